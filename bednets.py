@@ -4,29 +4,53 @@
 
 import settings
 
-from pylab import *
+from numpy import *
 from pymc import *
 
+import re
 import copy
 import time
+import glob
 import optparse
-import random
-
-from data import Data
-data = Data()
 
+from data import get_data
+
+import dynamics
+import sampling
+import trace_store
+import summary
+import results
+import diagnostics
+import checkpoint
+import warm_start
+import posterior
+import map_fit
+import step_methods
 import emp_priors
-import graphics
 
-def main(country_id):
+def setup_model(data, c, pop):
+    """ Build the model for one country
+
+    Parameters
+    ----------
+    data : data.Data
+    c : str
+      name of the country
+    pop : array
+      population of the country in each year
+
+    Results
+    -------
+    returns a dict of the nodes of the model, keyed by their variable
+    names in main, with 'vars' the list of all of them
+
+    Example
+    -------
+    >>> m = setup_model(data, 'Benin', data.population_for('Benin', year_start, year_end))
+    >>> Model(m['vars']).logp
+    """
     from settings import year_start, year_end
 
-    c = sorted(data.countries)[country_id]
-    print c
-
-    # get population data for this country, to calculate LLINs per capita
-    pop = data.population_for(c, year_start, year_end)
-
     ### setup the model variables
     vars = []
 
@@ -80,50 +104,17 @@ def main(country_id):
 
     vars += [log_delta, delta, log_mu, mu, log_Omega, Omega]
 
-    @deterministic(name='llin warehouse net stock')
-    def Psi(mu=mu, delta=delta):
-        Psi = zeros(year_end-year_start)
-        for t in range(year_end - year_start - 1):
-            Psi[t+1] = Psi[t] + mu[t] - delta[t]
-        return Psi
-
-    @deterministic(name='1-year-old household llin stock')
-    def Theta1(delta=delta):
-        Theta1 = zeros(year_end-year_start)
-        Theta1[1:] = delta[:-1]
-        return Theta1
-
-    @deterministic(name='2-year-old household llin stock')
-    def Theta2(Theta1=Theta1, pi=pi):
-        Theta2 = zeros(year_end-year_start)
-        Theta2[1:] = Theta1[:-1] * (1 - pi) ** .5
-        return Theta2
-
-    @deterministic(name='3-year-old household llin stock')
-    def Theta3(Theta2=Theta2, pi=pi):
-        Theta3 = zeros(year_end-year_start)
-        Theta3[1:] = Theta2[:-1] * (1  - pi)
-        return Theta3
-
-    @deterministic(name='household llin stock')
-    def Theta(Theta1=Theta1, Theta2=Theta2, Theta3=Theta3):
-        return Theta1 + Theta2 + Theta3
-
-    @deterministic(name='household itn stock')
-    def itns_owned(Theta=Theta, Omega=Omega):
-        return Theta + Omega
-
-    @deterministic(name='llin coverage')
-    def llin_coverage(Theta=Theta, pop=pop,
-                      eta=eta, alpha=alpha):
-        return 1. - (alpha / (eta*Theta/pop + alpha))**alpha
-
-    @deterministic(name='itn coverage')
-    def itn_coverage(llin=Theta, non_llin=Omega, pop=pop,
-                     eta=eta, alpha=alpha):
-        return 1. - (alpha / (eta*(llin + non_llin)/pop + alpha))**alpha
-
-    vars += [Psi, Theta, Theta1, Theta2, Theta3, itns_owned, llin_coverage, itn_coverage]
+    @deterministic(name='stock and flow', trace=False)
+    def X(mu=mu, delta=delta, Omega=Omega, pi=pi, eta=eta, alpha=alpha, pop=pop):
+        return dynamics.stock_and_flow(mu, delta, Omega, pi, eta, alpha, pop)
+
+    Psi = Lambda('llin warehouse net stock', lambda X=X: X[dynamics.WAREHOUSE])
+    Theta = Lambda('household llin stock', lambda X=X: X[dynamics.LLIN_STOCK])
+    itns_owned = Lambda('household itn stock', lambda X=X: X[dynamics.ITN_STOCK])
+    llin_coverage = Lambda('llin coverage', lambda X=X: X[dynamics.LLIN_COVERAGE])
+    itn_coverage = Lambda('itn coverage', lambda X=X: X[dynamics.ITN_COVERAGE])
+
+    vars += [X, Psi, Theta, itns_owned, llin_coverage, itn_coverage]
 
     # set initial conditions on nets manufactured to have no stockouts
     if min(Psi.value) < 0:
@@ -174,19 +165,20 @@ def main(country_id):
     ### nets shipped to country (reported by manufacturers)
 
     manufacturing_obs = []
-    for d in data.llin_manu:
-        if d['country'] != c:
-            continue
+    rows = data.llin_manu.for_country(c)
+    if len(rows) > 0:
+        manu_index = rows['year'].astype(int) - year_start
+        manu_itns = rows['manu_itns']
 
         @observed
-        @stochastic(name='manufactured_%s_%s' % (d['country'], d['year']))
-        def obs(value=max(1., float(d['manu_itns'])), year=int(d['year']), mu=mu, s_m=s_m):
-            return normal_like(log(value),  log(max(1., mu[year - year_start])), 1. / s_m**2)
+        @stochastic(name='manufactured_%s' % c)
+        def obs(value=log(maximum(1., manu_itns)), year_index=manu_index, mu=mu, s_m=s_m):
+            return normal_like(value, log(maximum(1., mu[year_index])), 1. / s_m**2)
         manufacturing_obs.append(obs)
 
         # also take this opportinuty to set better initial values for the MCMC
         cur_val = copy.copy(mu.value)
-        cur_val[int(d['year']) - year_start] = min(d['manu_itns'], 10.)
+        cur_val[manu_index] = minimum(manu_itns, 10.)
         log_mu.value = log(maximum(1., cur_val))
 
     vars += [manufacturing_obs]
@@ -196,26 +188,26 @@ def main(country_id):
     ### nets distributed in country (reported by NMCP)
 
     # store admin data for this country for each year
-    data_dict = {}
-    for d in data.admin_llin:
-        if d['country'] != c:
-            continue
-        data_dict[d['year']] = max(1., d['program_llins'])
+    rows = data.admin_llin.for_country(c)
+    data_dict = dict(zip(rows['year'], maximum(1., rows['program_llins'])))
         
     admin_distribution_obs = []
-    for year, d in data_dict.items():
+    if data_dict:
+        admin_years = sorted(data_dict.keys())
+        admin_index = array(admin_years, dtype=int) - year_start
+        admin_llins = array([data_dict[year] for year in admin_years])
 
         @observed
-        @stochastic(name='administrative_distribution_%s' % year)
-        def obs(value=log(d), year=year,
+        @stochastic(name='administrative_distribution_%s' % c)
+        def obs(value=log(admin_llins), year_index=admin_index,
                 delta=delta, s_d=s_d, e_d=e_d, beta=beta):
-            pred = log(max(1., delta[year - year_start] + beta*delta[year+1 - year_start])) + e_d
+            pred = log(maximum(1., delta[year_index] + beta*delta[year_index+1])) + e_d
             return normal_like(value, pred, 1. / s_d**2)
         admin_distribution_obs.append(obs)
 
         # also take this opportinuty to set better initial values for the MCMC
         cur_val = copy.copy(delta.value)
-        cur_val[year - year_start] = d
+        cur_val[admin_index] = admin_llins
         log_delta.value = log(cur_val)
 
     vars += [admin_distribution_obs]
@@ -224,34 +216,31 @@ def main(country_id):
     ### nets distributed in country (observed in household survey)
 
     household_distribution_obs = []
-    for d in data.hh_llin_flow:
-        if d['country'] != c:
-            continue
+    rows = data.hh_llin_flow.for_country(c)
+    if len(rows) > 0:
+        estimate_year = rows['year'].astype(int)
+        total_llins = rows['total_llins']
 
-        d2_i = d['total_llins']
-        estimate_year = int(d['year'])
-        
-        mean_survey_date = time.strptime(d['mean_svydate'], '%d-%b-%y')
-        survey_year = mean_survey_date[0] + mean_survey_date[1]/12.
-
-        s_d2_i = float(d['total_st'])
+        # time each net spent in the household before the survey,
+        # assuming it was distributed in the middle of the estimate year
+        time_held = rows['mean_survey_date'] - estimate_year - .5
 
         @observed
-        @stochastic(name='household_distribution_%s_%s' % (d['country'], d['year']))
-        def obs(value=d2_i,
-                estimate_year=estimate_year,
-                survey_year=survey_year,
-                survey_err=s_d2_i,
+        @stochastic(name='household_distribution_%s' % c)
+        def obs(value=total_llins,
+                year_index=estimate_year - year_start,
+                time_held=time_held,
+                survey_err=rows['total_st'],
                 delta=delta, pi=pi, s_rb=s_rb):
             return normal_like(
                 value,
-                delta[estimate_year - year_start] * (1 - pi) ** (survey_year - estimate_year - .5),
+                delta[year_index] * (1 - pi) ** time_held,
                 1./ (survey_err*(1+s_rb))**2)
         household_distribution_obs.append(obs)
 
         # also take this opportinuty to set better initial values for the MCMC
         cur_val = copy.copy(delta.value)
-        cur_val[estimate_year - year_start] = d2_i / (1 - pi.value)**(survey_year - estimate_year - .5)
+        cur_val[estimate_year - year_start] = total_llins / (1 - pi.value)**time_held
         log_delta.value = log(cur_val)
 
     vars += [household_distribution_obs]
@@ -259,20 +248,17 @@ def main(country_id):
 
     ### net stock in households (from survey)
     household_stock_obs = []
-    for d in data.hh_llin_stock:
-        if d['country'] != c:
-            continue
-        mean_survey_date = time.strptime(d['mean_svydate'], '%d-%b-%y')
-        d['year'] = mean_survey_date[0] + mean_survey_date[1]/12.
+    rows = data.hh_llin_stock.for_country(c)
+    if len(rows) > 0:
+        i0, i1, w = dynamics.interpolation_weights(rows['mean_survey_date'], year_start)
 
         @observed
-        @stochastic(name='LLIN_HH_Stock_%s_%s' % (d['country'], d['survey_year2']))
-        def obs(value=d['svyindex_llins'],
-                year=d['year'],
-                std_err=d['svyindexllins_se'],
+        @stochastic(name='LLIN_HH_Stock_%s' % c)
+        def obs(value=rows['svyindex_llins'],
+                i0=i0, i1=i1, w=w,
+                std_err=rows['svyindexllins_se'],
                 Theta=Theta):
-            year_part = year-floor(year)
-            Theta_i = (1-year_part) * Theta[floor(year)-year_start] + year_part * Theta[ceil(year)-year_start]
+            Theta_i = (1-w) * Theta[i0] + w * Theta[i1]
             return normal_like(value, Theta_i, 1. / std_err**2)
         household_stock_obs.append(obs)
 
@@ -280,100 +266,110 @@ def main(country_id):
 
 
     ### llin and itn coverage (from survey and survey reports)
+
+    # surveys report a standard error directly; for coverage imputed
+    # from under 5 usage or taken from survey reports, the standard
+    # error is the sampling error scaled by the survey design factor
     coverage_obs = []
-    for d in data.llin_coverage:
-        if d['country'] != c:
-            continue
-
-        if d['llins0_se']: # data from survey, includes standard error
-            d['coverage'] = 1. - float(d['per_0llins'])
-            d['coverage_se'] = float(d['llins0_se'])
-            mean_survey_date = time.strptime(d['mean_svydate'], '%d-%b-%y')
-            d['year'] = mean_survey_date[0] + mean_survey_date[1]/12.
-            
-            @observed
-            @stochastic(name='LLIN_Coverage_%s_%s' % (d['country'], d['survey_year2']))
-            def obs(value=d['coverage'],
-                    year=d['survey_year2'],
-                    std_err=d['coverage_se'],
-                    coverage=llin_coverage):
-                year_part = year-floor(year)
-                coverage_i = (1-year_part) * coverage[floor(year)-year_start] + year_part * coverage[ceil(year)-year_start]
-                return normal_like(value, coverage_i, 1. / std_err**2)
-        else: # data is imputed from under 5 usage, so estimate standard error
-            d['coverage'] = 1. - float(d['per_0llins'])
-            N = d['sample_size'] or 1000
-            d['sampling_error'] = d['coverage']*(1-d['coverage'])/sqrt(N)
-            d['coverage_se'] = d['sampling_error']*gamma.value
-
-            mean_survey_date = time.strptime(d['mean_svydate'], '%d-%b-%y')
-            d['year'] = mean_survey_date[0] + mean_survey_date[1]/12.
-
-            @observed
-            @stochastic(name='LLIN_Coverage_Imputation_%s_%s' % (d['country'], d['year']))
-            def obs(value=d['coverage'],
-                    year=d['year'],
-                    sampling_error=d['sampling_error'],
-                    design_factor=gamma,
-                    coverage=llin_coverage):
-                year_part = year-floor(year)
-                coverage_i = (1-year_part) * coverage[floor(year)-year_start] + year_part * coverage[ceil(year)-year_start]
-                return normal_like(value, coverage_i, 1. / (design_factor * sampling_error)**2)
-        coverage_obs.append(obs)
-            
-
-    for d in data.itn_coverage:
-        if d['country'] != c:
-            continue
-
-        d['coverage'] = 1. - float(d['per_0itns'])
-
-        if d['itns0_se']: # data from survey, includes standard error
-            d['coverage_se'] = d['itns0_se']
-
-            mean_survey_date = time.strptime(d['mean_svydate'], '%d-%b-%y')
-            d['year'] = mean_survey_date[0] + mean_survey_date[1]/12.
-
-            @observed
-            @stochastic(name='ITN_Coverage_%s_%s' % (d['country'], d['year']))
-            def obs(value=d['coverage'],
-                    year=d['year'],
-                    std_err=d['coverage_se'],
-                    coverage=itn_coverage):
-                year_part = year-floor(year)
-                coverage_i = (1-year_part) * coverage[floor(year)-year_start] + year_part * coverage[ceil(year)-year_start]
-                return normal_like(value, coverage_i, 1. / std_err**2)
-
-        else: # data from survey report, must calculate standard error
-            mean_survey_date = time.strptime(d['mean_svydate'], '%d-%b-%y')
-            d['year'] = mean_survey_date[0] + mean_survey_date[1]/12.
-
-            N = d['sample_size'] or 1000
-            d['sampling_error'] = d['coverage']*(1-d['coverage'])/sqrt(N)
-            d['coverage_se'] = d['sampling_error']*gamma.value
-
-            @observed
-            @stochastic(name='ITN_Coverage_Report_%s_%s' % (d['country'], d['year']))
-            def obs(value=d['coverage'],
-                    year=d['year'],
-                    sampling_error=d['sampling_error'],
-                    design_factor=gamma,
-                    coverage=itn_coverage):
-                year_part = year-floor(year)
-                coverage_i = (1-year_part) * coverage[floor(year)-year_start] + year_part * coverage[ceil(year)-year_start]
-                return normal_like(value, coverage_i, 1. / (design_factor * sampling_error)**2)
+    rows = data.llin_coverage.for_country(c)
+    if len(rows) > 0:
+        is_survey = rows['llins0_se'] > 0
+        i0, i1, w = dynamics.interpolation_weights(
+            where(is_survey, rows['survey_year2'], rows['mean_survey_date']), year_start)
 
+        @observed
+        @stochastic(name='LLIN_Coverage_%s' % c)
+        def obs(value=rows['coverage'],
+                i0=i0, i1=i1, w=w,
+                std_err=where(is_survey, rows['llins0_se'], 0.),
+                sampling_error=where(is_survey, 0., rows['sampling_error']),
+                design_factor=gamma,
+                coverage=llin_coverage):
+            coverage_i = (1-w) * coverage[i0] + w * coverage[i1]
+            return normal_like(value, coverage_i, 1. / (std_err + design_factor * sampling_error)**2)
         coverage_obs.append(obs)
 
 
+    rows = data.itn_coverage.for_country(c)
+    if len(rows) > 0:
+        is_survey = rows['itns0_se'] > 0
+        i0, i1, w = dynamics.interpolation_weights(rows['mean_survey_date'], year_start)
+
+        @observed
+        @stochastic(name='ITN_Coverage_%s' % c)
+        def obs(value=rows['coverage'],
+                i0=i0, i1=i1, w=w,
+                std_err=where(is_survey, rows['itns0_se'], 0.),
+                sampling_error=where(is_survey, 0., rows['sampling_error']),
+                design_factor=gamma,
+                coverage=itn_coverage):
+            coverage_i = (1-w) * coverage[i0] + w * coverage[i1]
+            return normal_like(value, coverage_i, 1. / (std_err + design_factor * sampling_error)**2)
+        coverage_obs.append(obs)
+
         # also take this opportinuty to set better initial values for the MCMC
-        t = floor(d['year'])-year_start
+        t = i0
         cur_val = copy.copy(Omega.value)
-        cur_val[t] = max(.0001*pop[t], log(1-d['coverage']) * pop[t] / eta.value - Theta.value[t])
+        cur_val[t] = maximum(.0001*pop[t], log(1-rows['coverage']) * pop[t] / eta.value - Theta.value[t])
         log_Omega.value = log(cur_val)
 
     vars += [coverage_obs]
 
+    return dict(vars=vars, pi=pi, e_d=e_d, s_d=s_d, beta=beta, eta=eta, alpha=alpha,
+                gamma=gamma, s_m=s_m, s_rb=s_rb,
+                log_delta=log_delta, delta=delta, log_mu=log_mu, mu=mu,
+                log_Omega=log_Omega, Omega=Omega,
+                X=X, Psi=Psi, Theta=Theta, itns_owned=itns_owned,
+                llin_coverage=llin_coverage, itn_coverage=itn_coverage,
+                positive_stocks=positive_stocks, proven_capacity=proven_capacity,
+                itn_composition=itn_composition, smooth_coverage=smooth_coverage,
+                manufacturing_obs=manufacturing_obs,
+                admin_distribution_obs=admin_distribution_obs,
+                household_distribution_obs=household_distribution_obs,
+                household_stock_obs=household_stock_obs,
+                coverage_obs=coverage_obs)
+
+
+def main(country_id, chains=None, resume=False, warm=None):
+    """ Fit the model for one country, and append the results to
+    settings.CSV_NAME
+
+    Parameters
+    ----------
+    country_id : int
+      index of the country in sorted(data.countries)
+    chains : int, optional
+      number of MCMC chains to run in parallel, defaults to
+      settings.CHAINS
+    resume : bool, optional
+      continue the latest fit for this country from its last
+      checkpoint, if it has one (see checkpoint.py)
+    warm : bool, optional
+      start from the state saved by the last fit for this country (see
+      warm_start.py), defaults to settings.WARM_START
+    """
+    from settings import year_start, year_end
+
+    if chains is None:
+        chains = settings.CHAINS
+    if warm is None:
+        warm = settings.WARM_START
+
+    data = get_data()
+    c = sorted(data.countries)[country_id]
+    print c
+
+    # get population data for this country, to calculate LLINs per capita
+    pop = data.population_for(c, year_start, year_end)
+
+    m = setup_model(data, c, pop)
+    vars = m['vars']
+    s_m, s_d, e_d, pi, eta, alpha, gamma, s_rb = [m[k] for k in ['s_m', 's_d', 'e_d', 'pi', 'eta', 'alpha', 'gamma', 's_rb']]
+    log_mu, log_delta, log_Omega, mu, delta, Omega = [m[k] for k in ['log_mu', 'log_delta', 'log_Omega', 'mu', 'delta', 'Omega']]
+    Psi, Theta, itns_owned, llin_coverage, itn_coverage = [m[k] for k in ['Psi', 'Theta', 'itns_owned', 'llin_coverage', 'itn_coverage']]
+    positive_stocks = m['positive_stocks']
+    manufacturing_obs, admin_distribution_obs, household_distribution_obs, household_stock_obs, coverage_obs = \
+        [m[k] for k in ['manufacturing_obs', 'admin_distribution_obs', 'household_distribution_obs', 'household_stock_obs', 'coverage_obs']]
 
        #################
       ### fit the model
@@ -381,7 +377,44 @@ def main(country_id):
     #################
     print 'running fit for net model in %s...' % c
 
-    if settings.TESTING:
+    ext = settings.TRACE_BACKEND
+    if ext == 'chunked':
+        ext = 'traces'  # a directory, see trace_store.py
+    dbname = settings.PATH + 'bednet_model_%s_%d_%s.%s' % (c, country_id, time.strftime('%Y_%m_%d_%H_%M'), ext)
+    if resume:
+        # the latest fit with a checkpoint, for itself or any of its chains
+        fits = sorted(glob.glob(settings.PATH + 'bednet_model_%s_%d_*.%s*.checkpoint' % (c, country_id, ext)))
+        if fits:
+            dbname = re.sub('(\.chain[0-9]+)?\.checkpoint$', '', fits[-1])
+            print 'resuming %s' % dbname
+        else:
+            print 'no checkpoint found, starting a new fit'
+            resume = False
+
+    # start from the state reached by the last fit, if it still fits
+    # the model and data
+    model = Model(vars)
+    saved = None
+    if warm and not resume:
+        saved = warm_start.load(c)
+        if saved and not warm_start.apply(model, saved['mcmc'] and saved['mcmc']['stochastics'] or saved['map']):
+            print 'saved state from %s does not fit the current model' % saved['time']
+            saved = None
+
+    map_values = None
+    post = laplace_cov = None
+    if resume:
+        pass  # the MCMC starts from the checkpoint, so there is no need for initial values
+    elif saved:
+        print 'warm start from fit of %s' % saved['time']
+    elif settings.MAP_METHOD == 'lbfgs':
+        # the laplace approximation at the optimum is also the starting
+        # proposal covariance of the block steps (see step_methods.py)
+        post = posterior.Posterior(vars)
+        x, laplace_cov = map_fit.laplace(post, map_fit.fit(post, verbose=1))
+        for stoch in [s_m, s_d, e_d, pi, eta, alpha]:
+            print '%s: %s' % (str(stoch), str(stoch.value))
+    elif settings.TESTING:
         map = MAP(vars)
         map.fit(method='fmin', iterlim=100, verbose=1)
     else:
@@ -405,27 +438,53 @@ def main(country_id):
         for stoch in [s_m, s_d, e_d, pi, eta, alpha]:
             print '%s: %s' % (str(stoch), str(stoch.value))
 
-    if settings.METHOD == 'MCMC':
-        mc = MCMC(vars, verbose=1, db='pickle', dbname=settings.PATH + 'bednet_model_%s_%d_%s.pickle' % (c, country_id, time.strftime('%Y_%m_%d_%H_%M')))
-        mc.use_step_method(Metropolis, s_m, proposal_sd=.001)
-        mc.use_step_method(Metropolis, eta, proposal_sd=.001)
+    if not resume and not saved:
+        map_values = warm_start.values(model)
 
-        try:
+    # posterior summaries of the reported quantities, accumulated as
+    # the samples are drawn
+    summaries = summary.Summaries([mu, delta, Psi, Theta, Omega, itns_owned, llin_coverage, itn_coverage])
+
+    if settings.METHOD == 'MCMC':
+        def make_mcmc(dbname):
+            mc = MCMC(vars, verbose=1, db=checkpoint.database(dbname), dbname=dbname)
+            blocked = [name for block in settings.BLOCKS for name in block]
+            for stoch in [s_m, eta]:
+                if stoch.__name__ not in blocked:
+                    mc.use_step_method(Metropolis, stoch, proposal_sd=.001)
+            step_methods.use_blocks(mc, settings.BLOCKS, post, laplace_cov)
+            if saved:
+                warm_start.tune(mc, saved['mcmc'])
+            summaries.attach(mc)
+            return mc
+
+        # stochs that are reported in the output, which must have
+        # converged before sampling stops
+        reported = ['llins shipped', 'llins distributed', 'llin warehouse net stock',
+                    'household llin stock', 'non-llin household net stock',
+                    'household itn stock', 'llin coverage', 'itn coverage', 'Pr[net is lost]']
+        burn = settings.BURN
+        if saved:
+            burn = settings.WARM_START_BURN
+        def sample_chain(mc):
             if settings.TESTING:
-                iter = 100
-                thin = 1
-                burn = 0
+                sampling.sample(mc, reported, 100, 0, 1, chains, adaptive=False)
             else:
-                iter = settings.NUM_SAMPLES
-                thin = settings.THIN
-                burn = settings.BURN
-            mc.sample(iter*thin+burn, burn, thin)
-        except KeyError:
-            pass
-        mc.db.commit()
+                sampling.sample(mc, reported, settings.NUM_SAMPLES, burn, settings.THIN, chains,
+                                summaries=summaries)
+
+        if chains > 1:
+            db = sampling.run_chains(make_mcmc, sample_chain, dbname, chains, summaries)
+            mc = MCMC(vars, db=db)
+            diagnostics.summarize(db, ['itn coverage', 'llins distributed', 'Pr[net is lost]'])
+        else:
+            mc = make_mcmc(dbname)
+            sample_chain(mc)
+            mc.db.commit()
 
     elif settings.METHOD == 'NormApprox':
         na = NormApprox(vars)
+        summaries.attach(na)
         na.fit(method='fmin_powell', tol=.00001, verbose=1)
         for stoch in [s_m, s_d, e_d, pi]:
             print '%s: %s' % (str(stoch), str(stoch.value))
@@ -435,83 +494,72 @@ def main(country_id):
         assert 0, 'Unknown estimation method'
 
     # save results in output file
-    col_headings = [
-        'Country', 'Year', 'Population',
-        'LLINs Shipped (Thousands)', 'LLINs Shipped Lower CI', 'LLINs Shipped Upper CI',
-        'LLINs Distributed (Thousands)', 'LLINs Distributed Lower CI', 'LLINs Distributed Upper CI',
-        'LLINs Not Owned Warehouse (Thousands)', 'LLINs Not Owned Lower CI', 'LLINs Not Owned Upper CI',
-        'LLINs Owned (Thousands)', 'LLINs Owned Lower CI', 'LLINs Owned Upper CI',
-        'non-LLIN ITNs Owned (Thousands)', 'non-LLIN ITNs Owned Lower CI', 'non-LLIN ITNs Owned Upper CI',
-        'ITNs Owned (Thousands)', 'ITNs Owned Lower CI', 'ITNs Owned Upper CI',
-        'LLIN Coverage (Percent)', 'LLIN Coverage Lower CI', 'LLIN Coverage Upper CI',
-        'ITN Coverage (Percent)', 'ITN Coverage Lower CI', 'ITN Coverage Upper CI',
-        ]
-
-    try:  # sleep for a random time interval to avoid collisions when writing results
-        print 'sleeping...'
-        time.sleep(random.random()*30)
-        print '...woke up'
-    except:  # but let user cancel with cntl-C if there is a rush
-        print '...work up early'
-
-    if not settings.CSV_NAME in os.listdir(settings.PATH):
-        f = open(settings.PATH + settings.CSV_NAME, 'a')
-        f.write('%s\n' % ','.join(col_headings))
-    else:
-        f = open(settings.PATH + settings.CSV_NAME, 'a')
+    rows = summaries.table(c, pop, year_start)
 
-    for t in range(year_end - year_start):
-        f.write('%s,%d,%d,' % (c,year_start + t,pop[t]))
-        if t == year_end - year_start - 1:
-            val = [-99, -99, -99]
-            val += [-99, -99, -99]
-        else:
-            val = [mu.stats()['mean'][t]/1000] + list(mu.stats()['95% HPD interval'][t]/1000)
-            val += [delta.stats()['mean'][t]/1000] + list(delta.stats()['95% HPD interval'][t]/1000)
-        val += [Psi.stats()['mean'][t]/1000] + list(Psi.stats()['95% HPD interval'][t]/1000)
-        val += [Theta.stats()['mean'][t]/1000] + list(Theta.stats()['95% HPD interval'][t]/1000)
-        val += [Omega.stats()['mean'][t]/1000] + list(Omega.stats()['95% HPD interval'][t]/1000)
-        val += [itns_owned.stats()['mean'][t]/1000] + list(itns_owned.stats()['95% HPD interval'][t]/1000)
-        val += [100*llin_coverage.stats()['mean'][t]] + list(100*llin_coverage.stats()['95% HPD interval'][t])
-        val += [100*itn_coverage.stats()['mean'][t]] + list(100*itn_coverage.stats()['95% HPD interval'][t])
-        f.write(','.join(['%.2f']*(len(col_headings)-3)) % tuple(val))
-        f.write('\n')
-    f.close()
+    # each fit saves its own results file, and output.csv is
+    # regenerated from all of them
+    results.save(c, results.new_run_id(), rows)
+    results.export_csv()
+    checkpoint.remove(dbname)
+
+    # save the state reached, for the next fit of this country
+    if settings.METHOD == 'MCMC':
+        warm_start.save(c, map_values, mc.db.getstate())
+    else:
+        warm_start.save(c, map_values)
     
     f = open(settings.PATH + 'traces/itn_coverage_%s_%d_%s.csv' % (c, country_id, time.strftime('%Y_%m_%d_%H_%M')), 'w')
     f.write(','.join(['itn_hhcov_%d' % year for year in range(year_start, year_end)]))
     f.write('\n')
-    for row in itn_coverage.trace():
+    for row in itn_coverage.trace(chain=None):
         f.write(','.join(['%.4f' % cell for cell in row]))
         f.write('\n')
     f.close()
     
     f = open(settings.PATH + 'traces/itn_stock_%s_%d_%s.csv' % (c, country_id, time.strftime('%Y_%m_%d_%H_%M')), 'w')
-    for row in itns_owned.trace():
+    for row in itns_owned.trace(chain=None):
         f.write(','.join(['%.4f' % cell for cell in row]))
         f.write('\n')
     f.close()
 
+    if not settings.PLOTTING:
+        return
+
+    import graphics
     graphics.plot_posterior(country_id, c, pop,
                             s_m, s_d, e_d, pi, mu, delta, Psi, Theta, Omega, gamma, eta, alpha, s_rb,
                             manufacturing_obs, admin_distribution_obs, household_distribution_obs,
-                            itn_coverage, llin_coverage, itns_owned, data
-                            )
+                            itn_coverage, llin_coverage, itns_owned, data,
+                            summaries)
 
 if __name__ == '__main__':
     usage = 'usage: %prog [options] country_id'
     parser = optparse.OptionParser(usage)
+    parser.add_option('--no-plots', action='store_true', dest='no_plots', default=False,
+                      help='skip all graphics, so matplotlib is never imported')
+    parser.add_option('-c', '--chains', type='int', dest='chains', default=None,
+                      help='number of MCMC chains to run in parallel (default: settings.CHAINS)')
+    parser.add_option('--resume', action='store_true', dest='resume', default=False,
+                      help='continue the latest fit for this country from its last checkpoint')
+    parser.add_option('--cold', action='store_false', dest='warm', default=None,
+                      help='ignore the state saved by the last fit for this country, and start from scratch')
     (options, args) = parser.parse_args()
 
+    if options.no_plots:
+        settings.PLOTTING = False
+
     if len(args) != 1:
         parser.error('incorrect number of arguments')
     elif args[0] == 'summarize':
         import explore
         explore.summarize_fits()
+    elif args[0] == 'joint':
+        import joint
+        joint.main(chains=options.chains, resume=options.resume)
     else:
         try:
             country_id = int(args[0])
         except ValueError:
-            parser.error('country_id must be an integer (or summarize to generate summary tables)')
+            parser.error('country_id must be an integer (or summarize to generate summary tables, or joint to fit all countries jointly)')
 
-        main(country_id)
+        main(country_id, options.chains, options.resume, options.warm)
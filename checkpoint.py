@@ -0,0 +1,143 @@
+""" Module for checkpointing long MCMC runs, so that a fit which is
+killed part way through (e.g. preempted on the cluster) can be resumed
+from the last batch of samples instead of from the start
+
+A checkpoint is saved next to the trace database after every batch of
+iterations (see sampling.py).  It holds everything needed to continue
+the run that is not already in the database: the current value of
+every stoch, the tuning of every step method, the state of the random
+number generator, the streaming summaries and the progress of the
+burn-in and sampling.  The traces themselves are already on disk,
+since each batch is a separate chain of the database.
+
+Example
+-------
+>>> mc = MCMC(vars, db='chunked', dbname='bednet_model_Angola_0.traces')
+>>> sampling.sample(mc, names, 10000, 250000, 2000, checkpoint=True)
+... killed ...
+>>> mc = MCMC(vars, db=checkpoint.database('bednet_model_Angola_0.traces'), dbname='bednet_model_Angola_0.traces')
+>>> sampling.sample(mc, names, 10000, 250000, 2000, checkpoint=True)   # continues from the last batch
+"""
+
+import os
+import cPickle
+
+import numpy
+import pymc
+
+import settings
+
+
+def filename(dbname):
+    """ Name of the checkpoint file for the database dbname"""
+    return dbname.rstrip('/') + '.checkpoint'
+
+
+def db_filename(db):
+    """ File (or directory) name of a pickle or chunked database"""
+    return getattr(db, 'filename', None) or db.dbname
+
+
+def exists(dbname):
+    return os.path.exists(filename(dbname))
+
+
+def database(dbname, backend=None):
+    """ Return the db argument for MCMC that adds chains to the
+    existing database dbname
+
+    Notes
+    -----
+    chunked databases are reopened by name, but the pymc pickle
+    backend would overwrite an existing file, so it is loaded instead
+    """
+    if backend is None:
+        backend = settings.TRACE_BACKEND
+    if backend == 'pickle' and os.path.exists(dbname):
+        return pymc.database.pickle.load(dbname)
+    return backend
+
+
+def save(mc, progress, summaries=None):
+    """ Save a checkpoint for the database of mc
+
+    Parameters
+    ----------
+    mc : pymc MCMC
+      sampler that has just finished a batch of samples
+    progress : dict
+      whatever the sampling loop needs to continue where it left off
+    summaries : summary.Summaries, optional
+      streaming summaries attached to mc
+    """
+    state = dict(sampler=mc.get_state(),
+                 random=numpy.random.get_state(),
+                 chains=mc.db.chains,
+                 progress=progress)
+    if summaries:
+        state['summaries'] = summaries.accumulators
+
+    # write via a temporary file, so a job killed while writing leaves
+    # the previous checkpoint intact
+    fname = filename(db_filename(mc.db))
+    f = open(fname + '.tmp', 'wb')
+    cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(fname + '.tmp', fname)
+
+
+def restore(mc, summaries=None):
+    """ Restore the state of mc (and summaries) from the checkpoint of
+    its database, if there is one
+
+    Results
+    -------
+    returns the progress dict passed to save, or None if there is no
+    checkpoint
+
+    Notes
+    -----
+    chains that were added to the database after the checkpoint (by a
+    batch that did not finish) are dropped; the step methods are
+    restored by pymc from the database state when sampling starts
+    """
+    fname = filename(db_filename(mc.db))
+    if not os.path.exists(fname):
+        return None
+    f = open(fname, 'rb')
+    state = cPickle.load(f)
+    f.close()
+
+    drop_chains(mc.db, state['chains'])
+    for s in mc.stochastics:
+        if s.__name__ in state['sampler']['stochastics']:
+            s.value = state['sampler']['stochastics'][s.__name__]
+    mc.db.savestate(state['sampler'])
+    numpy.random.set_state(state['random'])
+    if summaries and 'summaries' in state:
+        summaries.accumulators = state['summaries']
+        summaries.cache = {}
+
+    print 'resuming from checkpoint %s' % fname
+    return state['progress']
+
+
+def remove(dbname):
+    if exists(dbname):
+        os.remove(filename(dbname))
+
+
+def drop_chains(db, chains):
+    """ Remove the chains of a pickle or chunked database after the
+    first chains"""
+    if db.chains <= chains:
+        return
+    for name, trace in db._traces.items():
+        for k in range(chains, db.chains):
+            if hasattr(trace, '_trace'):
+                trace._trace.pop(k, None)
+            elif os.path.exists(trace.filename(k)):
+                os.remove(trace.filename(k))
+    db.trace_names = db.trace_names[:chains]
+    db.chains = chains
+    db.commit()
@@ -4,42 +4,141 @@ for bednet distribution
 
 import csv
 import time
-from numpy import zeros, mean
+import os
+import shutil
+import hashlib
+import simplejson as json
+from numpy import zeros, mean, array, asarray, argsort, unique, searchsorted, nan, isnan, save, load
 
 import settings
 
+# column types for the input csv files; columns not listed here are
+# loaded as floats if every cell is numeric, and as strings otherwise
+SCHEMA = {
+    'reten.csv': dict(name=str, year=float, retention_rate=float, follow_up_time=float),
+    'design.csv': dict(itncomplex_to_simpleratio=float, llincomplex_to_simpleratio=float),
+    'manuitns.csv': dict(country=str, year=float, manu_itns=float),
+    'adminllins_itns.csv': dict(country=str, year=float, program_llins=float),
+    'stock_llins.csv': dict(country=str, mean_svydate=str, survey_year1=float, survey_year2=float,
+                            svyindex_llins=float, svyindexllins_se=float),
+    'flow_llins.csv': dict(country=str, mean_svydate=str, year=float, total_llins=float, total_st=float),
+    'llincc.csv': dict(country=str, mean_svydate=str, survey_year1=float, survey_year2=float,
+                       per_0llins=float, llins0_se=float, sample_size=float),
+    'itncc.csv': dict(country=str, mean_svydate=str, per_0itns=float, itns0_se=float, sample_size=float),
+    'numllins.csv': dict(country=str, mean_svydate=str, survey_year1=float),
+    'pop.csv': dict(country=str, year=float, pop=float),
+    }
+
+# (attribute, csv file) for each table loaded by Data
+TABLES = [['retention', 'reten.csv'],
+          ['design', 'design.csv'],
+          ['llin_manu', 'manuitns.csv'],
+          ['admin_llin', 'adminllins_itns.csv'],
+          ['hh_llin_stock', 'stock_llins.csv'],
+          ['hh_llin_flow', 'flow_llins.csv'],
+          ['llin_coverage', 'llincc.csv'],
+          ['itn_coverage', 'itncc.csv'],
+          ['llin_num', 'numllins.csv'],
+          ['population', 'pop.csv']]
+
+# bump this when the parsed representation changes, to invalidate old caches
+CACHE_VERSION = 1
+
 class Data:
-    def __init__(self):
-        ### load all data from csv files
-        self.retention = load_csv('reten.csv')
-        self.design = load_csv('design.csv')
+    def __init__(self, path=None):
+        """ Load all of the input data in a directory
 
-        self.llin_manu = load_csv('manuitns.csv')
-        self.admin_llin = load_csv('adminllins_itns.csv')
+        Parameters
+        ----------
+        path : str, optional
+          directory containing the input csv files, ending with a '/';
+          defaults to settings.PATH
+        """
+        self.path = path or settings.PATH
 
-        self.hh_llin_stock = load_csv('stock_llins.csv')
-        self.hh_llin_flow = load_csv('flow_llins.csv')
+        cache_dir = None
+        if settings.DATA_CACHE:
+            cache_dir = '%scache/data_%s/' % (self.path, input_digest(self.path))
 
-        self.llin_coverage = load_csv('llincc.csv')
-        self.itn_coverage = load_csv('itncc.csv')
-        self.llin_num = load_csv('numllins.csv')
+        if cache_dir and os.path.exists(cache_dir):
+            self.load_cache(cache_dir)
+        else:
+            self.parse_csvs()
+            if cache_dir:
+                self.save_cache(cache_dir)
+
+        self.countries = set(self.population.index.keys())
+        self.years = range(settings.year_start, settings.year_end)
+
+    def parse_csvs(self):
+        ### load all data from csv files
+        for attr, fname in TABLES:
+            setattr(self, attr, load_table(fname, self.path))
 
         # add mean survey date to data
-        for d in self.hh_llin_stock + self.hh_llin_flow \
-                + self.llin_coverage + self.itn_coverage + self.llin_num:
-            mean_survey_date = time.strptime(d['mean_svydate'], '%d-%b-%y')
-            d['mean_survey_date'] = mean_survey_date[0] + mean_survey_date[1]/12.
+        for t in [self.hh_llin_stock, self.hh_llin_flow,
+                  self.llin_coverage, self.itn_coverage, self.llin_num]:
+            t.columns['mean_survey_date'] = fractional_dates(t['mean_svydate'])
 
-        self.population = load_csv('pop.csv')
+        # add coverage and its sampling error (for rows without a
+        # reported standard error) to coverage data
+        for t, uncovered in [[self.llin_coverage, 'per_0llins'],
+                             [self.itn_coverage, 'per_0itns']]:
+            coverage = 1. - t[uncovered]
+            N = t['sample_size'].copy()
+            N[isnan(N) | (N == 0)] = 1000
+            t.columns['coverage'] = coverage
+            t.columns['sampling_error'] = coverage*(1-coverage)/N**.5
 
-        self.countries = set([d['country'] for d in self.population])
-        self.years = range(settings.year_start, settings.year_end)
+    def save_cache(self, cache_dir):
+        """ Save the parsed tables as .npy files in cache_dir
+
+        Notes
+        -----
+        the files are written to a temporary dir which is then renamed,
+        so concurrent jobs never see a partially written cache
+        """
+        tmp_dir = '%s.tmp_%d' % (cache_dir.rstrip('/'), os.getpid())
+        os.makedirs(tmp_dir)
+
+        manifest = {}
+        for attr, fname in TABLES:
+            t = getattr(self, attr)
+            manifest[attr] = t.keys()
+            for j, k in enumerate(manifest[attr]):
+                save(os.path.join(tmp_dir, '%s.%d.npy' % (attr, j)), t[k])
+            if t.order is not None:
+                save(os.path.join(tmp_dir, '%s.order.npy' % attr), t.order)
+        f = open(os.path.join(tmp_dir, 'manifest.json'), 'w')
+        json.dump(manifest, f)
+        f.close()
+
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:  # another job finished writing the same cache first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def load_cache(self, cache_dir):
+        """ Load the tables saved by save_cache, memory-mapping each column"""
+        f = open(cache_dir + 'manifest.json')
+        manifest = json.load(f)
+        f.close()
+
+        for attr, fname in TABLES:
+            columns = {}
+            for j, k in enumerate(manifest[attr]):
+                columns[str(k)] = load_npy(cache_dir + '%s.%d.npy' % (attr, j))
+            order = None
+            if os.path.exists(cache_dir + '%s.order.npy' % attr):
+                order = load_npy(cache_dir + '%s.order.npy' % attr)
+            setattr(self, attr, Table(columns, order))
 
     def population_for(self, c, year_start, year_end):
         pop_vec = zeros(year_end - year_start)
-        for d in self.population:
-            if d['country'] == c:
-                pop_vec[int(d['year']) - year_start] = d['pop']*1000
+        rows = self.population.for_country(c)
+        t = rows['year'].astype(int) - year_start
+        in_range = (t >= 0) & (t < year_end - year_start)
+        pop_vec[t[in_range]] = rows['pop'][in_range]*1000
 
         # since we might be predicting into the future, fill in population with last existing value
         for ii in range(1, year_end-year_start):
@@ -49,13 +148,219 @@ class Data:
         return pop_vec
 
 
+# the Data instance shared by all modules, loaded on first use
+_data = None
+
+def get_data():
+    """ Return the shared Data instance, loading it from settings.PATH
+    the first time it is needed
+
+    Example
+    -------
+    >>> from data import get_data
+    >>> data = get_data()
+    >>> data.population_for('Benin', 1999, 2013)
+    """
+    global _data
+    if _data is None:
+        _data = Data()
+    return _data
+
+def set_data(data):
+    """ Replace the shared Data instance
+
+    Parameters
+    ----------
+    data : Data or None
+      the dataset all modules should use from now on; pass None to
+      reload from settings.PATH on next use (e.g. after changing it)
+
+    Example
+    -------
+    >>> import data
+    >>> data.set_data(data.Data('/home/j/Project/Models/bednets/2010_07_26/'))
+    """
+    global _data
+    _data = data
+
+
+class Table:
+    """ Columnar store for the rows of a csv file
+
+    Each column is a numpy array, and rows are grouped by country (if
+    there is a country column), so that the rows for a single country
+    are a contiguous slice of every column.
+
+    Example
+    -------
+    >>> t = load_table('manuitns.csv')
+    >>> t['manu_itns']                      # the whole column
+    >>> t.for_country('Benin')['year']      # a view of the rows for one country
+    >>> for d in t: print d['year']         # rows as dicts, in file order
+    """
+    def __init__(self, columns, order=None, index=None):
+        self.columns = columns
+        self.order = order
+        self.index = index
+
+        # find the row range for each country
+        if index is None:
+            self.index = {}
+        if index is None and 'country' in columns:
+            countries = columns['country']
+            for c in unique(countries):
+                start = searchsorted(countries, c, 'left')
+                stop = searchsorted(countries, c, 'right')
+                self.index[str(c)] = (start, stop)
+
+    def __len__(self):
+        for col in self.columns.values():
+            return len(col)
+        return 0
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def keys(self):
+        return self.columns.keys()
+
+    def for_country(self, c):
+        """ Return a Table of the rows for country c (the columns are
+        views, not copies)"""
+        start, stop = self.index.get(c, (0, 0))
+        return Table(dict([[k, col[start:stop]] for k, col in self.columns.items()]),
+                     index={c: (0, stop-start)})
+
+    def __iter__(self):
+        """ Iterate over rows as dicts, in the order of the csv file
+
+        Notes
+        -----
+        missing numeric values are returned as empty strings, as they
+        were by load_csv
+        """
+        order = self.order
+        if order is None:
+            order = range(len(self))
+        for i in order:
+            d = {}
+            for k, col in self.columns.items():
+                val = col[i]
+                if col.dtype.kind == 'f':
+                    if isnan(val):
+                        val = ''
+                    else:
+                        val = float(val)
+                else:
+                    val = str(val)
+                d[k] = val
+            yield d
+
+
+def input_digest(path):
+    """ Return a hash of path and the contents of every input csv in
+    it, which changes whenever any input is edited"""
+    h = hashlib.md5()
+    h.update('%s %d %r' % (path, CACHE_VERSION, sorted(SCHEMA.items())))
+    for attr, fname in TABLES:
+        f = open(path + fname, 'rb')
+        h.update(f.read())
+        f.close()
+    return h.hexdigest()
+
+
+def load_npy(fname):
+    """ Memory-map a .npy file, falling back on reading it for empty
+    arrays (which cannot be memory-mapped)"""
+    try:
+        return load(fname, mmap_mode='r')
+    except ValueError:
+        return load(fname)
+
+
+def fractional_dates(dates):
+    """ Convert an array of dates formatted like 15-Jun-08 to
+    fractional years, parsing each distinct date only once"""
+    dates, inverse = unique(asarray(dates), return_inverse=True)
+    years = zeros(len(dates))
+    for i, d in enumerate(dates):
+        t = time.strptime(d, '%d-%b-%y')
+        years[i] = t[0] + t[1]/12.
+    return years[inverse]
+
+
+def load_table(fname, path=None):
+    """ Load the columns of a csv file into a Table
+
+    Parameters
+    ----------
+    fname : str
+      name of the .csv file to load; column types are taken from
+      SCHEMA[fname]
+    path : str, optional
+      directory containing the file, defaults to settings.PATH
+
+    Results
+    -------
+    returns a Table, with rows grouped by country (in file order
+    within each country)
+    """
+    f = open((path or settings.PATH) + fname)
+    csv_f = csv.reader(f)
+    header = [k.lower() for k in csv_f.next()]
+    rows = [r for r in csv_f]
+    f.close()
+
+    schema = SCHEMA.get(fname, {})
+    columns = {}
+    for j, k in enumerate(header):
+        cells = [r[j].strip() for r in rows]
+        if schema.get(k, float) == str:
+            columns[k] = array(cells, dtype=str)
+        else:
+            col = parse_floats(cells)
+            if col is None:
+                if k in schema:
+                    col = array([to_float(x) for x in cells])
+                else:
+                    col = array(cells, dtype=str)
+            columns[k] = col
+
+    # group rows by country, keeping file order within each country
+    order = None
+    if 'country' in columns:
+        perm = argsort(columns['country'], kind='mergesort')
+        for k in columns:
+            columns[k] = columns[k][perm]
+        order = argsort(perm)
+
+    return Table(columns, order)
+
+
+def parse_floats(cells):
+    """ Convert a list of strings to a float array in one call,
+    treating blank cells as missing; return None if any cell is not
+    numeric"""
+    try:
+        return array([x.replace(',', '') or 'nan' for x in cells], dtype=float)
+    except ValueError:
+        return None
+
+
+def to_float(x):
+    try:
+        return float(x.replace(',', ''))
+    except ValueError:
+        return nan
+
+
 def load_csv(fname):
     """ Quick function to load each row of a csv file as a dict
     Parameters
     ----------
     fname : str
       name of the .csv file to load
-    
+
     Results
     -------
     returns a list of dicts, one list item for each row of the csv
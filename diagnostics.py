@@ -0,0 +1,119 @@
+""" Module for checking the convergence of the MCMC for the
+stock-and-flow model from several independent chains
+"""
+
+from numpy import asarray, zeros, ones, arange, sqrt, where, inf
+
+
+def chain_array(traces):
+    """ Stack a list of traces (one per chain) into an array of shape
+    (chains, samples, k), truncating the chains to a common length and
+    flattening any trailing axes"""
+    n = min([len(t) for t in traces])
+    x = asarray([asarray(t)[:n] for t in traces], dtype=float)
+    return x.reshape(x.shape[0], n, -1)
+
+
+def gelman_rubin(traces):
+    """ Potential scale reduction factor R-hat for each element of a
+    stoch, from the between- and within-chain variances
+
+    Parameters
+    ----------
+    traces : list of arrays, shape (samples, ...)
+      one trace per chain
+
+    Results
+    -------
+    returns an array of R-hat values, one for each element of the
+    stoch (values near 1 indicate convergence)
+
+    Example
+    -------
+    >>> diagnostics.gelman_rubin([db.trace('itn coverage', k)[:] for k in range(db.chains)])
+    """
+    x = chain_array(traces)
+    m, n = x.shape[:2]
+    if m < 2 or n < 2:
+        return zeros(x.shape[2]) + inf
+
+    W = x.var(axis=1, ddof=1).mean(axis=0)
+    B = n * x.mean(axis=1).var(axis=0, ddof=1)
+    var_plus = (n - 1.) / n * W + B / n
+    return sqrt(var_plus / where(W > 0, W, inf))
+
+
+def effective_sample_size(traces):
+    """ Effective sample size of each element of a stoch, combined
+    over all chains
+
+    Parameters
+    ----------
+    traces : list of arrays, shape (samples, ...)
+      one trace per chain (a single chain is fine)
+
+    Results
+    -------
+    returns an array with the number of effectively independent
+    samples for each element of the stoch
+
+    Notes
+    -----
+    autocorrelations are estimated from the variogram pooled over
+    chains and summed over lags until the sum of a consecutive pair
+    becomes negative (Geyer's initial positive sequence), as in
+    Gelman et al., Bayesian Data Analysis, section 11.5
+    """
+    x = chain_array(traces)
+    m, n, k = x.shape
+    if n < 4:
+        return zeros(k) + m*n
+
+    W = x.var(axis=1, ddof=1).mean(axis=0)
+    if m > 1:
+        B = n * x.mean(axis=1).var(axis=0, ddof=1)
+    else:
+        B = 0.
+    var_plus = (n - 1.) / n * W + B / n
+
+    rho_sum = zeros(k)
+    active = var_plus > 0
+    safe_var = where(active, var_plus, 1.)
+    for t in arange(1, n-1, 2):
+        pair = zeros(k)
+        for lag in [t, t+1]:
+            V = ((x[:, lag:] - x[:, :-lag])**2).mean(axis=1).mean(axis=0)
+            pair += 1. - V / (2. * safe_var)
+        active = active & (pair >= 0)
+        if not active.any():
+            break
+        rho_sum += where(active, pair, 0.)
+
+    ess = m * n / (1. + 2. * rho_sum)
+    return where(var_plus > 0, ess, m*n*ones(k))
+
+
+def summarize(db, names):
+    """ Print and return R-hat and combined effective sample size for
+    some stochs of a multi-chain pymc database
+
+    Parameters
+    ----------
+    db : pymc Database
+    names : list of str
+      names of traced stochs to check
+
+    Results
+    -------
+    returns a list of [name, element, R-hat, ESS] rows
+    """
+    rows = []
+    for name in names:
+        traces = [db.trace(name, k)[:] for k in range(db.chains)]
+        R = gelman_rubin(traces)
+        ess = effective_sample_size(traces)
+        for i in range(len(R)):
+            rows.append([name, i, R[i], ess[i]])
+        print '%s: max R-hat %.3f, min ESS %.0f (from %d chains of %d samples)' % (
+            name, R.max(), ess.min(), len(traces), min([len(t) for t in traces]))
+    return rows
@@ -0,0 +1,178 @@
+""" Module for the compartmental dynamics of the stock-and-flow model
+for bednet distribution
+"""
+
+from numpy import zeros, asarray, broadcast, cumsum, newaxis, floor, ceil, result_type
+
+# rows of the compartment array returned by stock_and_flow
+WAREHOUSE = 0
+HOUSEHOLD_1 = 1
+HOUSEHOLD_2 = 2
+HOUSEHOLD_3 = 3
+LLIN_STOCK = 4
+ITN_STOCK = 5
+LLIN_COVERAGE = 6
+ITN_COVERAGE = 7
+
+COMPARTMENTS = ['llin warehouse net stock',
+                '1-year-old household llin stock',
+                '2-year-old household llin stock',
+                '3-year-old household llin stock',
+                'household llin stock',
+                'household itn stock',
+                'llin coverage',
+                'itn coverage']
+
+
+def coverage(stock, pop, eta, alpha):
+    """ Fraction of households with at least one net, from the
+    negative-binomial model of nets per capita
+
+    Parameters
+    ----------
+    stock : array, shape (..., T)
+    pop : array, shape (T,)
+    eta, alpha : float or array broadcastable against stock
+    """
+    return 1. - (alpha / (eta*stock/pop + alpha))**alpha
+
+
+def stock_and_flow(mu, delta, Omega, pi, eta, alpha, pop):
+    """ Compute every compartment of the stock-and-flow model in a
+    single pass
+
+    Parameters
+    ----------
+    mu, delta, Omega : array, shape (..., T)
+      llins shipped, llins distributed and non-llin household net
+      stock for each year; any leading axes are treated as a batch
+      of parameter sets
+    pi, eta, alpha : float or array, shape (...)
+      probability a net is lost, coverage parameter and dispersion
+      parameter for each parameter set in the batch
+    pop : array, shape (T,)
+      population for each year
+
+    Results
+    -------
+    returns an array of shape (..., 8, T), with rows indexed by the
+    module constants WAREHOUSE, HOUSEHOLD_1, ..., ITN_COVERAGE (see
+    COMPARTMENTS for the corresponding node names)
+
+    Example
+    -------
+    >>> X = dynamics.stock_and_flow(mu, delta, Omega, pi, eta, alpha, pop)
+    >>> Psi = X[..., dynamics.WAREHOUSE, :]
+    """
+    mu = asarray(mu)
+    delta = asarray(delta)
+    Omega = asarray(Omega)
+    pi = asarray(pi)[..., newaxis]
+    eta = asarray(eta)[..., newaxis]
+    alpha = asarray(alpha)[..., newaxis]
+
+    batch_shape = broadcast(mu[..., 0], delta[..., 0], Omega[..., 0],
+                            pi[..., 0], eta[..., 0], alpha[..., 0]).shape
+    T = delta.shape[-1]
+    # complex parameters give complex compartments (see posterior.py)
+    X = zeros(batch_shape + (len(COMPARTMENTS), T), result_type(mu, delta, Omega, pi, eta, alpha, float))
+
+    # warehouse stock accumulates shipments not yet distributed
+    X[..., WAREHOUSE, 1:] = cumsum(mu[..., :-1] - delta[..., :-1], axis=-1)
+
+    # household llins age one year per time step, with losses after
+    # the first half year
+    X[..., HOUSEHOLD_1, 1:] = delta[..., :-1]
+    X[..., HOUSEHOLD_2, 2:] = X[..., HOUSEHOLD_1, 1:-1] * (1 - pi) ** .5
+    X[..., HOUSEHOLD_3, 3:] = X[..., HOUSEHOLD_2, 2:-1] * (1 - pi)
+    X[..., LLIN_STOCK, :] = X[..., HOUSEHOLD_1:HOUSEHOLD_3+1, :].sum(axis=-2)
+    X[..., ITN_STOCK, :] = X[..., LLIN_STOCK, :] + Omega
+
+    X[..., LLIN_COVERAGE, :] = coverage(X[..., LLIN_STOCK, :], pop, eta, alpha)
+    X[..., ITN_COVERAGE, :] = coverage(X[..., ITN_STOCK, :], pop, eta, alpha)
+
+    return X
+
+
+def project(state, mu, delta, Omega, pi, eta, alpha, pop):
+    """ Continue the stock-and-flow model from the compartments in one
+    year, e.g. the last year of a fit, without recomputing the years
+    before it
+
+    Parameters
+    ----------
+    state : array, shape (..., 4)
+      warehouse stock and 1-, 2- and 3-year-old household llin stock in
+      the first year (rows WAREHOUSE through HOUSEHOLD_3 of
+      stock_and_flow)
+    mu, delta, Omega : array, shape (..., T)
+      llins shipped, llins distributed and non-llin household net
+      stock in the first year and each year after it
+    pi, eta, alpha : float or array, shape (...)
+    pop : array, shape (T,)
+
+    Results
+    -------
+    returns an array of shape (..., 8, T), as for stock_and_flow, with
+    the first column the compartments in the first year; all leading
+    axes of the arguments are broadcast against each other
+
+    Example
+    -------
+    >>> X = dynamics.stock_and_flow(mu, delta, Omega, pi, eta, alpha, pop)
+    >>> Y = dynamics.project(X[..., :HOUSEHOLD_3+1, -1], mu2, delta2, Omega2, pi, eta, alpha, pop2)
+    """
+    state = asarray(state)
+    mu = asarray(mu)
+    delta = asarray(delta)
+    Omega = asarray(Omega)
+    pi = asarray(pi)[..., newaxis]
+    eta = asarray(eta)[..., newaxis]
+    alpha = asarray(alpha)[..., newaxis]
+
+    batch_shape = broadcast(state[..., 0], mu[..., 0], delta[..., 0], Omega[..., 0],
+                            pi[..., 0], eta[..., 0], alpha[..., 0]).shape
+    T = delta.shape[-1]
+    X = zeros(batch_shape + (len(COMPARTMENTS), T), result_type(state, mu, delta, Omega, pi, eta, alpha, float))
+
+    X[..., WAREHOUSE, :] = state[..., WAREHOUSE:WAREHOUSE+1]
+    X[..., WAREHOUSE, 1:] += cumsum(mu[..., :-1] - delta[..., :-1], axis=-1)
+
+    # the same aging as stock_and_flow, starting from the household
+    # stock of each age in the first year
+    X[..., HOUSEHOLD_1, 0] = state[..., HOUSEHOLD_1]
+    X[..., HOUSEHOLD_1, 1:] = delta[..., :-1]
+    X[..., HOUSEHOLD_2, 0] = state[..., HOUSEHOLD_2]
+    X[..., HOUSEHOLD_2, 1:] = X[..., HOUSEHOLD_1, :-1] * (1 - pi) ** .5
+    X[..., HOUSEHOLD_3, 0] = state[..., HOUSEHOLD_3]
+    X[..., HOUSEHOLD_3, 1:] = X[..., HOUSEHOLD_2, :-1] * (1 - pi)
+    X[..., LLIN_STOCK, :] = X[..., HOUSEHOLD_1:HOUSEHOLD_3+1, :].sum(axis=-2)
+    X[..., ITN_STOCK, :] = X[..., LLIN_STOCK, :] + Omega
+
+    X[..., LLIN_COVERAGE, :] = coverage(X[..., LLIN_STOCK, :], pop, eta, alpha)
+    X[..., ITN_COVERAGE, :] = coverage(X[..., ITN_STOCK, :], pop, eta, alpha)
+
+    return X
+
+
+def interpolation_weights(years, year_start):
+    """ Precompute the indices and weights for linearly interpolating
+    yearly compartments at fractional years
+
+    Parameters
+    ----------
+    years : list of floats
+      fractional years to interpolate at, e.g. mean survey dates
+    year_start : int
+      the year corresponding to index 0 of the compartments
+
+    Results
+    -------
+    returns (i0, i1, w), such that (1-w)*X[i0] + w*X[i1] is the
+    interpolated value of X at each year
+    """
+    years = asarray(years, dtype=float)
+    i0 = floor(years).astype(int) - year_start
+    i1 = ceil(years).astype(int) - year_start
+    w = years - floor(years)
+    return i0, i1, w
@@ -1,5 +1,15 @@
 """ Module to generate empirical priors for the stock-and-flow model
 for bednet distribution
+
+Each prior is saved in a json file in settings.PATH, next to a record
+of what it was computed from (<fname>.inputs: hashes of its input
+csvs, of the json files of the priors it depends on, and of the
+settings of its fit), and is computed again whenever any of these
+change.  From the command line, every prior that is missing or stale
+is computed, each in its own process, with the priors that do not
+depend on each other computed at the same time::
+
+    $ python emp_priors.py -j 4 --recompute
 """
 import settings
 
@@ -9,11 +19,108 @@ from pymc import *
 import simplejson as json
 import os
 import time
+import hashlib
+
+from data import get_data
+import sampling
+
+# bump this when the prior models change, to invalidate the saved priors
+PRIOR_VERSION = 1
+
+
+def file_digest(fname):
+    """ Hash of the contents of a file: an input csv, in the directory
+    the data are loaded from (see data.get_data), or the json file of
+    another prior, in settings.PATH"""
+    if fname.endswith('.json'):
+        path = settings.PATH
+    else:
+        path = get_data().path
+    f = open(path + fname, 'rb')
+    digest = hashlib.md5(f.read()).hexdigest()
+    f.close()
+    return digest
+
+
+def prior_inputs(files, **params):
+    """ Record of what a prior is computed from
 
-from data import Data
-data = Data()
+    Parameters
+    ----------
+    files : list of str
+      input csvs and json files of other priors (see file_digest)
+    params : optional
+      anything else that changes the fit, e.g. the number of MCMC
+      iterations
+
+    Results
+    -------
+    returns a dict mapping each file name, and 'fit' for the params,
+    to its hash
+    """
+    inputs = dict([[fname, file_digest(fname)] for fname in files])
+    params['version'] = PRIOR_VERSION
+    inputs['fit'] = hashlib.md5(repr(sorted(params.items()))).hexdigest()
+    return inputs
+
+
+def mcmc_params(iter, burn, thin):
+    """ The settings of a prior fit by MCMC (see sampling.sample), for
+    prior_inputs"""
+    return dict(iter=iter, burn=burn, thin=thin,
+                adaptive=settings.ADAPTIVE_SAMPLING, target_ess=settings.TARGET_ESS)
+
+
+def saved_inputs(fname):
+    """ The inputs recorded when the prior in fname was saved, or None"""
+    try:
+        f = open(settings.PATH + fname + '.inputs')
+    except IOError:
+        return None
+    inputs = json.load(f)
+    f.close()
+    return inputs
+
+
+def load_prior(fname, inputs, recompute=False):
+    """ Return the prior saved in fname, if it was computed from the
+    same inputs, and None if it must be computed again"""
+    if recompute or fname not in os.listdir(settings.PATH):
+        return None
+
+    saved = saved_inputs(fname)
+    if saved is None:
+        print 'recomputing %s, since its inputs were not recorded' % fname
+        return None
+    changed = sorted([k for k in set(inputs) | set(saved) if inputs.get(k) != saved.get(k)])
+    if changed:
+        print 'recomputing %s, since %s changed' % (fname, ', '.join(changed))
+        return None
+
+    f = open(settings.PATH + fname)
+    prior = json.load(f)
+    f.close()
+    return prior
+
+
+def save_prior(fname, prior, inputs):
+    """ Save a prior in fname, with the record of its inputs
+
+    Notes
+    -----
+    the json file is written to a temporary file which is then renamed,
+    so country fits never see a partially written prior, and the
+    inputs are saved last, so a prior is only considered current once
+    it is complete
+    """
+    f = open(settings.PATH + fname + '.tmp', 'w')
+    json.dump(prior, f)
+    f.close()
+    os.rename(settings.PATH + fname + '.tmp', settings.PATH + fname)
 
-import graphics
+    f = open(settings.PATH + fname + '.inputs', 'w')
+    json.dump(inputs, f)
+    f.close()
 
 
 def llin_discard_rate(recompute=False):
@@ -23,43 +130,46 @@ def llin_discard_rate(recompute=False):
     Parameters
     ----------
     recompute : bool, optional
-      pass recompute=True to force recomputation of empirical priors, even if json file exists
+      pass recompute=True to force recomputation of empirical priors,
+      even if json file exists and is current
 
     Results
     -------
     returns a dict suitable for using to instantiate a Beta stoch
     """
+    iter = 10000
+    thin = 20
+    burn = 20000
+
     # load and return, if applicable
     fname = 'discard_prior.json'
-    if fname in os.listdir(settings.PATH) and not recompute:
-        f = open(settings.PATH + fname)
-        return json.load(f)
+    inputs = prior_inputs(['reten.csv'], **mcmc_params(iter, burn, thin))
+    prior = load_prior(fname, inputs, recompute)
+    if prior:
+        return prior
         
+    data = get_data()
+
     ### setup (hyper)-prior stochs
     pi = Beta('Pr[net is lost]', 1, 2)
     sigma = InverseGamma('standard error', 11, 1)
 
     vars = [pi, sigma]
 
-    ### data likelihood from net retention studies
-    retention_obs = []
-    for d in data.retention:
-        @observed
-        @stochastic(name='retention_%s_%s' % (d['name'], d['year']))
-        def obs(value=d['retention_rate'],
-                T_i=d['follow_up_time'],
-                pi=pi, sigma=sigma):
-            return normal_like(value, (1. - pi) ** T_i, 1. / sigma**2)
-        retention_obs.append(obs)
+    ### data likelihood from net retention studies, all in one stoch
+    @observed
+    @stochastic(name='retention')
+    def retention_obs(value=data.retention['retention_rate'],
+                      T=data.retention['follow_up_time'],
+                      pi=pi, sigma=sigma):
+        return normal_like(value, (1. - pi) ** T, 1. / sigma**2)
 
-        vars += [retention_obs]
+    vars += [retention_obs]
 
-    # find model with MCMC
+    # find model with MCMC (the prior fits are short, and are not
+    # checkpointed: a new fit never resumes from a timestamped database)
     mc = MCMC(vars, verbose=1, db='pickle', dbname=settings.PATH + 'discard_prior_%s.pickle' % time.strftime('%Y_%m_%d_%H_%M'))
-    iter = 10000
-    thin = 20
-    burn = 20000
-    mc.sample(iter*thin+burn, burn, thin)
+    sampling.sample(mc, [pi.__name__], iter, burn, thin, checkpoint=False)
     mc.db.commit()
 
     # save fit values for empirical prior
@@ -68,10 +178,11 @@ def llin_discard_rate(recompute=False):
 
     emp_prior_dict = dict(mu=x, var=v, tau=1/v,
                           alpha=x*(x*(1-x)/v-1), beta=(1-x)*(x*(1-x)/v-1))
-    f = open(settings.PATH + fname, 'w')
-    json.dump(emp_prior_dict, f)
+    save_prior(fname, emp_prior_dict, inputs)
 
-    graphics.plot_discard_prior(pi, emp_prior_dict)
+    if settings.PLOTTING:
+        import graphics
+        graphics.plot_discard_prior(pi, emp_prior_dict)
     
     return emp_prior_dict
 
@@ -107,7 +218,7 @@ def admin_err_and_bias(recompute=False, flow_data=None):
     ----------
     recompute : bool, optional
       pass recompute=True to force recomputation of empirical priors,
-      even if json file exists
+      even if json file exists and is current
 
     flow_data : list of dicts, optional
       this defaults to the household survey llin flow data, but for
@@ -122,14 +233,40 @@ def admin_err_and_bias(recompute=False, flow_data=None):
     -------
     returns a dict suitable for using to instantiate a Beta stoch
     """
-    # load and return, if applicable
-    fname = 'admin_err_and_bias_prior.json'
-    if fname in os.listdir(settings.PATH) and not recompute:
-        f = open(settings.PATH + fname)
-        return json.load(f)
+    iter = 10000
+    thin = 20
+    burn = 20000
 
     mu_pi = llin_discard_rate()['mu']
 
+    # load and return, if applicable
+    fname = 'admin_err_and_bias_prior.json'
+    files = ['adminllins_itns.csv', 'pop.csv', 'discard_prior.json']
+    fit_params = mcmc_params(iter, burn, thin)
+    fit_params['years'] = [settings.year_start, settings.year_end]
+
+    # a prior refined with flow data from the posterior (see
+    # improve_admin_err_and_bias_from_posterior) stays current until
+    # one of its other inputs changes
+    saved = saved_inputs(fname)
+    refined = flow_data == None and saved and 'flow data' in saved and not recompute
+    if flow_data != None:
+        inputs = prior_inputs(files, **fit_params)
+        inputs['flow data'] = hashlib.md5(repr([sorted(d.items()) for d in flow_data])).hexdigest()
+    elif refined:
+        inputs = prior_inputs(files, **fit_params)
+        inputs['flow data'] = saved['flow data']
+    else:
+        inputs = prior_inputs(files + ['flow_llins.csv'], **fit_params)
+    prior = load_prior(fname, inputs, recompute)
+    if prior:
+        return prior
+    if refined:
+        # it is recomputed from the household survey flow data
+        inputs = prior_inputs(files + ['flow_llins.csv'], **fit_params)
+
+    data = get_data()
+
     # setup hyper-prior stochs
     sigma = Gamma('error in admin dist data', 1., 1.)
     eps = Normal('bias in admin dist data', 0., 1.)
@@ -166,30 +303,28 @@ def admin_err_and_bias(recompute=False, flow_data=None):
 
     print 'fitting %d data points' % len(data_dict)
 
-    # create the observed stochs
-    data_vars = []
-    for k, d in data_dict.items():
-        @deterministic(name='pred_%s'%str(k))
-        def pred(mu=d['true_t'], mu_next=d['true_{t+1}'], eps=eps, beta=beta):
-            return log(max(1., mu + beta*mu_next)) + eps
-
-        @observed
-        @stochastic(name='obs_%s'%str(k))
-        def obs(value=log(max(1., d['obs_t'])),
-                pred=pred,
-                log_v=1.1*d['se_t']**2/d['true_t']**2 + 1.1*d['se_{t+1}']**2/d['true_{t+1}']**2,
-                sigma=sigma):
-            return normal_like(value, pred,
-                               1. / (log_v + sigma**2))
-        data_vars.append([obs, pred])
-    vars.append(data_vars)
+    # create the observed stoch, with one entry for each country-year
+    keys = sorted(data_dict.keys())
+    column = lambda col: array([data_dict[k][col] for k in keys], dtype=float)
+    true_t, true_next = column('true_t'), column('true_{t+1}')
+
+    @deterministic(name='pred')
+    def pred(mu=true_t, mu_next=true_next, eps=eps, beta=beta):
+        return log(maximum(1., mu + beta*mu_next)) + eps
+
+    @observed
+    @stochastic(name='obs')
+    def obs(value=log(maximum(1., column('obs_t'))),
+            pred=pred,
+            log_v=1.1*column('se_t')**2/true_t**2 + 1.1*column('se_{t+1}')**2/true_next**2,
+            sigma=sigma):
+        return normal_like(value, pred,
+                           1. / (log_v + sigma**2))
+    vars += [pred, obs]
 
     # sample from empirical prior distribution via MCMC
     mc = MCMC(vars, verbose=1, db='pickle', dbname=settings.PATH + 'admin_err_prior_%s.pickle' % time.strftime('%Y_%m_%d_%H_%M'))
-    iter = 10000
-    thin = 20
-    burn = 20000
-    mc.sample(iter*thin+burn, burn, thin)
+    sampling.sample(mc, [sigma.__name__, eps.__name__, beta.__name__], iter, burn, thin, checkpoint=False)
     mc.db.commit()
 
     # output information on empirical prior distribution
@@ -204,10 +339,11 @@ def admin_err_and_bias(recompute=False, flow_data=None):
                   std=beta.stats()['standard deviation'],
                   tau=beta.stats()['standard deviation']**-2))
 
-    f = open(settings.PATH + fname, 'w')
-    json.dump(emp_prior_dict, f)
+    save_prior(fname, emp_prior_dict, inputs)
 
-    graphics.plot_admin_priors(eps, sigma, emp_prior_dict, data_dict, data_vars, mc)
+    if settings.PLOTTING:
+        import graphics
+        graphics.plot_admin_priors(eps, sigma, emp_prior_dict, data_dict, obs, pred, mc)
 
     return emp_prior_dict
 
@@ -220,17 +356,24 @@ def neg_binom(recompute=False):
     ----------
     recompute : bool, optional
       pass recompute=True to force recomputation of empirical priors,
-      even if json file exists
+      even if json file exists and is current
 
     Results
     -------
     returns a dict suitable for using to instantiate normal and beta stochs
     """
+    iter = 1000
+    thin = 20
+    burn = 2000
+
     # load and return, if applicable
     fname = 'neg_binom_prior.json'
-    if fname in os.listdir(settings.PATH) and not recompute:
-        f = open(settings.PATH + fname)
-        return json.load(f)
+    inputs = prior_inputs(['pop.csv', 'stock_llins.csv', 'llincc.csv'], **mcmc_params(iter, burn, thin))
+    prior = load_prior(fname, inputs, recompute)
+    if prior:
+        return prior
+
+    data = get_data()
 
     # setup hyper-prior stochs
     e = Normal('coverage parameter', 5., 3.)
@@ -263,25 +406,27 @@ def neg_binom(recompute=False):
         if len(data_dict[key]) != 5:
             data_dict.pop(key)
 
-    # create stochs from stock and coverage data
-    for k, d in data_dict.items():
-        stock = Normal('stock_%s_%s' % k, mu=d['stock'], tau=d['stock_se']**-2)
-        
-        @observed
-        @stochastic
-        def obs(value=d['uncovered'], stock=stock, tau=d['se']**-2,
-                e=e, a=a):
-            return normal_like(value,
-                               exp(negative_binomial_like(0, e * stock, a)),
-                               tau)
-        vars += [stock, obs]
+    # create stochs from stock and coverage data, with one entry for
+    # each country-year
+    keys = sorted(data_dict.keys())
+    column = lambda col: array([data_dict[k][col] for k in keys], dtype=float)
+    stock = Normal('stock', mu=column('stock'), tau=column('stock_se')**-2)
+
+    @observed
+    @stochastic(name='uncovered')
+    def obs(value=column('uncovered'), stock=stock, tau=column('se')**-2,
+            e=e, a=a):
+        # Pr[no nets] under the negative binomial, elementwise, which
+        # is zero where the mean is not positive (as in pymc)
+        mu = e * stock
+        pos = mu > 0
+        p_0 = where(pos, (a / (a + where(pos, mu, 1.))) ** a, 0.)
+        return normal_like(value, p_0, tau)
+    vars += [stock, obs]
 
     # sample from empirical prior distribution via MCMC
     mc = MCMC(vars, verbose=1, db='pickle', dbname=settings.PATH + 'neg_binom_prior_%s.pickle' % time.strftime('%Y_%m_%d_%H_%M'))
-    iter = 1000
-    thin = 20
-    burn = 2000
-    mc.sample(iter*thin+burn, burn, thin)
+    sampling.sample(mc, [e.__name__, a.__name__], iter, burn, thin, checkpoint=False)
     mc.db.commit()
 
 
@@ -296,10 +441,11 @@ def neg_binom(recompute=False):
                    beta=a.stats()['mean']/a.stats()['standard deviation']**2)
         )
 
-    f = open(settings.PATH + fname, 'w')
-    json.dump(emp_prior_dict, f)
+    save_prior(fname, emp_prior_dict, inputs)
 
-    graphics.plot_neg_binom_priors(e, a, emp_prior_dict, data_dict)
+    if settings.PLOTTING:
+        import graphics
+        graphics.plot_neg_binom_priors(e, a, emp_prior_dict, data_dict)
 
     return emp_prior_dict
 
@@ -313,35 +459,110 @@ def survey_design(recompute=False):
     """
     # load and return, if applicable
     fname = 'survey_design_effect_prior.json'
-    if fname in os.listdir(settings.PATH) and not recompute:
-        f = open(settings.PATH + fname)
-        return json.load(f)
+    inputs = prior_inputs(['design.csv'])
+    prior = load_prior(fname, inputs, recompute)
+    if prior:
+        return prior
 
+    data = get_data()
     obs = [d['itncomplex_to_simpleratio'] for d in data.design] + \
         [d['llincomplex_to_simpleratio'] for d in data.design if d['llincomplex_to_simpleratio']]
     emp_prior_dict = dict(mu=mean(obs), std=std(obs), tau=1/var(obs))
 
-    f = open(settings.PATH + fname, 'w')
-    json.dump(emp_prior_dict, f)
+    save_prior(fname, emp_prior_dict, inputs)
 
-    graphics.plot_survey_design_prior(emp_prior_dict, obs)
+    if settings.PLOTTING:
+        import graphics
+        graphics.plot_survey_design_prior(emp_prior_dict, obs)
 
     return emp_prior_dict
 
 
+# each empirical prior, with the priors it is computed from
+PRIORS = dict(llin_discard_rate=[llin_discard_rate, []],
+              admin_err_and_bias=[admin_err_and_bias, ['llin_discard_rate']],
+              neg_binom=[neg_binom, []],
+              survey_design=[survey_design, []])
+
+
+def fit_all(recompute=False, processes=None, no_plots=False):
+    """ Compute all the empirical priors that are missing or stale, each
+    in its own process, as many at a time as their dependencies allow
+
+    Parameters
+    ----------
+    recompute : bool, optional
+      recompute every prior, even if its json file exists and is current
+    processes : int, optional
+      maximum number of priors to fit at once, defaults to the number
+      of cores
+    no_plots : bool, optional
+      skip all graphics
+
+    Results
+    -------
+    returns a dict mapping job name to status, as jobs.LocalExecutor.wait
+
+    Example
+    -------
+    >>> emp_priors.fit_all(recompute=True, processes=4)
+    """
+    import jobs
+    executor = jobs.LocalExecutor(processes)
+
+    opts = []
+    if recompute:
+        opts += ['--recompute']
+    if no_plots or not settings.PLOTTING:
+        opts += ['--no-plots']
+
+    for name, (fit, depends_on) in sorted(PRIORS.items()):
+        executor.submit('prior-%s' % name, ['emp_priors.py'] + opts + ['--only', name],
+                        settings.PATH + 'prior-%s-stdout.txt' % name,
+                        settings.PATH + 'prior-%s-stderr.txt' % name,
+                        depends_on=['prior-%s' % d for d in depends_on])
+
+    # the negative binomial fits to the net count data only need the
+    # data, and are plotted along with the priors
+    if not no_plots and settings.PLOTTING and (recompute or not os.path.exists(settings.PATH + 'neg_binom_fits.png')):
+        executor.submit('prior-neg_binom_fits', ['emp_priors.py', '--only', 'neg_binom_fits'],
+                        settings.PATH + 'prior-neg_binom_fits-stdout.txt',
+                        settings.PATH + 'prior-neg_binom_fits-stderr.txt')
+
+    return executor.wait()
+
+
 if __name__ == '__main__':
     import optparse
     
     usage = 'usage: %prog [options]'
     parser = optparse.OptionParser(usage)
+    parser.add_option('--no-plots', action='store_true', dest='no_plots', default=False,
+                      help='skip all graphics, so matplotlib is never imported')
+    parser.add_option('--recompute', action='store_true', dest='recompute', default=False,
+                      help='recompute the priors, even if their json files exist and are current')
+    parser.add_option('-j', '--processes', type='int', dest='processes', default=None,
+                      help='maximum number of priors to fit at once (default: number of cores)')
+    parser.add_option('--only', dest='only', default=None,
+                      help='compute a single prior in this process (one of %s, or neg_binom_fits for its plot)'
+                      % ', '.join(sorted(PRIORS)))
     (options, args) = parser.parse_args()
 
     if len(args) != 0:
         parser.error('incorrect number of arguments')
 
-    admin_err_and_bias()
-    llin_discard_rate()
-    neg_binom()
-    survey_design()
-    
-    graphics.plot_neg_binom_fits()
+    if options.no_plots:
+        settings.PLOTTING = False
+
+    if options.only == 'neg_binom_fits':
+        import graphics
+        graphics.plot_neg_binom_fits()
+    elif options.only:
+        if options.only not in PRIORS:
+            parser.error('unknown prior %s' % options.only)
+        fit, depends_on = PRIORS[options.only]
+        fit(recompute=options.recompute)
+    else:
+        status = fit_all(options.recompute, options.processes, options.no_plots)
+        if [s for s in status.values() if s != 'done']:
+            raise SystemExit(1)
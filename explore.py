@@ -1,45 +1,207 @@
 """ Script for exploratory analysis of the bednet model estimates"""
 
+import settings
+
+import os
 import re
-import pylab as pl
 import pymc
+import trace_store
+
+# file names of country fits, bednet_model_<country>_<country_id>_<time>
+RUN_NAME = re.compile('^bednet_model_(.+?)_([0-9]+)_[0-9]{4}(_[0-9]{2}){4}\.(pickle|traces)$')
+
+def load_pylab():
+    """ Import pylab on demand, so that summarizing fits without
+    settings.PLOTTING never loads matplotlib"""
+    import pylab
+    return pylab
+
+class TraceCache:
+    """ Traces read from fitted model databases, keyed by (file name,
+    node name), keeping the most recently used ones that fit in
+    max_bytes
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.arrays = {}
+        self.order = []  # keys, least recently used first
+        self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def get(self, key):
+        x = self.arrays.get(key)
+        if x is not None:
+            self.order.remove(key)
+            self.order.append(key)
+        return x
+
+    def put(self, key, x):
+        if key in self.arrays:
+            self.order.remove(key)
+            self.nbytes -= self.arrays.pop(key).nbytes
+        self.arrays[key] = x
+        self.order.append(key)
+        self.nbytes += x.nbytes
+
+        # the newest trace is kept even if it is bigger than the limit
+        while self.nbytes > self.max_bytes and len(self.order) > 1:
+            self.nbytes -= self.arrays.pop(self.order.pop(0)).nbytes
+
+# the TraceCache shared by all runs, created on first use
+_cache = None
+
+def get_cache():
+    """ Return the shared TraceCache, which holds at most
+    settings.EXPLORE_CACHE_SIZE megabytes of traces"""
+    global _cache
+    if _cache is None:
+        _cache = TraceCache(settings.EXPLORE_CACHE_SIZE * 2**20)
+    return _cache
+
+def read_traces(fname, names):
+    """ Read the traces of some nodes from a fitted model database
+
+    Results
+    -------
+    returns a dict mapping each name to an array of its samples from
+    all chains
+
+    Notes
+    -----
+    a directory of chunked traces only reads the requested nodes, but
+    a pickle database must be read in full
+    """
+    from numpy import array
+    if os.path.isdir(fname):
+        db = trace_store.load(fname)
+    else:
+        db = pymc.database.pickle.load(fname)
+    return dict([[name, array(db.trace(name, chain=None)[:])] for name in names])
+
+def read_traces_args(args):
+    return read_traces(*args)
+
+class Run:
+    """ Handle for the fitted model database of one country fit, which
+    reads the traces of its nodes when they are first needed
+
+    Example
+    -------
+    >>> run = explore.Run('bednet_model_Benin_1_2010_10_01_12_00.traces')
+    >>> run.country, run.country_id
+    >>> run.draws('itn coverage')   # shape (samples, years)
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.name = os.path.basename(fname)
+        match = RUN_NAME.match(self.name)
+        if match:
+            self.country, self.country_id = match.group(1), int(match.group(2))
+        else:
+            self.country, self.country_id = self.name.split('_')[2], None
+
+    def draws(self, name):
+        """ Posterior draws of the node called name, from all chains"""
+        cache = get_cache()
+        x = cache.get((self.fname, name))
+        if x is None:
+            x = read_traces(self.fname, [name])[name]
+            cache.put((self.fname, name), x)
+        return x
 
-def load_pickles(path='./'):
-    """ Load all of the files with name bednet_model.*pickle in the
+def prefetch(runs, names, processes=None):
+    """ Read the traces of some nodes for many runs into the cache, in
+    a pool of worker processes
+
+    Parameters
+    ----------
+    runs : list of Runs
+    names : list of str
+    processes : int, optional
+      defaults to the number of cores
+
+    Notes
+    -----
+    once more is read than fits in the cache, the traces read first
+    are dropped again, so prefetch only as much as is needed at once
+    """
+    import jobs
+    cache = get_cache()
+    args = [[r.fname, [n for n in names if (r.fname, n) not in cache]] for r in runs]
+    args = [[fname, todo] for fname, todo in args if todo]
+    if processes is None:
+        processes = jobs.cpu_count()
+
+    try:
+        import multiprocessing
+    except ImportError:
+        processes = 1
+
+    pool = None
+    if processes <= 1 or len(args) <= 1:
+        results = map(read_traces_args, args)
+    else:
+        pool = multiprocessing.Pool(min(processes, len(args)))
+        results = pool.imap(read_traces_args, args)
+
+    try:
+        for (fname, todo), traces in zip(args, results):
+            for name, x in traces.items():
+                cache.put((fname, name), x)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+def load_pickles(path='./', countries=None, nodes=None, processes=None):
+    """ Find all of the files with name bednet_model.*pickle (and
+    directories of chunked traces named bednet_model.*traces) in the
     specified directory
 
+    Parameters
+    ----------
+    path : str, optional
+    countries : list of str, optional
+      only find the fits of these countries
+    nodes : list of str, optional
+      read the traces of these nodes now, in parallel (see prefetch);
+      otherwise each trace is read when it is first used
+
+    Results
+    -------
+    returns a dict mapping each file name to a Run
+
     Example
     -------
     >>> db = explore.load_pickles('/home/j/Project/Models/bednets/2010_07_09/')
+    >>> db = explore.load_pickles('./', countries=['Benin', 'Chad'], nodes=['itn coverage'])
     """
-    
-    import os, sys
-    file_list = os.listdir(path)
-
     db = {}
-    for f in file_list:
-        match = re.match('^bednet_model.*pickle$', f)
-        if match:
-            print 'loading', f, '...',
-            sys.stdout.flush()
-            k=match.group()
-            db[k] = pymc.database.pickle.load(path + f)
-            print 'finished.'
+    for f in os.listdir(path):
+        if re.match('^bednet_model.*(pickle|traces)$', f):
+            run = Run(path + f)
+            if countries is None or run.country in countries:
+                db[f] = run
+
+    if nodes:
+        prefetch(db.values(), nodes, processes)
 
     return db
 
 def plot_net_survival(db, country_list):
-    import pylab as pl
+    pl = load_pylab()
     import settings
     pl.clf()
     ii = 0.
     for k, p in sorted(db.items()):
-        country = k.split('_')[2] # TODO: refactor k.split into function
+        country = p.country
         if country not in country_list:
             continue
-        pr = pl.sort(p.__getattribute__('Pr[net is lost]').gettrace())
-        pr0 = pr[.025*len(pr)]
-        pr1 = pr[.975*len(pr)]
+        pr = pl.sort(p.draws('Pr[net is lost]'))
+        pr0 = pr[int(.025*len(pr))]
+        pr1 = pr[int(.975*len(pr))]
 
         t = pl.arange(0,5,.1)
         pct0 = 100. * pl.where(t<3, (1-pr0)**t, 0.)
@@ -63,39 +225,109 @@ def plot_net_survival(db, country_list):
     pl.title('LLIN Survival Curve Posteriors')
     pl.savefig(settings.PATH + 'net_survival.png')
 
+# quantiles reported by summary_stats, as fractions of the sorted draws
+QUANTILES = dict(median=.5, lower=.025, upper=.975)
+
+def summary_stats(db, table_start=2007, table_end=2010, parameter='itn coverage', midyear=True):
+    """ Posterior median and 95% interval of a node for every run and
+    year
+
+    Parameters
+    ----------
+    db : dict of Runs
+      from load_pickles
+    table_start, table_end : int
+      first and last year of the table
+    parameter : str
+      name of the node
+    midyear : bool, optional
+      summarize the average of the values on Jan 1 of each year and
+      the next, instead of the value on Jan 1
+
+    Results
+    -------
+    returns a numpy structured array with a row for each run (in
+    sorted order) and year, and fields 'run', 'country', 'country_id',
+    'year', 'median', 'lower' and 'upper'
+
+    Example
+    -------
+    >>> stats = explore.summary_stats(db, parameter='llins distributed', midyear=False)
+    >>> stats[stats['country'] == 'Benin']['median']
+
+    Notes
+    -----
+    the draws of the table's years for all runs with the same number
+    of draws are stacked into one array, and every quantile is found
+    from a single partition of it (the same draws a full sort would
+    give); the stack only holds the years in the table, so it is much
+    smaller than the traces
+    """
+    from numpy import arange, array, zeros, nan, newaxis
+
+    years = arange(table_start, table_end+1)
+    i = years - settings.year_start
+    runs = [p for k, p in sorted(db.items())]
+    prefetch(runs, [parameter])
+
+    # the draws for the table's years, grouped by the number of draws
+    groups = {}
+    for j, p in enumerate(runs):
+        x = p.draws(parameter)
+        if midyear:
+            x = .5 * (x[:, i] + x[:, i+1])
+        else:
+            x = x[:, i]
+        groups.setdefault(len(x), []).append([j, x])
+
+    stats = zeros((len(runs), len(years)), dtype=[('run', 'S128'), ('country', 'S64'), ('country_id', int),
+                                                  ('year', int), ('median', float),
+                                                  ('lower', float), ('upper', float)])
+    stats['run'] = array([p.name for p in runs])[:, newaxis]
+    stats['country'] = array([p.country for p in runs])[:, newaxis]
+    stats['country_id'] = array([-1 if p.country_id is None else p.country_id for p in runs])[:, newaxis]
+    stats['year'] = years
+    for n, group in groups.items():
+        index = [j for j, x in group]
+        if n == 0:
+            for q in QUANTILES:
+                stats[q][index] = nan
+            continue
+        # (runs, years, draws), so the draws of each cell are
+        # contiguous, and only partitioned around the quantiles
+        rank = dict([[q, min(int(frac*n), n-1)] for q, frac in QUANTILES.items()])
+        X = array([x.T for j, x in group])
+        X.partition(sorted(set(rank.values())), axis=-1)
+        for q in QUANTILES:
+            stats[q][index] = X[..., rank[q]]
+
+    return stats.ravel()
+
 def summary_table(db, table_start=2007, table_end=2010, parameter='itn coverage', midyear=True):
     """ Output a table of midyear coverage estimates by country
 
     Example
     -------
     >>> db = explore.load_pickles('/home/j/Project/Models/bednets/2010_07_09/')
-    >>> tab = explore.midyear_coverage_table(db)
+    >>> tab = explore.summary_table(db)
     >>> f = open('/home/j/Project/Models/bednets/2010_08_05/best_case.csv', 'w')
     >>> import csv
     >>> cf = csv.writer(f)
     >>> cf.writerows(tab)
     >>> f.close()
     """
-    import settings
-    from pylab import mean, std, sort
-    
     headers = [ 'Country' ]
     for y in range(table_start, table_end+1):
         headers += [y, 'ui']
 
     tab = [ headers ]
 
-    for k, p in sorted(db.items()):
-        row = [k.split('_')[2]] # TODO: refactor k.split into function 
-        cov = p.__getattribute__(parameter).gettrace()
-        for y in range(table_start, table_end+1):
-            i = y-settings.year_start
-            if midyear:
-                c_y = sort(.5 * (cov[:, i] + cov[:, i+1]))  # compute mid-year estimate from posterior draws
-            else:
-                c_y = sort(cov[:, i])  # compute jan 1 / whole-year estimate posterior draws
-            n = len(c_y)
-            row += ['%f' % c_y[.5*n], '(%f, %f)' % (c_y[.025*n], c_y[.975*n])]
+    stats = summary_stats(db, table_start, table_end, parameter, midyear)
+    years = table_end + 1 - table_start
+    for j in range(0, len(stats), years):
+        row = [stats['country'][j]]
+        for d in stats[j:j+years]:
+            row += ['%f' % d['median'], '(%f, %f)' % (d['lower'], d['upper'])]
         tab.append(row)
         
     return tab
@@ -114,65 +346,20 @@ def detailed_summary_table(db):
     >>> f.close()
     """
     import settings
-    from pylab import mean, std, sort
-    
-    # save results in output file
-    headers = [
-        'Country', 'Year', 'Population',
-        'LLINs Shipped (Thousands)', 'LLINs Shipped Lower CI', 'LLINs Shipped Upper CI',
-        'LLINs Distributed (Thousands)', 'LLINs Distributed Lower CI', 'LLINs Distributed Upper CI',
-        'LLINs Not Owned Warehouse (Thousands)', 'LLINs Not Owned Lower CI', 'LLINs Not Owned Upper CI',
-        'LLINs Owned (Thousands)', 'LLINs Owned Lower CI', 'LLINs Owned Upper CI',
-        'non-LLIN ITNs Owned (Thousands)', 'non-LLIN ITNs Owned Lower CI', 'non-LLIN ITNs Owned Upper CI',
-        'ITNs Owned (Thousands)', 'ITNs Owned Lower CI', 'ITNs Owned Upper CI',
-        'LLIN Coverage (Percent)', 'LLIN Coverage Lower CI', 'LLIN Coverage Upper CI',
-        'ITN Coverage (Percent)', 'ITN Coverage Lower CI', 'ITN Coverage Upper CI',
-        ]
-
-    tab = [ headers ]
+    import summary
+    from data import get_data
+    data = get_data()
 
-    year_start = settings.year_start
-    year_end = settings.year_end
-    from data import Data
-    data = Data()
-
-    from pymc.utils import hpd
-    def my_summary(stoch, i, li, ui, factor=.001):
-        row = []
-        row += [mean(trace[stoch][:, i])*factor]
-        row += list(hpd(trace[stoch][[li,ui], i], .05)*factor)
-        return row
-    
+    tab = [ summary.HEADINGS ]
     for k, p in sorted(db.items()):
-        trace = {}
-        for stoch in ['llins shipped', 'llins distributed', 'llin warehouse net stock', 'household llin stock', 'non-llin household net stock', 'household itn stock', 'llin coverage', 'itn coverage']:
-            
-            trace[stoch] = sort(p.__getattribute__(stoch).gettrace(), axis=0)
-        c = k.split('_')[2] # TODO: refactor k.split into function
-        pop = data.population_for(c, year_start, year_end)
-        
-        for i in range(year_end - year_start):
-            row = [c, year_start + i, pop[i]]
-
-            li = .025 * len(trace['llins shipped'][:,0])
-            ui = .975 * len(trace['llins shipped'][:,0])
-
-            if i == year_end - year_start - 1:
-                row += [-99, -99, -99]
-                row += [-99, -99, -99]
-            else:
-                row += my_summary('llins shipped', i, li, ui)
-                row += my_summary('llins distributed', i, li, ui)
-
-
-            row += my_summary('llin warehouse net stock', i, li, ui)
-            row += my_summary('household llin stock', i, li, ui)
-            row += my_summary('non-llin household net stock', i, li, ui)
-            row += my_summary('household itn stock', i, li, ui)
-            row += my_summary('llin coverage', i, li, ui, 100)
-            row += my_summary('itn coverage', i, li, ui, 100)
-
-            tab.append(row)
+        # all the nodes of a run are read at once
+        prefetch([p], [stoch for stoch, scale in summary.REPORTED])
+        stats = {}
+        for stoch, scale in summary.REPORTED:
+            stats[stoch] = summary.trace_stats(p.draws(stoch))
+        c = p.country
+        pop = data.population_for(c, settings.year_start, settings.year_end)
+        tab += summary.output_table(c, pop, stats, settings.year_start)
         
     return tab
 
@@ -208,10 +395,16 @@ def summarize_fits(path=''):
         cf.writerows(rows)
         f.close()
 
+    # regenerate output.csv from the results of every fit
+    import results
+    results.export_csv(path=path)
+
     # TODO: notify that model is complete
     # e.g. http://www.al1us.net/?p=79 to notify via skype msg
 
 def scatter_stats(db, s1, s2, f1=None, f2=None, **kwargs):
+    pl = load_pylab()
+
     if f1 == None:
         f1 = lambda x: x # constant function
 
@@ -225,8 +418,8 @@ def scatter_stats(db, s1, s2, f1=None, f2=None, **kwargs):
     yerr = []
     
     for k in db:
-        x_k = [f1(x_ki) for x_ki in db[k].__getattribute__(s1).gettrace()]
-        y_k = [f2(y_ki) for y_ki in db[k].__getattribute__(s2).gettrace()]
+        x_k = [f1(x_ki) for x_ki in db[k].draws(s1)]
+        y_k = [f2(y_ki) for y_ki in db[k].draws(s2)]
         
         x.append(pl.mean(x_k))
         xerr.append(pl.std(x_k))
@@ -243,19 +436,18 @@ def scatter_stats(db, s1, s2, f1=None, f2=None, **kwargs):
     pl.ylabel(s2)
     
 def compare_models(db, stoch='itn coverage', stat_func=None, plot_type='', **kwargs):
+    pl = load_pylab()
+
     if stat_func == None:
         stat_func = lambda x: x
 
     X = {}
     for k in sorted(db.keys()):
-        c = k.split('_')[2]
-        X[c] = []
+        X[db[k].country] = []
 
     for k in sorted(db.keys()):
-        c = k.split('_')[2]
-        X[c].append(
-            [stat_func(x_ki) for x_ki in
-             db[k].__getattribute__(stoch).gettrace()]
+        X[db[k].country].append(
+            [stat_func(x_ki) for x_ki in db[k].draws(stoch)]
             )
 
     x = pl.array([pl.mean(xc[0]) for xc in X.values()])
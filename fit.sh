@@ -16,6 +16,7 @@
 
 # to run this script for all countries, do the following
 ## for i in {0..50}; do qsub fit.sh $i; done
+# (add --no-plots to skip graphics and keep matplotlib out of memory)
 
 ## Put the hostname, current directory, and start date
 ## into variables, then write them to standard output.
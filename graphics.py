@@ -9,8 +9,9 @@ from pymc import *
 import time
 import copy
 
-from data import Data
-data = Data()
+import summary
+
+from data import get_data
 
 def my_savefig(fname):
     try:
@@ -58,9 +59,8 @@ def plot_discard_prior(pi, discard_prior):
     l, r, b, t = axis()
     
     # plot data
-    data_vals = []
-    for d in data.retention:
-        data_vals.append(1. - d['retention_rate'] ** (1 / d['follow_up_time']))
+    data = get_data()
+    data_vals = 1. - data.retention['retention_rate'] ** (1 / data.retention['follow_up_time'])
 
     vlines(data_vals, 0, t+1,
            linewidth=2, alpha=.75, color='black',
@@ -109,14 +109,15 @@ def plot_survey_design_prior(design_prior, data_vals):
     my_savefig('survey_design_effect_prior.eps')
 
     
-def plot_admin_priors(eps, sigma, admin_priors, data_dict, data_vars, mc):
+def plot_admin_priors(eps, sigma, admin_priors, data_dict, obs, pred, mc):
 
     # plot residuals for fit
     figure(figsize=(8.5,8.5), dpi=settings.DPI)
-    data_vars = sorted(data_vars, key=lambda x: x[0].value)
-    x = [obs.value for obs, pred in data_vars]
-    y = [obs.value-pred.stats()['mean'] for obs, pred in data_vars]
-    yerr = [obs.value - pred.stats()['95% HPD interval'] for obs, pred in data_vars]
+    order = argsort(obs.value)
+    stats = summary.trace_stats(pred.trace())
+    x = obs.value[order]
+    y = x - stats['mean'][order]
+    yerr = x[:, newaxis] - stats['95% HPD interval'][order]
 
     plot(x, y, 'o')
     plot(x, yerr, 'k-', alpha=.5)
@@ -288,6 +289,7 @@ def plot_neg_binom_fits():
 
     figure(figsize=(8.5,8.5), dpi=settings.DPI)
     error_list = []
+    data = get_data()
 
     cols = 5
     rows = 5
@@ -342,8 +344,15 @@ def plot_neg_binom_fits():
 def plot_posterior(c_id, c, pop,
                    s_m, s_d, e_d, pi, nm, nd, W, H, Hprime, s_r_c, eta, alpha, s_rb,
                    manufacturing_obs, admin_distribution_obs, household_distribution_obs,
-                   itn_coverage, llin_coverage, hh_itn, data):
+                   itn_coverage, llin_coverage, hh_itn, data, summaries=None):
     from settings import year_start, year_end
+
+    def stats(f):
+        """ Posterior statistics of a node, from the streaming
+        summaries if they are available"""
+        if summaries:
+            return summaries.stats(f)
+        return f.stats(chain=None)
     
     ### setup the canvas for our plots
     figure(**settings.FIGURE_OPTIONS)
@@ -357,18 +366,18 @@ def plot_posterior(c_id, c, pop,
         """
         if style=='lines' or style=='alt lines':
             x = year_start + arange(len(f.value))
-            y = f.stats()['mean']/scale
-            lb = f.stats()['quantiles'][2.5]/scale
-            ub = f.stats()['quantiles'][97.5]/scale
+            y = stats(f)['mean']/scale
+            lb = stats(f)['quantiles'][2.5]/scale
+            ub = stats(f)['quantiles'][97.5]/scale
         elif style=='steps':
             x = []
             for ii in range(len(f.value)):
                 x.append(ii)
                 x.append(ii)
 
-            y = (f.stats()['mean']/scale)[x]
-            lb = (f.stats()['quantiles'][2.5]/scale)[x]
-            ub = (f.stats()['quantiles'][97.5]/scale)[x]
+            y = (stats(f)['mean']/scale)[x]
+            lb = (stats(f)['quantiles'][2.5]/scale)[x]
+            ub = (stats(f)['quantiles'][97.5]/scale)[x]
             x = array(x[1:] + [ii+1]) + year_start
         else:
             raise ValueError, 'unrecognized style option: %s' % str(style)
@@ -384,32 +393,31 @@ def plot_posterior(c_id, c, pop,
             y = np.concatenate((lb, ub[::-1]))
             fill(x, y, alpha=.95, label='Est 95% UI', facecolor='.8')
 
-    def scatter_data(data_list, country, country_key, data_key,
-                     error_key=None, error_val=0.,  pi=None, s_r=None,
-                     fmt='go', scale=1.e6, label='', offset=0.):
+    def scatter_data(table, data_key, error_key=None, error_val=0., error=None,
+                     fmt='go', scale=1.e6, label='', offset=0., year_key='year'):
         """ This convenience function is a little bit of a mess, but it
         avoids duplicating code for scatter-plotting various types of
         data, with various types of error bars
         """
-
-        data_val = array([float(d[data_key]) for d in data_list if d[country_key] == c])
+        rows = table.for_country(c)
+        data_val = rows[data_key]
         if len(data_val) == 0:
             return
 
-        if error_key:
-            error_val = array([1.96*float(d[error_key]) \
-                                   for d in data_list if d[country_key] == c])
-
+        if error is not None:
+            error_val = 1.96 * error
+        elif error_key:
+            error_val = 1.96 * rows[error_key]
         elif error_val:
             error_val = 1.96 * error_val * data_val
-        x = array([float(d['year']) for d in data_list if d[country_key] == c])
+        x = rows[year_key]
         errorbar(x + offset,
                  data_val/scale,
                  error_val/scale, fmt=fmt, alpha=.75, label=label,
                  markersize=20)
 
     def stoch_max(stoch):
-        return max(stoch.stats()['95% HPD interval'][:,1])
+        return max(stats(stoch)['95% HPD interval'][:,1])
 
     def decorate_figure(ystr='# of Nets (Per Capita)', ymax=False):
         """ Set the axis, etc."""
@@ -423,7 +431,7 @@ def plot_posterior(c_id, c, pop,
 
     def my_hist(stoch):
         """ Plot a histogram of the posterior distribution of a stoch"""
-        hist(stoch.trace(), normed=True, log=False, label=str(stoch), alpha=.5)
+        hist(stoch.trace(chain=None), normed=True, log=False, label=str(stoch), alpha=.5)
         #l,r,b,t = axis()
         #vlines(ravel(stoch.stats()['quantiles'].values()), b, t,
         #       linewidth=2, alpha=.75, linestyle='dashed',
@@ -452,7 +460,7 @@ def plot_posterior(c_id, c, pop,
 
     def my_acorr(stoch):
         """ Plot the autocorrelation of the a stoch trace"""
-        vals = copy.copy(stoch.trace())
+        vals = copy.copy(stoch.trace(chain=None))
         if shape(vals)[-1] == 1:
             vals = ravel(vals)
 
@@ -488,7 +496,7 @@ def plot_posterior(c_id, c, pop,
         figtext(6.45/8., .097 + .814*(1-(ii+.0)/rows), str(stoch), horizontalalignment='center', verticalalignment='top', fontsize=small_fontsize)
         subplot(rows, cols*2, 2*cols - 1 + ii*2*cols)
         try:
-            plot(stoch.trace(), linewidth=2, alpha=.5)
+            plot(stoch.trace(chain=None), linewidth=2, alpha=.5)
         except Exception, e:
             print 'Error: ', e
 
@@ -532,8 +540,8 @@ def plot_posterior(c_id, c, pop,
     title('LLINs shipped (per capita)', fontsize=fontsize)
     plot_fit(nm, scale=pop, style='steps')
     if len(manufacturing_obs) > 0:
-        scatter_data(data.llin_manu, c, 'country', 'manu_itns', scale=mean(pop),
-                     error_val=1.96 * s_m.stats()['mean'], offset=.5)
+        scatter_data(data.llin_manu, 'manu_itns', scale=mean(pop),
+                     error_val=1.96 * stats(s_m)['mean'], offset=.5)
     ymax=.4
     decorate_figure(ymax=ymax)
 
@@ -547,40 +555,40 @@ def plot_posterior(c_id, c, pop,
     plot_fit(nd, style='steps', scale=pop)
     if len(admin_distribution_obs) > 0:
         label = 'Administrative Data'
-        scatter_data(data.admin_llin, c, 'country', 'program_llins', scale=mean(pop),
-                     error_val=1.96 * s_d.stats()['mean'], label=label, offset=.5)
+        scatter_data(data.admin_llin, 'program_llins', scale=mean(pop),
+                     error_val=1.96 * stats(s_d)['mean'], label=label, offset=.5)
     if len(household_distribution_obs) > 0:
         label = 'Survey Data'
-        scatter_data(data.hh_llin_flow, c, 'country', 'total_llins', scale=mean(pop),
+        scatter_data(data.hh_llin_flow, 'total_llins', scale=mean(pop),
                      error_key='total_st', fmt='bs',
-                     pi=pi.stats()['mean'],
                      label=label, offset=.5)
     legend(loc='upper left')
     decorate_figure(ymax=ymax)
 
-    for d in data.hh_llin_stock:
-        mean_survey_date = time.strptime(d['mean_svydate'], '%d-%b-%y')
-        d['year'] = mean_survey_date[0] + mean_survey_date[1]/12.
-
     subplot(rows, cols/2, 4*(cols/2)+1)
     title('ITN and LLIN coverage', fontsize=fontsize)
     plot_fit(itn_coverage, scale=.01)
     plot_fit(llin_coverage, scale=.01, style='alt lines')
-    if max(itn_coverage.stats()['mean']) > .1:
+    if max(stats(itn_coverage)['mean']) > .1:
         hlines([80], 1999, 2009, linestyle='dotted', color='blue', alpha=.5)
 
-    scatter_data(data.llin_coverage, c, 'country', 'coverage', 'coverage_se',
-                 fmt='bs', scale=.01)
-    scatter_data(data.itn_coverage, c, 'country', 'coverage', 'coverage_se',
-                 fmt='r^', scale=.01)
+    # coverage without a reported standard error has sampling error
+    # scaled by the survey design factor
+    design_factor = stats(s_r_c)['mean']
+    for table, se_key, fmt in [[data.llin_coverage, 'llins0_se', 'bs'],
+                               [data.itn_coverage, 'itns0_se', 'r^']]:
+        cov_rows = table.for_country(c)
+        se = where(cov_rows[se_key] > 0, cov_rows[se_key], design_factor*cov_rows['sampling_error'])
+        scatter_data(table, 'coverage', error=se, fmt=fmt, scale=.01,
+                     year_key='mean_survey_date')
     decorate_figure(ystr='At least one net (%)', ymax=80)
 
     subplot(rows, cols/2, 3*(cols/2)+1)
     title('ITNs and LLINs in households (per capita)', fontsize=fontsize)
     plot_fit(hh_itn, scale=pop)
     plot_fit(H, scale=pop, style='alt lines')
-    scatter_data(data.hh_llin_stock, c, 'country', 'svyindex_llins', scale=mean(pop),
-                 error_key='svyindexllins_se', fmt='bs')
+    scatter_data(data.hh_llin_stock, 'svyindex_llins', scale=mean(pop),
+                 error_key='svyindexllins_se', fmt='bs', year_key='mean_survey_date')
     decorate_figure(ymax=ymax)
 
     my_savefig('bednets_%s_%d_%s.png' % (c, c_id, time.strftime('%Y_%m_%d_%H_%M')))
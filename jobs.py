@@ -0,0 +1,148 @@
+""" Module to run the jobs of a full model fit, either through the
+cluster queue (qsub) or as a pool of local processes
+
+Example
+-------
+>>> import jobs
+>>> ex = jobs.LocalExecutor(processes=8)
+>>> ex.submit('ITNAng-0', ['bednets.py', '0'], 'Ang-stdout.txt', 'Ang-stderr.txt')
+>>> ex.submit('netsdone', ['bednets.py', 'summarize'], 'summarize.stdout', 'summarize.stderr',
+...           depends_on=['ITNAng-0'])
+>>> status = ex.wait()
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+# directory containing the model scripts
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def cpu_count():
+    """ Return the number of cores on this machine"""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        try:
+            return int(os.sysconf('SC_NPROCESSORS_ONLN'))
+        except (AttributeError, ValueError):
+            return 1
+
+
+class Job:
+    def __init__(self, name, args, stdout, stderr, depends_on=[]):
+        self.name = name
+        self.args = args
+        self.stdout = stdout
+        self.stderr = stderr
+        self.depends_on = list(depends_on)
+
+        self.status = 'waiting'
+        self.process = None
+        self.start_time = None
+        self.files = []  # stdout and stderr, while the job runs
+
+
+class QsubExecutor:
+    """ Submit each job to the SGE queue through fit.sh; the queue
+    enforces dependencies with -hold_jid
+
+    Notes
+    -----
+    fit.sh runs bednets.py, so only bednets.py jobs are supported
+    """
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, name, args, stdout, stderr, depends_on=[]):
+        assert args[0] == 'bednets.py', 'qsub jobs must run bednets.py (through fit.sh)'
+
+        call_str = 'qsub -cwd -o %s -e %s ' % (stdout, stderr)
+        if depends_on:
+            call_str += '-hold_jid %s ' % ','.join(depends_on)
+        call_str += '-N %s ' % name \
+                    + 'fit.sh %s' % ' '.join(args[1:])
+        subprocess.call(call_str, shell=True)
+        self.jobs.append(Job(name, args, stdout, stderr, depends_on))
+
+    def wait(self):
+        """ Jobs run on the cluster, so there is nothing to wait for
+        here; return the status of each job as 'submitted'"""
+        return dict([[j.name, 'submitted'] for j in self.jobs])
+
+
+class LocalExecutor:
+    """ Run jobs as local python processes, at most `processes` at a
+    time, starting each job once all of the jobs it depends on have
+    finished successfully
+    """
+    def __init__(self, processes=None, poll_interval=1.):
+        self.processes = processes or cpu_count()
+        self.poll_interval = poll_interval
+        self.jobs = []
+
+    def submit(self, name, args, stdout, stderr, depends_on=[]):
+        self.jobs.append(Job(name, args, stdout, stderr, depends_on))
+
+    def start(self, job):
+        args = [sys.executable, '-u', os.path.join(SRC_DIR, job.args[0])] + list(job.args[1:])
+        job.files = [open(job.stdout, 'w'), open(job.stderr, 'w')]
+        job.process = subprocess.Popen(args, stdout=job.files[0], stderr=job.files[1])
+        job.start_time = time.time()
+        job.status = 'running'
+        print 'started %s: %s' % (job.name, ' '.join(job.args))
+        sys.stdout.flush()
+
+    def wait(self):
+        """ Run all submitted jobs to completion
+
+        Results
+        -------
+        returns a dict mapping job name to its final status: 'done',
+        'failed' (nonzero exit code) or 'skipped' (a job it depends on
+        did not finish successfully)
+        """
+        status = dict([[j.name, j] for j in self.jobs])
+
+        while [j for j in self.jobs if j.status in ['waiting', 'running']]:
+            # collect finished jobs
+            for j in self.jobs:
+                if j.status == 'running' and j.process.poll() is not None:
+                    for f in j.files:
+                        f.close()
+                    j.files = []
+                    if j.process.returncode == 0:
+                        j.status = 'done'
+                    else:
+                        j.status = 'failed'
+                    print '%s %s (exit code %d, %.0f seconds)' % (
+                        j.status, j.name, j.process.returncode, time.time() - j.start_time)
+                    sys.stdout.flush()
+
+            # skip jobs that can never run, start jobs that are ready
+            for j in self.jobs:
+                if j.status != 'waiting':
+                    continue
+                dep_status = [status[d].status for d in j.depends_on if d in status]
+                if [s for s in dep_status if s in ['failed', 'skipped']]:
+                    j.status = 'skipped'
+                    print 'skipped %s (a job it depends on failed)' % j.name
+                elif [s for s in dep_status if s != 'done']:
+                    continue
+                elif len([k for k in self.jobs if k.status == 'running']) < self.processes:
+                    self.start(j)
+
+            time.sleep(self.poll_interval)
+
+        results = dict([[j.name, j.status] for j in self.jobs])
+        failed = sorted([n for n, s in results.items() if s != 'done'])
+        print '%d of %d jobs finished successfully' % (len(results) - len(failed), len(results))
+        if failed:
+            print 'not finished: %s' % ', '.join(failed)
+        return results
+
+
+EXECUTORS = dict(qsub=QsubExecutor, local=LocalExecutor)
@@ -0,0 +1,509 @@
+""" Module to fit the stock-and-flow model for many countries jointly,
+in a single sampler
+
+Each country has its own log stocks (llins shipped, llins distributed
+and non-llin net stock in every year), dynamics, additional priors and
+observations, as in bednets.py, so that a step that updates the stocks
+of one country only recomputes its own likelihood, and a sweep through
+all the countries costs as much as fitting each of them once.  The
+stocks, flows and coverage that are reported are stacked into arrays
+with a country axis, which nothing else depends on.  The parameters that bednets.py
+takes from the empirical priors fit to pooled data (the loss rate, the
+admin bias and error and the coverage parameters), and the survey
+design factor and reporting errors, are shared by all countries and
+estimated with them.  The empirical priors only enter where they come
+from data that are not in the country likelihoods (the retention
+studies and the survey design effects); the admin and coverage
+parameters get the hyper-priors used to fit their empirical priors
+(see emp_priors.py), so there is no need to refine them from the
+posterior by hand (emp_priors.improve_admin_err_and_bias_from_posterior).
+
+Example
+-------
+>>> import joint
+>>> joint.main()                  # all countries
+>>> joint.main([0, 5, 12])        # some of them
+
+or, from the command line,
+
+$ python bednets.py joint
+"""
+
+import settings
+
+from numpy import *
+from pymc import *
+
+import re
+import glob
+import time
+
+from data import get_data
+
+import dynamics
+import sampling
+import summary
+import results
+import diagnostics
+import checkpoint
+import posterior
+import map_fit
+import step_methods
+import emp_priors
+import bednets
+
+# stochs that each country has its own copy of, named '<name>_<country>'
+COUNTRY_STOCHS = ['log(llins distributed)', 'log(llins shipped)', 'log(non-llin household net stock)']
+
+
+def country_fits(data, countries, pop):
+    """ Build and initialize the model for each country on its own
+
+    Results
+    -------
+    returns a list with a dict of the nodes of each country model (see
+    bednets.setup_model), with 'post' and 'cov' the log-posterior and
+    the covariance of the laplace approximation at its MAP, if they
+    were found (settings.MAP_METHOD == 'lbfgs')
+    """
+    fits = []
+    for k, c in enumerate(countries):
+        print 'initializing %s...' % c
+        m = bednets.setup_model(data, c, pop[k])
+        m['post'] = m['cov'] = None
+        if settings.MAP_METHOD == 'lbfgs':
+            m['post'] = posterior.Posterior(m['vars'])
+            x, m['cov'] = map_fit.laplace(m['post'], map_fit.fit(m['post']))
+        fits.append(m)
+    return fits
+
+
+def setup_model(data, countries, pop, fits):
+    """ Build the joint model for several countries
+
+    Parameters
+    ----------
+    data : data.Data
+    countries : list of str
+    pop : array, shape (C, T)
+      population of each country in each year
+    fits : list of dicts
+      the initialized model of each country, from country_fits, which
+      give the initial values
+
+    Results
+    -------
+    returns a dict of the nodes of the model, keyed as for
+    bednets.setup_model, with the nodes reported for every country
+    (stocks, flows and coverage) stacked into arrays of shape (C, T),
+    the other country-level nodes in lists with one for each country
+    (or one for each country that has the data, for the
+    observations), and 'vars' the list of all of them
+    """
+    # initial values of the shared stochs, from the country models
+    init = lambda key: mean([f[key].value for f in fits], axis=0)
+
+    ### setup the model variables
+    vars = []
+
+       ####################
+      ### shared parameters
+     ###
+    ####################
+
+    # priors from data that are not in the likelihood
+    prior = emp_priors.llin_discard_rate()
+    pi = Beta('Pr[net is lost]', prior['alpha'], prior['beta'], value=init('pi'))
+
+    prior = emp_priors.survey_design()
+    gamma = Normal('survey design factor for coverage data', prior['mu'], prior['tau'],
+                   value=init('gamma'))
+
+    # hyper-priors of the empirical priors fit to data that are now
+    # in the likelihood
+    e_d = Normal('bias in admin dist data', 0., 1., value=init('e_d'))
+    s_d = Gamma('error in admin dist data', 1., 1., value=maximum(.01, init('s_d')))
+    beta = Uniform('relative weights of next year to current year in admin dist data', 0., 2.,
+                   value=clip(init('beta'), .01, 1.99))
+    eta = Normal('coverage parameter', 5., 3., value=init('eta'))
+    alpha = Exponential('dispersion parameter', 1., value=init('alpha'))
+
+    s_m = Lognormal('error_in_llin_ship', log(.05), .5**-2, value=init('s_m'))
+    s_rb = Lognormal('recall bias factor', log(.05), .5**-2, value=init('s_rb'))
+
+    vars += [pi, gamma, e_d, s_d, beta, eta, alpha, s_m, s_rb]
+
+       ##########################################
+      ### the model of each country, and the nodes
+     ### with a country axis stacked from them
+    ##########################################
+
+    shared = dict(pi=pi, gamma=gamma, e_d=e_d, s_d=s_d, beta=beta, eta=eta, alpha=alpha,
+                  s_m=s_m, s_rb=s_rb)
+    nodes = [country_model(data, c, pop[k], fits[k], shared) for k, c in enumerate(countries)]
+    for n in nodes:
+        vars += n['vars']
+
+    # arrays of shape (C, T), for reporting only: no stoch depends on
+    # them, so they are computed when they are tallied, once for each
+    # sample, and not at every step
+    def stack(key, name):
+        return Lambda(name, lambda x=[n[key] for n in nodes]: array(x))
+
+    delta = stack('delta', 'llins distributed')
+    mu = stack('mu', 'llins shipped')
+    Omega = stack('Omega', 'non-llin household net stock')
+    Psi = stack('Psi', 'llin warehouse net stock')
+    Theta = stack('Theta', 'household llin stock')
+    itns_owned = stack('itns_owned', 'household itn stock')
+    llin_coverage = stack('llin_coverage', 'llin coverage')
+    itn_coverage = stack('itn_coverage', 'itn coverage')
+
+    vars += [delta, mu, Omega, Psi, Theta, itns_owned, llin_coverage, itn_coverage]
+
+    m = dict(vars=vars, delta=delta, mu=mu, Omega=Omega, Psi=Psi, Theta=Theta, itns_owned=itns_owned,
+             llin_coverage=llin_coverage, itn_coverage=itn_coverage)
+    m.update(shared)
+    for key in ['log_delta', 'log_mu', 'log_Omega', 'X',
+                'positive_stocks', 'proven_capacity', 'itn_composition', 'smooth_coverage']:
+        m[key] = [n[key] for n in nodes]
+    for key in ['manufacturing_obs', 'admin_distribution_obs', 'household_distribution_obs',
+                'household_stock_obs', 'coverage_obs']:
+        m[key] = [obs for n in nodes for obs in n[key]]
+    return m
+
+
+def country_model(data, c, pop, fit, shared):
+    """ Build the nodes of one country in the joint model, which depend
+    on the other countries only through the shared parameters
+
+    Parameters
+    ----------
+    data : data.Data
+    c : str
+    pop : array
+      population of the country in each year
+    fit : dict
+      the initialized model of the country, from country_fits, which
+      gives the initial values
+    shared : dict
+      the shared parameters, keyed as for bednets.setup_model
+
+    Results
+    -------
+    returns a dict of the nodes, keyed as for bednets.setup_model, with
+    'vars' the list of all of them; every name ends in '_<country>'
+    """
+    from settings import year_start, year_end
+    pi, gamma, e_d, s_d, beta, eta, alpha, s_m, s_rb = [
+        shared[key] for key in ['pi', 'gamma', 'e_d', 's_d', 'beta', 'eta', 'alpha', 's_m', 's_rb']]
+
+    vars = []
+
+       #######################
+      ### compartmental model
+     ###
+    #######################
+
+    mu_N = .001 * pop
+    std_N = where(arange(year_start, year_end) <= 2003, .2, 2.)
+
+    log_delta = Normal('log(llins distributed)_%s' % c, mu=log(mu_N), tau=std_N**-2,
+                       value=fit['log_delta'].value)
+    delta = Lambda('llins distributed_%s' % c, lambda x=log_delta: exp(x), trace=False)
+
+    log_mu = Normal('log(llins shipped)_%s' % c, mu=log(mu_N), tau=std_N**-2,
+                    value=fit['log_mu'].value)
+    mu = Lambda('llins shipped_%s' % c, lambda x=log_mu: exp(x), trace=False)
+
+    log_Omega = Normal('log(non-llin household net stock)_%s' % c, mu=log(mu_N), tau=2.**-2,
+                       value=fit['log_Omega'].value)
+    Omega = Lambda('non-llin household net stock_%s' % c, lambda x=log_Omega: exp(x), trace=False)
+
+    vars += [log_delta, delta, log_mu, mu, log_Omega, Omega]
+
+    @deterministic(name='stock and flow_%s' % c, trace=False)
+    def X(mu=mu, delta=delta, Omega=Omega, pi=pi, eta=eta, alpha=alpha, pop=pop):
+        return dynamics.stock_and_flow(mu, delta, Omega, pi, eta, alpha, pop)
+
+    Psi = Lambda('llin warehouse net stock_%s' % c, lambda X=X: X[dynamics.WAREHOUSE], trace=False)
+    Theta = Lambda('household llin stock_%s' % c, lambda X=X: X[dynamics.LLIN_STOCK], trace=False)
+    itns_owned = Lambda('household itn stock_%s' % c, lambda X=X: X[dynamics.ITN_STOCK], trace=False)
+    llin_coverage = Lambda('llin coverage_%s' % c, lambda X=X: X[dynamics.LLIN_COVERAGE], trace=False)
+    itn_coverage = Lambda('itn coverage_%s' % c, lambda X=X: X[dynamics.ITN_COVERAGE], trace=False)
+
+    vars += [X, Psi, Theta, itns_owned, llin_coverage, itn_coverage]
+
+       #####################
+      ### additional priors
+     ###
+    #####################
+
+    # the same potentials as bednets.setup_model, in their numpy
+    # versions from posterior.py
+    @potential(name='positive_stocks_%s' % c)
+    def positive_stocks(Theta=Theta, Psi=Psi, Omega=Omega):
+        return posterior.positive_stocks(dict(Theta=Theta, Psi=Psi, Omega=Omega, smooth=0.), None)
+
+    @potential(name='proven_capacity_%s' % c)
+    def proven_capacity(delta=delta, Omega=Omega, tau=.5**-2):
+        return posterior.proven_capacity(dict(delta=delta, Omega=Omega), tau)
+
+    @potential(name='itn_composition_%s' % c)
+    def itn_composition(llin=Theta, non_llin=Omega, tau=.5**-2):
+        return posterior.itn_composition(dict(Theta=llin, Omega=non_llin), tau)
+
+    @potential(name='smooth_coverage_%s' % c)
+    def smooth_coverage(itn_coverage=itn_coverage, tau=.5**-2):
+        return posterior.smooth_coverage(dict(itn_coverage=itn_coverage), tau)
+
+    vars += [positive_stocks, proven_capacity, itn_composition, smooth_coverage]
+
+       #####################
+      ### statistical model
+     ###
+    #####################
+
+    ### nets shipped to country (reported by manufacturers)
+    manufacturing_obs = []
+    rows = data.llin_manu.for_country(c)
+    if len(rows) > 0:
+        @observed
+        @stochastic(name='manufactured_%s' % c)
+        def obs(value=log(maximum(1., rows['manu_itns'])),
+                year_index=rows['year'].astype(int) - year_start, mu=mu, s_m=s_m):
+            return normal_like(value, log(maximum(1., mu[year_index])), 1. / s_m**2)
+        manufacturing_obs.append(obs)
+    vars += [manufacturing_obs]
+
+    ### nets distributed in country (reported by NMCP)
+    admin_distribution_obs = []
+    rows = data.admin_llin.for_country(c)
+    data_dict = dict(zip(rows['year'], maximum(1., rows['program_llins'])))
+    if data_dict:
+        admin_years = sorted(data_dict.keys())
+
+        @observed
+        @stochastic(name='administrative_distribution_%s' % c)
+        def obs(value=log([data_dict[year] for year in admin_years]),
+                year_index=array(admin_years, dtype=int) - year_start,
+                delta=delta, s_d=s_d, e_d=e_d, beta=beta):
+            pred = log(maximum(1., delta[year_index] + beta*delta[year_index+1])) + e_d
+            return normal_like(value, pred, 1. / s_d**2)
+        admin_distribution_obs.append(obs)
+    vars += [admin_distribution_obs]
+
+    ### nets distributed in country (observed in household survey)
+    household_distribution_obs = []
+    rows = data.hh_llin_flow.for_country(c)
+    if len(rows) > 0:
+        estimate_year = rows['year'].astype(int)
+
+        @observed
+        @stochastic(name='household_distribution_%s' % c)
+        def obs(value=rows['total_llins'],
+                year_index=estimate_year - year_start,
+                time_held=rows['mean_survey_date'] - estimate_year - .5,
+                survey_err=rows['total_st'],
+                delta=delta, pi=pi, s_rb=s_rb):
+            return normal_like(
+                value,
+                delta[year_index] * (1 - pi) ** time_held,
+                1./ (survey_err*(1+s_rb))**2)
+        household_distribution_obs.append(obs)
+    vars += [household_distribution_obs]
+
+    ### net stock in households (from survey)
+    household_stock_obs = []
+    rows = data.hh_llin_stock.for_country(c)
+    if len(rows) > 0:
+        i0, i1, w = dynamics.interpolation_weights(rows['mean_survey_date'], year_start)
+
+        @observed
+        @stochastic(name='LLIN_HH_Stock_%s' % c)
+        def obs(value=rows['svyindex_llins'],
+                i0=i0, i1=i1, w=w,
+                std_err=rows['svyindexllins_se'],
+                Theta=Theta):
+            Theta_i = (1-w) * Theta[i0] + w * Theta[i1]
+            return normal_like(value, Theta_i, 1. / std_err**2)
+        household_stock_obs.append(obs)
+    vars += [household_stock_obs]
+
+    ### llin and itn coverage (from survey and survey reports)
+    coverage_obs = []
+    rows = data.llin_coverage.for_country(c)
+    if len(rows) > 0:
+        is_survey = rows['llins0_se'] > 0
+        i0, i1, w = dynamics.interpolation_weights(
+            where(is_survey, rows['survey_year2'], rows['mean_survey_date']), year_start)
+
+        @observed
+        @stochastic(name='LLIN_Coverage_%s' % c)
+        def obs(value=rows['coverage'],
+                i0=i0, i1=i1, w=w,
+                std_err=where(is_survey, rows['llins0_se'], 0.),
+                sampling_error=where(is_survey, 0., rows['sampling_error']),
+                design_factor=gamma,
+                coverage=llin_coverage):
+            coverage_i = (1-w) * coverage[i0] + w * coverage[i1]
+            return normal_like(value, coverage_i, 1. / (std_err + design_factor * sampling_error)**2)
+        coverage_obs.append(obs)
+
+    rows = data.itn_coverage.for_country(c)
+    if len(rows) > 0:
+        is_survey = rows['itns0_se'] > 0
+        i0, i1, w = dynamics.interpolation_weights(rows['mean_survey_date'], year_start)
+
+        @observed
+        @stochastic(name='ITN_Coverage_%s' % c)
+        def obs(value=rows['coverage'],
+                i0=i0, i1=i1, w=w,
+                std_err=where(is_survey, rows['itns0_se'], 0.),
+                sampling_error=where(is_survey, 0., rows['sampling_error']),
+                design_factor=gamma,
+                coverage=itn_coverage):
+            coverage_i = (1-w) * coverage[i0] + w * coverage[i1]
+            return normal_like(value, coverage_i, 1. / (std_err + design_factor * sampling_error)**2)
+        coverage_obs.append(obs)
+    vars += [coverage_obs]
+
+    return dict(vars=vars, log_delta=log_delta, delta=delta, log_mu=log_mu, mu=mu,
+                log_Omega=log_Omega, Omega=Omega,
+                X=X, Psi=Psi, Theta=Theta, itns_owned=itns_owned,
+                llin_coverage=llin_coverage, itn_coverage=itn_coverage,
+                positive_stocks=positive_stocks, proven_capacity=proven_capacity,
+                itn_composition=itn_composition, smooth_coverage=smooth_coverage,
+                manufacturing_obs=manufacturing_obs,
+                admin_distribution_obs=admin_distribution_obs,
+                household_distribution_obs=household_distribution_obs,
+                household_stock_obs=household_stock_obs,
+                coverage_obs=coverage_obs)
+
+
+def use_step_methods(mc, countries, fits):
+    """ Assign the block steps of settings.BLOCKS, with one block for
+    each country for blocks of country-level stochs, started from the
+    laplace approximation of the country fits if there is one"""
+    nodes = dict([[s.__name__, s] for s in mc.stochastics])
+    for block in settings.BLOCKS:
+        if [name for name in block if name not in COUNTRY_STOCHS]:
+            step_methods.use_blocks(mc, [block])
+            continue
+        for c, f in zip(countries, fits):
+            cov = None
+            if f['cov'] is not None:
+                cov = step_methods.initial_cov(f['post'], f['cov'], block)
+            mc.use_step_method(step_methods.BlockMetropolis, [nodes['%s_%s' % (name, c)] for name in block], cov=cov)
+
+
+def country_stats(stats, k):
+    """ Posterior stats of country k, from the stats of a node with a
+    country axis (as returned by summary.Summaries.stats)
+
+    Notes
+    -----
+    the HPD interval of a (C, T) node has shape (T, C, 2)
+    """
+    return {'mean': stats['mean'][k],
+            '95% HPD interval': stats['95% HPD interval'][:, k]}
+
+
+def main(country_ids=None, chains=None, resume=False):
+    """ Fit the joint model, and save the results for each country as
+    bednets.main does
+
+    Parameters
+    ----------
+    country_ids : list of ints, optional
+      indices of the countries in sorted(data.countries), defaults to
+      all of them
+    chains : int, optional
+      number of MCMC chains to run in parallel, defaults to
+      settings.CHAINS
+    resume : bool, optional
+      continue the latest joint fit from its last checkpoint, if it has
+      one (see checkpoint.py)
+    """
+    from settings import year_start, year_end
+
+    if chains is None:
+        chains = settings.CHAINS
+
+    data = get_data()
+    countries = sorted(data.countries)
+    if country_ids is not None:
+        countries = [countries[i] for i in country_ids]
+    print 'joint fit of %d countries' % len(countries)
+
+    pop = array([data.population_for(c, year_start, year_end) for c in countries])
+    fits = country_fits(data, countries, pop)
+    m = setup_model(data, countries, pop, fits)
+    vars = m['vars']
+
+    ext = settings.TRACE_BACKEND
+    if ext == 'chunked':
+        ext = 'traces'  # a directory, see trace_store.py
+    dbname = settings.PATH + 'joint_model_%s.%s' % (time.strftime('%Y_%m_%d_%H_%M'), ext)
+    if resume:
+        checkpoints = sorted(glob.glob(settings.PATH + 'joint_model_*.%s*.checkpoint' % ext))
+        if checkpoints:
+            dbname = re.sub('(\.chain[0-9]+)?\.checkpoint$', '', checkpoints[-1])
+            print 'resuming %s' % dbname
+        else:
+            print 'no checkpoint found, starting a new fit'
+
+    summaries = summary.Summaries([m[k] for k in ['mu', 'delta', 'Psi', 'Theta', 'Omega',
+                                                    'itns_owned', 'llin_coverage', 'itn_coverage']])
+
+    def make_mcmc(dbname):
+        mc = MCMC(vars, verbose=1, db=checkpoint.database(dbname), dbname=dbname)
+        use_step_methods(mc, countries, fits)
+        summaries.attach(mc)
+        return mc
+
+    reported = ['llins distributed', 'itn coverage', 'Pr[net is lost]', 'coverage parameter']
+    def sample_chain(mc):
+        if settings.TESTING:
+            sampling.sample(mc, reported, 100, 0, 1, chains, adaptive=False)
+        else:
+            sampling.sample(mc, reported, settings.NUM_SAMPLES, settings.BURN, settings.THIN, chains,
+                            summaries=summaries)
+
+    if chains > 1:
+        db = sampling.run_chains(make_mcmc, sample_chain, dbname, chains, summaries)
+        mc = MCMC(vars, db=db)
+        diagnostics.summarize(db, ['itn coverage', 'llins distributed', 'Pr[net is lost]'])
+    else:
+        mc = make_mcmc(dbname)
+        sample_chain(mc)
+        mc.db.commit()
+
+    for stoch in [m[k] for k in ['pi', 'e_d', 's_d', 'beta', 'eta', 'alpha', 'gamma', 's_m', 's_rb']]:
+        print '%s: %s' % (str(stoch), summaries.stats(stoch)['mean'])
+
+    # save results for each country, as bednets.main does
+    run_id = results.new_run_id()
+    for k, c in enumerate(countries):
+        stats = dict([[n.__name__, country_stats(summaries.stats(n), k)] for n in summaries.nodes])
+        results.save(c, run_id, summary.output_table(c, pop[k], stats, year_start))
+    results.export_csv()
+    checkpoint.remove(dbname)
+
+    for k, c in enumerate(countries):
+        country_id = sorted(data.countries).index(c)
+        f = open(settings.PATH + 'traces/itn_coverage_%s_%d_%s.csv' % (c, country_id, time.strftime('%Y_%m_%d_%H_%M')), 'w')
+        f.write(','.join(['itn_hhcov_%d' % year for year in range(year_start, year_end)]))
+        f.write('\n')
+        for row in m['itn_coverage'].trace(chain=None):
+            f.write(','.join(['%.4f' % cell for cell in row[k]]))
+            f.write('\n')
+        f.close()
+
+        f = open(settings.PATH + 'traces/itn_stock_%s_%d_%s.csv' % (c, country_id, time.strftime('%Y_%m_%d_%H_%M')), 'w')
+        for row in m['itns_owned'].trace(chain=None):
+            f.write(','.join(['%.4f' % cell for cell in row[k]]))
+            f.write('\n')
+        f.close()
+
+    return m
@@ -0,0 +1,115 @@
+""" Module for finding the MAP estimate of the stock-and-flow model for
+one country with a quasi-Newton method (L-BFGS) and exact gradients,
+and the Laplace approximation to the posterior at the optimum
+
+This replaces the derivative-free fmin_powell fits of pymc's MAP,
+which need a number of function evaluations that grows quickly with
+the number of years.
+
+Example
+-------
+>>> post = posterior.Posterior(vars)
+>>> x = map_fit.fit(post)           # also sets the stochs to the MAP values
+>>> mean, cov = map_fit.laplace(post, x)
+"""
+
+from numpy import isfinite, zeros, dot, sqrt, diag
+from numpy.linalg import eigh
+from scipy.optimize import fmin_l_bfgs_b
+
+# the positive_stocks potential is linear in the number of nets below
+# zero, so the optimum usually sits on its kink, where quasi-Newton
+# steps stall; the optimization is done in stages, with the kink
+# smoothed over this many nets and then less and less, down to the
+# exact density
+SMOOTHING = [1000., 10., 0.]
+
+# returned by the objective where the log-posterior is not finite
+# (e.g. a coverage parameter for which the coverage is undefined)
+INFEASIBLE = 1.e300
+
+
+def fit(post, x0=None, smoothing=SMOOTHING, iterlim=2000, factr=1.e9, verbose=0):
+    """ Maximize the log-posterior with L-BFGS, using exact gradients
+
+    Parameters
+    ----------
+    post : posterior.Posterior
+    x0 : array, optional
+      starting parameter vector, defaults to the current values of the
+      stochs
+    smoothing : list of floats, optional
+      widths (in nets) of the smoothing of the positive_stocks kink
+      for each stage, ending with 0 for the exact density
+    iterlim : int, optional
+      maximum number of L-BFGS iterations per stage
+    factr : float, optional
+      L-BFGS stops when the relative change in the log-posterior is
+      below factr times the machine precision
+    verbose : int, optional
+
+    Results
+    -------
+    returns the parameter vector at the optimum, and sets the stochs
+    to it
+
+    Notes
+    -----
+    if the optimizer ends somewhere worse than x0, x0 is kept
+    """
+    if x0 is None:
+        x0 = post.vector()
+
+    evals = [0]
+    def f(x, smooth):
+        evals[0] += 1
+        logp = post.logp(x, smooth)
+        if not isfinite(logp):
+            return INFEASIBLE, zeros(len(x))
+        return -logp, -post.grad(x, smooth)
+
+    x = x0
+    for smooth in smoothing:
+        x, neg_logp, info = fmin_l_bfgs_b(f, x, args=(smooth,), maxiter=iterlim, factr=factr)
+        if verbose:
+            print 'L-BFGS (smoothing %g): log-posterior %.2f after %d iterations' % (smooth, -neg_logp, info['nit'])
+
+    logp = post.logp(x)
+    if not (logp > post.logp(x0)):
+        x = x0
+    if verbose:
+        print 'MAP log-posterior %.2f from %d evaluations' % (post.logp(x), evals[0])
+    post.set_values(x)
+    return x
+
+
+def laplace(post, x):
+    """ Laplace approximation to the posterior at the optimum x
+
+    Results
+    -------
+    returns (mean, cov), the mean and covariance of a normal
+    approximation to the posterior of the parameter vector (on the
+    unconstrained scale)
+
+    Notes
+    -----
+    the covariance is the inverse of the negative Hessian; directions
+    in which the log-posterior is not strictly concave (e.g. where a
+    potential is flat) are given the variance of the smallest
+    positive curvature instead of an infinite one
+    """
+    H = post.hessian(x)
+    w, V = eigh(-H)
+    positive = w > 0
+    floor = w[positive].min() if positive.any() else 1.
+    w = w * positive + floor * (1 - positive)
+    cov = dot(V / w, V.T)
+    return x, cov
+
+
+def standard_errors(post, x):
+    """ Standard error of each parameter, from the Laplace
+    approximation"""
+    mean, cov = laplace(post, x)
+    return sqrt(diag(cov))
@@ -0,0 +1,524 @@
+""" Module for evaluating the log-posterior of the stock-and-flow model
+for one country directly with numpy, as a function of a flat vector
+of unconstrained parameters, with exact derivatives
+
+The priors, data and potentials are read from the pymc nodes built by
+bednets.setup_model, so the density is the same as the pymc model's,
+but each evaluation is a handful of array operations instead of a walk
+over the nodes, and a batch of thousands of parameter vectors costs
+little more than one.  Every
+operation is written so that it also works on complex numbers, which
+gives exact first derivatives by the complex-step method (a
+forward-mode scheme: the derivative in each direction is carried in
+the imaginary part), with all directions evaluated in one batch.
+
+Example
+-------
+>>> post = posterior.Posterior(vars)
+>>> x = post.vector()                # current values of the stochs
+>>> post.logp(x), post.grad(x)
+>>> post.set_values(x + .1)
+
+>>> post = posterior.for_country(3)
+>>> post.logp(post.vector() + .01*randn(1000, post.size))  # 1000 log-posteriors in one call
+>>> posterior.check(post)          # agrees with the pymc model
+
+or, from the command line,
+
+$ python posterior.py 3
+$ python posterior.py      # check against the pymc model, with synthetic data
+"""
+
+import sys
+import time
+
+from numpy import asarray, zeros, eye, log, exp, pi as PI, where, newaxis, concatenate, diff, \
+    isfinite, random, inf
+from scipy.special import gammaln
+
+import pymc
+
+import dynamics
+
+# the stochs of the country model, with the transformation from each
+# one's support to the real line
+PARAMETERS = [['Pr[net is lost]', 'logit'],
+              ['bias in admin dist data', None],
+              ['error in admin dist data', None],
+              ['relative weights of next year to current year in admin dist data', None],
+              ['coverage parameter', None],
+              ['dispersion parameter', 'log'],
+              ['survey design factor for coverage data', None],
+              ['error_in_llin_ship', 'log'],
+              ['recall bias factor', 'log'],
+              ['log(llins distributed)', None],
+              ['log(llins shipped)', None],
+              ['log(non-llin household net stock)', None]]
+
+# years of the itn_composition potential in bednets.main, where all
+# nets are assumed to be non-llins (0) or llins (1)
+COMPOSITION_INDEX = [0, 1, 2, 6, 7, 8, 9, 10, 11]
+COMPOSITION_TARGET = [0., 0., 0., 1., 1., 1., 1., 1., 1.]
+
+# step for the complex-step derivatives, and relative step for the
+# finite differences of the gradient that give the Hessian
+COMPLEX_STEP = 1.e-20
+HESSIAN_STEP = 1.e-5
+
+
+def normal_like(x, mu, tau):
+    """ Normal log-likelihood, summed over the last axis"""
+    return (-.5 * tau * (x - mu)**2 + .5 * log(.5 * tau / PI)).sum(axis=-1)
+
+
+def lognormal_like(x, mu, tau):
+    return (-.5 * tau * (log(x) - mu)**2 + .5 * log(.5 * tau / PI) - log(x)).sum(axis=-1)
+
+
+def beta_like(x, alpha, beta):
+    return ((alpha - 1) * log(x) + (beta - 1) * log(1 - x)
+            + gammaln(alpha + beta) - gammaln(alpha) - gammaln(beta)).sum(axis=-1)
+
+
+def gamma_like(x, alpha, beta):
+    return (-gammaln(alpha) + alpha * log(beta) - beta * x + (alpha - 1) * log(x)).sum(axis=-1)
+
+
+PRIORS = dict(Normal=[normal_like, 'mu', 'tau'],
+              Lognormal=[lognormal_like, 'mu', 'tau'],
+              Beta=[beta_like, 'alpha', 'beta'],
+              Gamma=[gamma_like, 'alpha', 'beta'])
+
+
+def positive_part(x):
+    """ maximum(x, 0), comparing real parts (so it is complex-step safe)"""
+    return where(x.real > 0, x, 0.)
+
+
+def softplus(x, width):
+    """ Smooth approximation to positive_part(x), which differs from it
+    by at most width*log(2)"""
+    z = x / width
+    big = z.real > 30.
+    return where(big, x, width * log(1. + exp(where(big, 30., z))))
+
+
+def at_least(x, lower):
+    """ maximum(x, lower), comparing real parts"""
+    return where(x.real > lower, x, lower)
+
+
+def running_max(x):
+    """ Running maximum along the last axis, comparing real parts"""
+    m = x[..., :1]
+    cols = [m]
+    for t in range(1, x.shape[-1]):
+        m = where(x[..., t:t+1].real > m.real, x[..., t:t+1], m)
+        cols.append(m)
+    return concatenate(cols, axis=-1)
+
+
+class Posterior:
+    """ The log-posterior of a country model, as a function of a flat
+    vector of unconstrained parameters
+
+    Parameters
+    ----------
+    vars : list
+      the pymc nodes of the model, as built by bednets.setup_model
+
+    Notes
+    -----
+    the density is the pymc model's logp, with no Jacobian for the
+    transformations, so it has the same maximum as pymc's MAP
+    """
+    def __init__(self, vars):
+        self.model = model = pymc.Model(vars)
+        nodes = dict([[n.__name__, n] for n in model.nodes])
+
+        self.stochs = []
+        self.slices = {}
+        self.scalar = {}
+        self.transforms = {}
+        self.priors = []
+        n = 0
+        for name, transform in PARAMETERS:
+            s = nodes[name]
+            size = max(1, asarray(s.value).size)
+            self.stochs.append(s)
+            self.slices[name] = slice(n, n+size)
+            self.scalar[name] = asarray(s.value).ndim == 0
+            self.transforms[name] = transform
+            like, a, b = PRIORS[s.__class__.__name__]
+            p = s.parents.value
+            self.priors.append([name, like, asarray(p[a], dtype=float), asarray(p[b], dtype=float)])
+            n += size
+        self.size = n
+
+        missing = set([s.__name__ for s in model.stochastics]) - set(self.slices)
+        if missing:
+            raise ValueError, 'no numpy version of stoch(s) %s' % ', '.join(missing)
+
+        self.pop = asarray(nodes['stock and flow'].parents.value['pop'], dtype=float)
+
+        # data and constants of the observations and potentials
+        self.obs = []
+        for o in model.observed_stochastics:
+            # observations are named '<kind>_<country>', and country
+            # names may contain '_'
+            kinds = [k for k in OBSERVATIONS if o.__name__.startswith(k + '_')]
+            if not kinds:
+                raise ValueError, 'no numpy version of observation %s' % o.__name__
+            kind = max(kinds, key=len)
+            p = o.parents.value
+            self.obs.append([kind, asarray(o.value, dtype=float), p])
+
+        self.potentials = []
+        for f in model.potentials:
+            if f.__name__ not in POTENTIALS:
+                raise ValueError, 'no numpy version of potential %s' % f.__name__
+            self.potentials.append([f.__name__, f.parents.value.get('tau')])
+
+    def value(self, x, name):
+        """ Value of a stoch from a (batch of) parameter vector(s),
+        transformed back to its support"""
+        v = x[..., self.slices[name]]
+        if self.scalar[name]:
+            v = v[..., 0]
+        transform = self.transforms[name]
+        if transform == 'log':
+            return exp(v)
+        elif transform == 'logit':
+            return 1. / (1. + exp(-v))
+        return v
+
+    def vector(self):
+        """ Return the parameter vector for the current values of the
+        stochs"""
+        x = zeros(self.size)
+        for s in self.stochs:
+            v = asarray(s.value, dtype=float)
+            transform = self.transforms[s.__name__]
+            if transform == 'log':
+                v = log(v)
+            elif transform == 'logit':
+                v = log(v / (1. - v))
+            x[self.slices[s.__name__]] = v
+        return x
+
+    def set_values(self, x):
+        """ Set the stochs to the values of parameter vector x"""
+        for s in self.stochs:
+            v = self.value(asarray(x, dtype=float), s.__name__)
+            if self.scalar[s.__name__]:
+                v = float(v)
+            s.value = v
+
+    def logp(self, x, smooth=0.):
+        """ Log-posterior of parameter vector x
+
+        Parameters
+        ----------
+        x : array, shape (..., size)
+          one parameter vector, or a batch of them (real or complex)
+        smooth : float, optional
+          if positive, the kink in the positive_stocks potential is
+          smoothed over this many nets (see map_fit.py)
+
+        Results
+        -------
+        returns an array of shape (...)
+        """
+        x = asarray(x)
+        v = dict([[name, self.value(x, name)] for name, t in PARAMETERS])
+        one = lambda name: v[name][..., newaxis]
+
+        logp = 0.
+        for name, like, a, b in self.priors:
+            y = v[name]
+            if y.ndim == x.ndim - 1:
+                y = y[..., newaxis]
+            logp = logp + like(y, a, b)
+
+        mu = exp(v['log(llins shipped)'])
+        delta = exp(v['log(llins distributed)'])
+        Omega = exp(v['log(non-llin household net stock)'])
+        X = dynamics.stock_and_flow(mu, delta, Omega, v['Pr[net is lost]'],
+                                    v['coverage parameter'], v['dispersion parameter'], self.pop)
+        state = dict(mu=mu, delta=delta, Omega=Omega,
+                     Psi=X[..., dynamics.WAREHOUSE, :],
+                     Theta=X[..., dynamics.LLIN_STOCK, :],
+                     llin_coverage=X[..., dynamics.LLIN_COVERAGE, :],
+                     itn_coverage=X[..., dynamics.ITN_COVERAGE, :],
+                     pi=one('Pr[net is lost]'),
+                     s_m=one('error_in_llin_ship'),
+                     s_d=one('error in admin dist data'),
+                     e_d=one('bias in admin dist data'),
+                     beta=one('relative weights of next year to current year in admin dist data'),
+                     s_rb=one('recall bias factor'),
+                     gamma=one('survey design factor for coverage data'),
+                     smooth=smooth)
+
+        for kind, value, p in self.obs:
+            logp = logp + OBSERVATIONS[kind](value, p, state)
+        for name, tau in self.potentials:
+            logp = logp + POTENTIALS[name](state, tau)
+        return logp
+
+    def grad(self, x, smooth=0.):
+        """ Exact gradient of logp at x, shape (..., size), from one
+        batched complex-step evaluation"""
+        x = asarray(x, dtype=float)
+        z = x[..., newaxis, :] + 1j * COMPLEX_STEP * eye(self.size)
+        return self.logp(z, smooth).imag / COMPLEX_STEP
+
+    def hessian(self, x, smooth=0.):
+        """ Hessian of logp at x, from central differences of the exact
+        gradient (evaluated in one batch)"""
+        x = asarray(x, dtype=float)
+        h = HESSIAN_STEP * (1. + abs(x))
+        steps = eye(self.size) * h
+        g = self.grad(concatenate([x + steps, x - steps]), smooth)
+        H = (g[:self.size] - g[self.size:]) / (2. * h[:, newaxis])
+        return .5 * (H + H.T)
+
+
+def manufacturing_like(value, p, s):
+    pred = log(at_least(s['mu'][..., p['year_index']], 1.))
+    return normal_like(value, pred, 1. / s['s_m']**2)
+
+
+def admin_distribution_like(value, p, s):
+    i = p['year_index']
+    delta = s['delta']
+    pred = log(at_least(delta[..., i] + s['beta'] * delta[..., i+1], 1.)) + s['e_d']
+    return normal_like(value, pred, 1. / s['s_d']**2)
+
+
+def household_distribution_like(value, p, s):
+    pred = s['delta'][..., p['year_index']] * (1 - s['pi']) ** p['time_held']
+    return normal_like(value, pred, 1. / (p['survey_err'] * (1 + s['s_rb']))**2)
+
+
+def interpolate(X, p):
+    return (1 - p['w']) * X[..., p['i0']] + p['w'] * X[..., p['i1']]
+
+
+def household_stock_like(value, p, s):
+    return normal_like(value, interpolate(s['Theta'], p), 1. / p['std_err']**2)
+
+
+def coverage_like(name):
+    def like(value, p, s):
+        tau = 1. / (p['std_err'] + s['gamma'] * p['sampling_error'])**2
+        return normal_like(value, interpolate(s[name], p), tau)
+    return like
+
+
+# the observations in bednets.main, by name (without the country)
+OBSERVATIONS = {'manufactured': manufacturing_like,
+                'administrative_distribution': admin_distribution_like,
+                'household_distribution': household_distribution_like,
+                'LLIN_HH_Stock': household_stock_like,
+                'LLIN_Coverage': coverage_like('llin_coverage'),
+                'ITN_Coverage': coverage_like('itn_coverage')}
+
+
+def positive_stocks(s, tau):
+    if s['smooth'] > 0:
+        shortfall = lambda x: softplus(-x, s['smooth'])
+    else:
+        shortfall = lambda x: positive_part(-x)
+    return -(shortfall(s['Psi']).sum(axis=-1) + shortfall(s['Theta']).sum(axis=-1)
+             + shortfall(s['Omega']).sum(axis=-1))
+
+
+def proven_capacity(s, tau):
+    delta, Omega = s['delta'], s['Omega']
+    total_dist = delta[..., :-1] + .5*(Omega[..., 1:] + Omega[..., :-1])
+    max_log_d = log(at_least(running_max(total_dist), 1.))
+    amt_below_cap = -positive_part(max_log_d - log(at_least(total_dist, 1.)))
+    return normal_like(amt_below_cap, 0., tau)
+
+
+def itn_composition(s, tau):
+    frac_llin = s['Theta'] / (s['Theta'] + s['Omega'])
+    return normal_like(frac_llin[..., COMPOSITION_INDEX], COMPOSITION_TARGET, tau)
+
+
+def smooth_coverage(s, tau):
+    return normal_like(diff(log(s['itn_coverage']), axis=-1), 0., tau)
+
+
+POTENTIALS = dict(positive_stocks=positive_stocks,
+                  proven_capacity=proven_capacity,
+                  itn_composition=itn_composition,
+                  smooth_coverage=smooth_coverage)
+
+
+def for_country(country_id):
+    """ Build the log-posterior of the model for one country, from the
+    same priors and data as bednets.main, without fitting it
+
+    Parameters
+    ----------
+    country_id : int
+      index of the country in sorted(data.countries)
+    """
+    import bednets
+    from data import get_data
+    from settings import year_start, year_end
+
+    data = get_data()
+    c = sorted(data.countries)[country_id]
+    pop = data.population_for(c, year_start, year_end)
+    return Posterior(bednets.setup_model(data, c, pop)['vars'])
+
+
+def pymc_logp(model):
+    """ Log-posterior of a pymc model, -inf where it has zero
+    probability"""
+    try:
+        return model.logp
+    except (pymc.ZeroProbability, ValueError):
+        return -inf
+
+
+def check(post, n=100, scale=.1, tol=1.e-8):
+    """ Check that logp agrees with the pymc model at n random
+    parameter vectors around the current values of the stochs
+
+    Parameters
+    ----------
+    post : Posterior
+    n : int, optional
+    scale : float, optional
+      standard deviation of the random perturbations of the
+      parameter vector
+    tol : float, optional
+      largest relative difference allowed
+
+    Results
+    -------
+    returns the largest relative difference, and raises an
+    AssertionError if it is above tol (or if only one of the two
+    densities is finite); the stochs are left at their current values
+    """
+    x0 = post.vector()
+    X = x0 + scale * random.randn(n, post.size)
+    X[0] = x0
+
+    numpy_logp = post.logp(X)
+    max_diff = 0.
+    try:
+        for x, lp in zip(X, numpy_logp):
+            post.set_values(x)
+            expected = pymc_logp(post.model)
+            assert isfinite(lp) == isfinite(expected), \
+                'logp is %s, but the pymc model has %s, at %s' % (lp, expected, x)
+            if isfinite(lp):
+                rel = abs(lp - expected) / max(1., abs(expected))
+                assert rel <= tol, 'logp is %s, but the pymc model has %s, at %s' % (lp, expected, x)
+                max_diff = max(max_diff, rel)
+    finally:
+        post.set_values(x0)
+    return max_diff
+
+
+# small synthetic inputs for self_test, for two countries (one with a
+# '_' in its name, as in the observation names)
+TEST_CSVS = {
+    'pop.csv': ['Country,Year,Pop'] + ['%s,%d,%d' % (c, t, 5000 + 50*(t-1999))
+                                      for c in ['Benin', 'Cote_d_Ivoire'] for t in range(1999, 2011)],
+    'reten.csv': ['Name,Year,Retention_Rate,Follow_up_Time', 'study0,2000,0.9,1.0', 'study1,2001,0.85,1.5'],
+    'design.csv': ['ItnComplex_to_SimpleRatio,LlinComplex_to_SimpleRatio', '1.5,1.4', '1.6,1.5'],
+    'manuitns.csv': ['Country,Year,Manu_Itns', 'Benin,2004,"16,000"', 'Benin,2006,40000',
+                     'Cote_d_Ivoire,2005,20000'],
+    'adminllins_itns.csv': ['Country,Year,Program_Llins', 'Benin,2004,12800', 'Benin,2005,20000',
+                            'Cote_d_Ivoire,2006,30000'],
+    'flow_llins.csv': ['Country,Year,Mean_SvyDate,Total_Llins,Total_St', 'Benin,2005,15-Jun-08,17500,5000',
+                       'Cote_d_Ivoire,2006,15-Jun-08,25200,5000'],
+    'stock_llins.csv': ['Country,Mean_SvyDate,Survey_Year1,Survey_Year2,SvyIndex_Llins,SvyIndexLlins_se',
+                        'Benin,15-Jun-06,2006,2006.5,40000,4000', 'Cote_d_Ivoire,10-Mar-08,2008,2008.5,40000,4000'],
+    'llincc.csv': ['Country,Mean_SvyDate,Survey_Year1,Survey_Year2,Per_0Llins,Llins0_se,Sample_Size',
+                   'Benin,15-Jun-06,2006,2006.5,0.7,0.02,', 'Cote_d_Ivoire,10-Mar-08,2008,2008.5,0.7,,2000'],
+    'itncc.csv': ['Country,Mean_SvyDate,Survey_Year1,Per_0Itns,Itns0_se,Sample_Size',
+                  'Benin,15-Jun-06,2006,0.6,0.03,', 'Cote_d_Ivoire,10-Mar-08,2008,0.6,,1500'],
+    'numllins.csv': ['Country,Mean_SvyDate,Survey_Year1,Per_0Llins,Llins0_se',
+                     'Benin,15-Jun-06,2006,0.6,0.01'],
+    }
+
+# fixed empirical priors for self_test, in the form of those in emp_priors.py
+TEST_PRIORS = dict(llin_discard_rate=dict(alpha=2., beta=10.),
+                   admin_err_and_bias=dict(eps=dict(mu=0., tau=10.), sigma=dict(mu=.2, tau=100.),
+                                           beta=dict(mu=.5, tau=10.)),
+                   neg_binom=dict(eta=dict(mu=5., tau=.1), alpha=dict(alpha=2., beta=1., mu=2.)),
+                   survey_design=dict(mu=1.5, tau=10.))
+
+
+def self_test(n=20, tol=1.e-8):
+    """ Check logp against the pymc model, as check does, for the
+    models of two small synthetic countries, so that neither the input
+    csvs nor the empirical priors are needed
+
+    Results
+    -------
+    returns the largest relative difference, and raises an
+    AssertionError if it is above tol
+
+    Notes
+    -----
+    the synthetic csvs are written to a temporary directory and loaded
+    with data.set_data, and the empirical priors are replaced by
+    TEST_PRIORS; both are put back afterwards
+    """
+    import shutil
+    import tempfile
+    import data
+    import emp_priors
+    import bednets
+    from settings import year_start, year_end
+
+    path = tempfile.mkdtemp() + '/'
+    shared_data = data._data
+    fits = dict([[name, getattr(emp_priors, name)] for name in TEST_PRIORS])
+    try:
+        for fname, lines in TEST_CSVS.items():
+            f = open(path + fname, 'w')
+            f.write('\n'.join(lines) + '\n')
+            f.close()
+        data.set_data(data.Data(path))
+        for name, prior in TEST_PRIORS.items():
+            setattr(emp_priors, name, lambda prior=prior, **kwargs: prior)
+
+        max_diff = 0.
+        d = data.get_data()
+        for c in sorted(d.countries):
+            post = Posterior(bednets.setup_model(d, c, d.population_for(c, year_start, year_end))['vars'])
+            max_diff = max(max_diff, check(post, n, tol=tol))
+        return max_diff
+    finally:
+        for name, fit in fits.items():
+            setattr(emp_priors, name, fit)
+        data.set_data(shared_data)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'largest relative difference from the pymc model of synthetic data: %g' % self_test()
+        sys.exit()
+
+    post = for_country(int(sys.argv[1]))
+    print 'largest relative difference from the pymc model: %g' % check(post)
+
+    X = post.vector() + .1 * random.randn(1000, post.size)
+    t = time.time()
+    post.logp(X)
+    t_numpy = time.time() - t
+    t = time.time()
+    for x in X[:100]:
+        post.set_values(x)
+        pymc_logp(post.model)
+    t_pymc = 10. * (time.time() - t)
+    print '1000 evaluations: %.3fs with numpy, %.3fs with pymc' % (t_numpy, t_pymc)
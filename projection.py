@@ -0,0 +1,239 @@
+""" Module for projecting net stocks and coverage forward from a country
+fit, under hypothetical schedules of future distributions, without
+refitting
+
+The posterior draws of the loss rate, the coverage parameters and the
+compartments in the last year of the fit are read from the fit's trace
+database, and every draw is pushed through the compartmental dynamics
+(dynamics.project) under every scenario at once, as arrays of shape
+(draws, scenarios, years).
+
+A scenario is the number of llins distributed in each year from the
+last year of the fit on.  The distributions in the last year of the
+fit are not estimated (see summary.FLOWS), so they are part of the
+scenario; as in the fit, the distributions in the final year of a
+scenario do not affect the stocks within it.
+
+Example
+-------
+>>> draws = projection.load_draws('bednet_model_Benin_1_2010_10_01_12_00.traces')
+>>> pop = data.population_for('Benin', settings.year_end-1, settings.year_end+4)
+>>> X = projection.project(draws, [[2e6, 0, 0, 3e6, 0], [1e6, 1e6, 1e6, 1e6, 1e6]], pop)
+>>> stats = projection.bands(X[..., dynamics.ITN_COVERAGE, :])
+>>> stats['95% HPD interval'][1, 2]     # itn coverage in the third year of scenario 1
+
+or, from the command line, for the latest fit of country 1 and the
+scenarios in a csv with a Scenario column and a column for each year,
+
+$ python projection.py 1 scenarios.csv
+"""
+
+import os
+import re
+import sys
+import csv
+import glob
+
+from numpy import asarray, atleast_2d, ones, sort, newaxis, concatenate, linspace
+
+import pymc
+
+import settings
+import dynamics
+import summary
+import trace_store
+
+# the compartments reported in a projection, with their scale factors
+# (the headings are those of the same nodes in output.csv)
+PROJECTED = [['household llin stock', dynamics.LLIN_STOCK, .001],
+             ['household itn stock', dynamics.ITN_STOCK, .001],
+             ['llin coverage', dynamics.LLIN_COVERAGE, 100.],
+             ['itn coverage', dynamics.ITN_COVERAGE, 100.]]
+
+REPORTED_NAMES = [name for name, scale in summary.REPORTED]
+HEADINGS = ['Country', 'Scenario', 'Year', 'Population']
+for name, row, scale in PROJECTED:
+    j = 3 + 3*REPORTED_NAMES.index(name)
+    HEADINGS += summary.HEADINGS[j:j+3]
+
+
+def load_db(dbname):
+    """ Open the trace database of a fit, chunked or pickle"""
+    if os.path.isdir(dbname):
+        return trace_store.load(dbname)
+    return pymc.database.pickle.load(dbname)
+
+
+def load_draws(dbname, n=1000):
+    """ Load the posterior draws needed for projections from the trace
+    database of a country fit
+
+    Parameters
+    ----------
+    dbname : str
+    n : int, optional
+      number of draws to keep, evenly spaced through the joined chains
+
+    Results
+    -------
+    returns a dict of arrays, with one row for each draw: 'state', the
+    warehouse and household llin stock of each age in the last year of
+    the fit, 'Omega', the non-llin household net stock in that year,
+    and 'pi', 'eta' and 'alpha'
+    """
+    db = load_db(dbname)
+    trace = lambda name: asarray(db.trace(name, chain=None)[:], dtype=float)
+    pi = trace('Pr[net is lost]')
+    keep = linspace(0, len(pi)-1, min(n, len(pi))).astype(int)
+
+    mu = trace('llins shipped')[keep]
+    delta = trace('llins distributed')[keep]
+    Omega = trace('non-llin household net stock')[keep]
+    pi = pi[keep]
+    eta = trace('coverage parameter')[keep]
+    alpha = trace('dispersion parameter')[keep]
+
+    # the stocks do not depend on the population, only the coverage
+    # (which is not needed here)
+    X = dynamics.stock_and_flow(mu, delta, Omega, pi, eta, alpha, ones(delta.shape[-1]))
+    return dict(state=X[:, :dynamics.HOUSEHOLD_3+1, -1], Omega=Omega[:, -1],
+                pi=pi, eta=eta, alpha=alpha)
+
+
+def project(draws, distributed, pop, shipped=None, non_llin=None):
+    """ Project every compartment forward for every draw under every
+    scenario
+
+    Parameters
+    ----------
+    draws : dict
+      from load_draws
+    distributed : array, shape (S, H)
+      llins distributed in each of H years from the last year of the
+      fit on, for each of S scenarios
+    pop : array, shape (H,)
+      population in each of those years
+    shipped : array, shape (S, H), optional
+      llins shipped, defaults to the llins distributed (so the
+      warehouse stock stays at its level in the last year of the fit)
+    non_llin : array, shape (S, H), optional
+      non-llin household net stock, defaults to its level in the last
+      year of the fit for each draw
+
+    Results
+    -------
+    returns an array of shape (draws, S, 8, H), with rows indexed by
+    the constants of dynamics.py, and the first column the last year
+    of the fit
+    """
+    delta = atleast_2d(asarray(distributed, dtype=float))
+    mu = delta
+    if shipped is not None:
+        mu = atleast_2d(asarray(shipped, dtype=float))
+    if non_llin is None:
+        Omega = draws['Omega'][:, newaxis, newaxis] * ones(delta.shape[-1])
+    else:
+        Omega = atleast_2d(asarray(non_llin, dtype=float))
+
+    one_per_draw = lambda x: x[:, newaxis]
+    return dynamics.project(draws['state'][:, newaxis, :], mu, delta, Omega,
+                            one_per_draw(draws['pi']), one_per_draw(draws['eta']),
+                            one_per_draw(draws['alpha']), pop)
+
+
+def bands(x, alpha=.05):
+    """ Posterior mean and HPD interval of projected draws
+
+    Parameters
+    ----------
+    x : array, shape (draws, ...)
+      e.g. X[..., dynamics.ITN_COVERAGE, :] for X from project
+
+    Results
+    -------
+    returns a dict with keys 'mean', of shape x.shape[1:], and
+    '95% HPD interval', of shape x.shape[1:] + (2,), like node.stats()
+    """
+    x = sort(x, axis=0)
+    lower, upper = summary.hpd(x, alpha)
+    return {'mean': x.mean(axis=0),
+            '%s%s HPD interval' % (int(100*(1-alpha)), '%'): concatenate([lower[..., newaxis], upper[..., newaxis]], axis=-1)}
+
+
+def table(c, names, X, pop, year):
+    """ Build the rows of a projection csv, matching HEADINGS
+
+    Parameters
+    ----------
+    c : str
+    names : list
+      name of each scenario
+    X : array, shape (draws, S, 8, H)
+      from project
+    pop : array, shape (H,)
+    year : int
+      the first year of the projection
+    """
+    S, H = X.shape[1], X.shape[-1]
+    cols = []
+    for name, row, scale in PROJECTED:
+        stats = bands(X[..., row, :] * scale)
+        cols += [stats['mean'][..., newaxis], stats['95% HPD interval']]
+    vals = concatenate(cols, axis=-1)
+    return [[c, names[s], year + t, pop[t]] + list(vals[s, t]) for s in range(S) for t in range(H)]
+
+
+def latest_fit(c, country_id, path=None):
+    """ Trace database of the latest fit for a country, or None"""
+    fits = sorted(glob.glob((path or settings.PATH) + 'bednet_model_%s_%d_*.traces' % (c, country_id))
+                  + glob.glob((path or settings.PATH) + 'bednet_model_%s_%d_*.pickle' % (c, country_id)),
+                  key=lambda f: re.sub('\.(traces|pickle)$', '', f))
+    if fits:
+        return fits[-1]
+
+
+def load_scenarios(fname):
+    """ Read scenarios from a csv with a Scenario column and a column of
+    llins distributed for each year
+
+    Results
+    -------
+    returns (names, years, distributed), with distributed an array of
+    shape (scenarios, years)
+    """
+    f = open(fname)
+    rows = [r for r in csv.DictReader(f)]
+    f.close()
+    years = sorted([int(k) for k in rows[0] if k != 'Scenario'])
+    names = [r['Scenario'] for r in rows]
+    distributed = asarray([[float(r[str(y)]) for y in years] for r in rows])
+    return names, years, distributed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print 'usage: python projection.py country_id scenarios.csv'
+        sys.exit(1)
+
+    from data import get_data
+    data = get_data()
+    country_id = int(sys.argv[1])
+    c = sorted(data.countries)[country_id]
+
+    names, years, distributed = load_scenarios(sys.argv[2])
+    assert years == range(settings.year_end-1, settings.year_end-1+len(years)), \
+        'scenarios must give the llins distributed in every year from %d on' % (settings.year_end-1)
+
+    dbname = latest_fit(c, country_id)
+    assert dbname, 'no fit found for %s' % c
+    print 'projecting %d scenarios from %s' % (len(names), dbname)
+    pop = data.population_for(c, years[0], years[-1]+1)
+    X = project(load_draws(dbname), distributed, pop)
+
+    fname = settings.PATH + 'projections_%s.csv' % re.sub('[^A-Za-z0-9]+', '_', c)
+    f = open(fname, 'w')
+    cf = csv.writer(f, lineterminator='\n')
+    cf.writerow(HEADINGS)
+    cf.writerows(table(c, names, X, pop, years[0]))
+    f.close()
+    print 'saved projections in %s' % fname
@@ -0,0 +1,157 @@
+""" Module for storing the results of the country fits, so that many
+fits running at once can save their results without colliding
+
+Each fit writes its rows of output.csv to its own shard file,
+PATH/results/<country>_<run id>.csv, under a temporary name that is
+renamed into place when it is complete.  Nothing is ever appended to
+a shared file, so there is no need to wait for other jobs, and a
+reader never sees a partial shard.  output.csv is exported from the
+shards on demand.
+
+Example
+-------
+>>> import results
+>>> results.save('Benin', '2010_10_01_12_00', rows)
+>>> r = results.load()
+>>> r.get('Benin', 2008, 'ITN Coverage (Percent)')    # (mean, lower, upper) from the latest run
+>>> results.export_csv()                               # write PATH/output.csv
+"""
+
+import os
+import re
+import csv
+import time
+
+import settings
+import summary
+
+# name of each reported quantity, in column order (the columns for
+# each are its mean, lower and upper bound)
+QUANTITIES = summary.HEADINGS[3::3]
+
+
+def results_dir(path=None):
+    return (path or settings.PATH) + 'results/'
+
+
+def new_run_id():
+    """ Return an id for a fit, which sorts in the order the fits were
+    started"""
+    return '%s_%d' % (time.strftime('%Y_%m_%d_%H_%M_%S'), os.getpid())
+
+
+def save(c, run_id, rows, path=None):
+    """ Save the output.csv rows from one fit
+
+    Parameters
+    ----------
+    c : str
+      country name
+    run_id : str
+      id of this fit, e.g. from new_run_id
+    rows : list of lists
+      rows matching summary.HEADINGS, as returned by
+      summary.output_table
+    path : str, optional
+      defaults to settings.PATH
+    """
+    dir = results_dir(path)
+    try:
+        os.makedirs(dir)
+    except OSError:  # another job created it first
+        pass
+
+    fname = '%s%s_%s.csv' % (dir, re.sub('[^A-Za-z0-9]+', '_', c), run_id)
+    tmp = '%s.tmp_%d' % (fname, os.getpid())
+    f = open(tmp, 'w')
+    cf = csv.writer(f, lineterminator='\n')
+    cf.writerow(['Run'] + summary.HEADINGS)
+    for row in rows:
+        cf.writerow([run_id, row[0], '%d' % row[1], '%d' % row[2]] + ['%.2f' % x for x in row[3:]])
+    f.close()
+    os.rename(tmp, fname)
+
+
+class Results:
+    """ The results of every saved fit, indexed by country, year,
+    quantity and run id"""
+    def __init__(self, rows):
+        self.rows = rows
+        self.index = {}
+        self.run_ids = {}
+        for d in rows:
+            c = d['Country']
+            year = int(d['Year'])
+            for q in QUANTITIES:
+                j = summary.HEADINGS.index(q)
+                self.index[(c, year, q, d['Run'])] = tuple([float(d[k]) for k in summary.HEADINGS[j:j+3]])
+            self.run_ids.setdefault(c, set()).add(d['Run'])
+
+    def countries(self):
+        return sorted(self.run_ids.keys())
+
+    def runs(self, c):
+        """ Return the ids of the fits for country c, oldest first"""
+        return sorted(self.run_ids.get(c, []))
+
+    def get(self, c, year, quantity, run_id=None):
+        """ Return (mean, lower, upper) for a quantity, from the latest
+        fit for country c unless run_id is given"""
+        if run_id is None:
+            run_id = self.runs(c)[-1]
+        return self.index[(c, year, quantity, run_id)]
+
+    def table(self, all_runs=False):
+        """ Return rows matching summary.HEADINGS (as strings), for the
+        latest fit of each country, or for every fit if all_runs is
+        True"""
+        latest = dict([[c, self.runs(c)[-1]] for c in self.countries()])
+        tab = []
+        for d in sorted(self.rows, key=lambda d: (d['Country'], d['Run'], int(d['Year']))):
+            if all_runs or d['Run'] == latest[d['Country']]:
+                tab.append([d[k] for k in summary.HEADINGS])
+        return tab
+
+
+def load(path=None):
+    """ Load the results of every saved fit
+
+    Results
+    -------
+    returns a Results instance
+    """
+    dir = results_dir(path)
+    rows = []
+    if os.path.exists(dir):
+        for fname in sorted(os.listdir(dir)):
+            if not fname.endswith('.csv'):
+                continue
+            f = open(dir + fname)
+            rows += [d for d in csv.DictReader(f)]
+            f.close()
+    return Results(rows)
+
+
+def export_csv(fname=None, path=None, all_runs=False):
+    """ Write the saved results as a single csv with the columns of
+    output.csv
+
+    Parameters
+    ----------
+    fname : str, optional
+      defaults to PATH + settings.CSV_NAME
+    path : str, optional
+      directory of the results, defaults to settings.PATH
+    all_runs : bool, optional
+      include every fit of each country, not just the latest
+    """
+    if fname is None:
+        fname = (path or settings.PATH) + settings.CSV_NAME
+
+    tmp = '%s.tmp_%d' % (fname, os.getpid())
+    f = open(tmp, 'w')
+    cf = csv.writer(f, lineterminator='\n')
+    cf.writerow(summary.HEADINGS)
+    cf.writerows(load(path).table(all_runs))
+    f.close()
+    os.rename(tmp, fname)
@@ -13,63 +13,110 @@ notes on how to do this:
 
     $ python run_all.py
 
+   or, to run every job on this machine instead of the cluster,
+   using at most 8 cores at a time::
+
+    $ python run_all.py --local -j 8
+
 """
 
 import optparse
 import os
-import subprocess
 
 import settings
+import jobs
 
-def run_all(fit_empirical_priors=False):
+def run_all(fit_empirical_priors=False, backend='qsub', processes=None, no_plots=False, joint=False):
     """ Enqueues all jobs necessary to fit model
 
+    Parameters
+    ----------
+    fit_empirical_priors : bool, optional
+      refit all the empirical priors before fitting the countries, not
+      just those whose inputs have changed
+    backend : str, optional
+      'qsub' to submit jobs to the cluster queue, or 'local' to run
+      them as a pool of processes on this machine
+    processes : int, optional
+      maximum number of jobs to run at once with the local backend,
+      and of empirical priors to fit at once with either backend,
+      defaults to the number of cores
+    no_plots : bool, optional
+      pass --no-plots to each job
+    joint : bool, optional
+      fit all countries jointly in a single job (see joint.py),
+      instead of one job for each country
+
+    Results
+    -------
+    returns a dict mapping job name to status ('submitted' for qsub;
+    'done', 'failed' or 'skipped' for local)
+
     Example
     -------
     >>> import run_all
     >>> run_all.run_all()
+    >>> run_all.run_all(backend='local', processes=64)
     """
-
-    if fit_empirical_priors:
-        # fit empirical priors (by pooling data from all regions)
-        import emp_priors, graphics
-
-        emp_priors.admin_err_and_bias(recompute=True)
-        emp_priors.llin_discard_rate(recompute=True)
-        emp_priors.neg_binom(recompute=True)
-        emp_priors.survey_design(recompute=True)
-    
-        graphics.plot_neg_binom_fits()
+    if backend == 'local':
+        executor = jobs.LocalExecutor(processes)
+    else:
+        executor = jobs.EXECUTORS[backend]()
+
+    # fit empirical priors (by pooling data from all regions) before
+    # any country fits are started, since they all use them; only the
+    # priors that are missing or stale are fit, unless
+    # fit_empirical_priors, and the priors that do not depend on each
+    # other are fit at once, on this machine
+    import emp_priors
+
+    status = emp_priors.fit_all(recompute=fit_empirical_priors, processes=processes, no_plots=no_plots)
+    if [s for s in status.values() if s != 'done']:
+        print 'failed to fit the empirical priors, no countries fit'
+        return status
         
+    opts = []
+    if no_plots:
+        opts = ['--no-plots']
+
+    dir = settings.PATH
+    if joint:
+        executor.submit('ITNjoint', ['bednets.py'] + opts + ['joint'],
+                        '%s/joint-stdout.txt' % dir, '%s/joint-stderr.txt' % dir)
+        return executor.wait()
 
     #fit each region individually for this model
-    from data import Data
-    data = Data()
+    from data import get_data
+    data = get_data()
     post_names = []
-    dir = settings.PATH
     for ii, r in enumerate(sorted(data.countries)):
         o = '%s/%s-stdout.txt' % (dir, r[0:3])
         e = '%s/%s-stderr.txt' % (dir, r[0:3])
         name_str = 'ITN%s-%d' % (r[0:3].strip(), ii)
         post_names.append(name_str)
-        call_str = 'qsub -cwd -o %s -e %s ' % (o,e) \
-                   + '-N %s ' % name_str \
-                   + 'fit.sh %d' % ii
-        subprocess.call(call_str, shell=True)
+        executor.submit(name_str, ['bednets.py'] + opts + ['%d' % ii], o, e)
         
     # TODO: after all posteriors have finished running, notify me via email
-    hold_str = '-hold_jid %s ' % ','.join(post_names)
     o = '%s/summarize.stdout' % dir
     e = '%s/summarize.stderr' % dir
-    call_str = 'qsub -cwd -o %s -e %s ' % (o,e) \
-               + hold_str \
-               + '-N netsdone ' \
-               + 'fit.sh summarize'
-    subprocess.call(call_str, shell=True)
+    executor.submit('netsdone', ['bednets.py'] + opts + ['summarize'], o, e,
+                    depends_on=post_names)
+
+    return executor.wait()
 
 def main():
     usage = 'usage: %prog [options]'
     parser = optparse.OptionParser(usage)
+    parser.add_option('--local', action='store_const', const='local', dest='backend', default='qsub',
+                      help='run jobs as processes on this machine, instead of with qsub')
+    parser.add_option('-j', '--processes', type='int', dest='processes', default=None,
+                      help='maximum number of jobs to run at once with --local (default: number of cores)')
+    parser.add_option('--fit-priors', action='store_true', dest='fit_priors', default=False,
+                      help='refit all the empirical priors, not just those whose inputs changed, before fitting each country')
+    parser.add_option('--no-plots', action='store_true', dest='no_plots', default=False,
+                      help='skip all graphics, so matplotlib is never imported')
+    parser.add_option('--joint', action='store_true', dest='joint', default=False,
+                      help='fit all countries jointly in a single job, instead of one job for each')
     (options, args) = parser.parse_args()
 
     if len(args) != 0:
@@ -92,7 +139,12 @@ def main():
     except IOError, e:
         parser.error('failed to create data/output directory: %s' % e)
 
-    run_all()
+    if options.no_plots:
+        settings.PLOTTING = False
+
+    status = run_all(options.fit_priors, options.backend, options.processes, options.no_plots, options.joint)
+    if [s for s in status.values() if s in ['failed', 'skipped']]:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
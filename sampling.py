@@ -0,0 +1,457 @@
+""" Module for running the MCMC for the stock-and-flow model, including
+running several independent chains in parallel processes, choosing
+the run length adaptively, and checkpointing long runs so that they
+can be resumed
+"""
+
+import os
+import sys
+import copy
+import traceback
+import cPickle
+
+import numpy
+import pymc
+
+import settings
+import diagnostics
+import trace_store
+import summary
+import checkpoint as checkpoints
+import step_methods
+
+
+def sample(mc, names, iter, burn, thin, chains=1, adaptive=None, summaries=None, checkpoint=None):
+    """ Sample from a model, either for a fixed number of iterations or
+    adaptively until the stochs in names have enough effective samples
+
+    Parameters
+    ----------
+    mc : pymc MCMC
+    names : list of str
+      names of the traced stochs to monitor
+    iter, burn, thin : int
+      samples to keep, burn-in and thinning; when sampling adaptively,
+      iter*thin + burn is the maximum number of iterations
+    chains : int, optional
+      number of chains the samples are split between (this is one of
+      them), so each keeps iter/chains samples, or aims for
+      settings.TARGET_ESS/chains effective samples
+    adaptive : bool, optional
+      defaults to settings.ADAPTIVE_SAMPLING
+    summaries : summary.Summaries, optional
+      streaming summaries attached to mc, which are reset at the end
+      of the burn-in
+    checkpoint : bool, optional
+      save a checkpoint after every batch, and continue from the
+      checkpoint of mc's database if there is one (see checkpoint.py);
+      defaults to settings.CHECKPOINT
+
+    Notes
+    -----
+    the proposals of block steps are frozen at the end of the burn-in
+    (see step_methods.py)
+
+    Example
+    -------
+    >>> mc = MCMC(vars)
+    >>> sampling.sample(mc, ['itn coverage'], 10000, 250000, 2000)
+    """
+    if adaptive is None:
+        adaptive = settings.ADAPTIVE_SAMPLING
+    if checkpoint is None:
+        checkpoint = settings.CHECKPOINT
+    iter = int(numpy.ceil(float(iter) / chains))
+    max_iter = iter*thin + burn
+
+    if adaptive:
+        return sample_adaptively(mc, names, float(settings.TARGET_ESS) / chains, max_iter,
+                                 batch=max(1000, max_iter / 200), summaries=summaries,
+                                 checkpoint=checkpoint)
+    else:
+        return sample_fixed(mc, max_iter, burn, thin, batch=max(1000, max_iter / 200),
+                            summaries=summaries, checkpoint=checkpoint)
+
+
+def sample_batch(mc, iter, burn, thin):
+    """ Call mc.sample, and raise KeyboardInterrupt if the sampling was
+    interrupted before iter iterations"""
+    try:
+        mc.sample(iter, burn, thin)
+    except KeyError:
+        pass
+    if mc._current_iter < iter:
+        raise KeyboardInterrupt, 'sampling interrupted after %d of %d iterations' % (mc._current_iter, iter)
+
+
+def sample_fixed(mc, iter, burn, thin, batch, summaries=None, checkpoint=False):
+    """ Sample for a fixed number of iterations, in batches so that a
+    checkpoint can be saved after each one
+
+    Parameters
+    ----------
+    mc : pymc MCMC
+    iter, burn, thin : int
+      total iterations (including burn-in), burn-in and thinning, as
+      for mc.sample
+    batch : int
+      iterations per batch (rounded down to a multiple of thin)
+    summaries : summary.Summaries, optional
+      streaming summaries attached to mc
+    checkpoint : bool, optional
+      save a checkpoint after every batch, and resume from an
+      existing one
+
+    Results
+    -------
+    returns a dict with the burn, thin and iter (total iterations)
+    """
+    db = mc.db
+    progress = dict(iters=0, burn_chains=None)
+    if checkpoint:
+        progress = checkpoints.restore(mc, summaries) or progress
+
+    batch = max(thin, batch - batch % thin)
+    while progress['iters'] < iter:
+        if progress['iters'] < burn:
+            # nothing is tallied during the burn-in
+            n = min(batch, burn - progress['iters'])
+            sample_batch(mc, n, n, 1)
+        else:
+            if progress['burn_chains'] is None:
+                progress['burn_chains'] = db.chains
+                step_methods.freeze(mc)
+            n = min(batch, iter - progress['iters'])
+            sample_batch(mc, n, 0, thin)
+        progress['iters'] += n
+        if checkpoint:
+            checkpoints.save(mc, progress, summaries)
+
+    if progress['burn_chains'] is not None:
+        join_chains(db, progress['burn_chains'])
+        progress['burn_chains'] = None
+        if checkpoint:
+            checkpoints.save(mc, progress, summaries)
+    return dict(burn=burn, thin=thin, iter=iter)
+
+
+def sample_adaptively(mc, names, target_ess, max_iter, batch, r_hat=1.05, samples_per_batch=1000,
+                      summaries=None, checkpoint=False):
+    """ Sample until the stochs in names have target_ess effective
+    samples, choosing the burn-in and thinning from running
+    convergence diagnostics
+
+    Parameters
+    ----------
+    mc : pymc MCMC
+    names : list of str
+      names of the traced stochs to monitor
+    target_ess : float
+      effective sample size to reach for every element of every stoch
+    max_iter : int
+      maximum number of iterations, including burn-in
+    batch : int
+      iterations per burn-in batch
+    r_hat : float, optional
+      burn-in ends when R-hat between the last two batches is below
+      this for every monitored element
+    samples_per_batch : int, optional
+      samples kept from each burn-in batch, for the diagnostics
+    summaries : summary.Summaries, optional
+      streaming summaries attached to mc, which are reset at the end
+      of the burn-in
+    checkpoint : bool, optional
+      save a checkpoint after every batch, and resume from an
+      existing one
+
+    Results
+    -------
+    returns a dict with the burn, thin, iter (total iterations) and
+    ess (the smallest effective sample size reached)
+
+    Notes
+    -----
+    each call to mc.sample adds a chain to the database, so the
+    burn-in batches are dropped and the remaining batches joined into
+    a single chain at the end
+    """
+    db = mc.db
+    p = dict(stage='burn-in', iters=0)
+    if checkpoint:
+        p = checkpoints.restore(mc, summaries) or p
+
+    # burn-in: sample until the last two batches look like draws from
+    # the same distribution
+    batch_thin = max(1, batch / samples_per_batch)
+    batch = max(batch_thin, batch - batch % batch_thin)
+    while p['stage'] == 'burn-in':
+        sample_batch(mc, batch, 0, batch_thin)
+        p['iters'] += batch
+        if db.chains >= 2:
+            R = max([diagnostics.gelman_rubin([db.trace(n, -2)[:], db.trace(n, -1)[:]]).max()
+                     for n in names])
+            print 'burn-in: %d iterations, R-hat %.3f' % (p['iters'], R)
+            if R < r_hat or p['iters'] >= max_iter / 2:
+                end_burn_in(db, p, names, batch, target_ess, max_iter, summaries)
+                step_methods.freeze(mc)
+        if checkpoint:
+            checkpoints.save(mc, p, summaries)
+
+    # sample until every monitored stoch has reached the target
+    while p['stage'] == 'sampling':
+        n = int(1.1 * (target_ess - p['ess']) * p['iter_per_ess'])
+        n = min(max(n, 10*p['thin']), max_iter - p['iters'])
+        n = max(p['thin'], n - n % p['thin'])
+        sample_batch(mc, n, 0, p['thin'])
+        p['iters'] += n
+
+        p['ess'] = min([diagnostics.effective_sample_size(
+                    [numpy.concatenate([db.trace(name, k)[:] for k in range(p['burn_chains'], db.chains)])]).min()
+                        for name in names])
+        print 'sampling: %d iterations (thin %d), effective sample size %.0f of %.0f' % (
+            p['iters'], p['thin'], p['ess'], target_ess)
+        if p['ess'] >= target_ess:
+            p['stage'] = 'joining'
+        elif p['iters'] >= max_iter:
+            print 'stopped at maximum of %d iterations before reaching target' % max_iter
+            p['stage'] = 'joining'
+        else:
+            p['iter_per_ess'] = (p['iters'] - p['burn']) / max(p['ess'], 1.)
+        if checkpoint:
+            checkpoints.save(mc, p, summaries)
+
+    if p['stage'] == 'joining':
+        join_chains(db, p['burn_chains'])
+        p['stage'] = 'done'
+        if checkpoint:
+            checkpoints.save(mc, p, summaries)
+    return dict(burn=p['burn'], thin=p['thin'], iter=p['iters'], ess=p['ess'])
+
+
+def end_burn_in(db, p, names, batch, target_ess, max_iter, summaries=None):
+    """ Record the end of the burn-in in the progress dict p of
+    sample_adaptively, and choose the thinning"""
+    p.update(stage='sampling', burn=p['iters'], burn_chains=db.chains, ess=0.)
+    if summaries:
+        summaries.reset()
+
+    # thin so that successive samples are roughly independent, based on
+    # the autocorrelation in the last two batches (but keep at least
+    # target_ess samples if the maximum iterations are reached)
+    ess = min([diagnostics.effective_sample_size([db.trace(n, -2)[:], db.trace(n, -1)[:]]).min()
+               for n in names])
+    p['iter_per_ess'] = 2. * batch / max(ess, 1.)
+    p['thin'] = max(1, min(int(p['iter_per_ess']), int((max_iter - p['iters']) / target_ess)))
+    if p['iters'] >= max_iter:
+        p['stage'] = 'joining'
+
+
+def join_chains(db, first=0):
+    """ Replace the chains of a pickle or chunked database with a single
+    chain, joining chains first, first+1, ... and dropping the chains
+    before first"""
+    if isinstance(db, trace_store.Database):
+        db.join_chains(first)
+        return
+
+    for name, trace in db._traces.items():
+        kept = [trace._trace[k] for k in sorted(trace._trace.keys()) if k >= first]
+        trace._trace = {0: numpy.concatenate(kept)}
+    db.trace_names = db.trace_names[-1:]
+    db.chains = 1
+
+    container = dict([[name, trace._trace] for name, trace in db._traces.items()])
+    container['_state_'] = getattr(db, '_state_', {})
+    save_pickle(container, db.filename)
+
+
+def disperse(mc, scale=.5, tries=10):
+    """ Move the stochs of a model part of the way from their current
+    values towards a random draw from their priors, to give a
+    dispersed starting point for an MCMC chain
+
+    Parameters
+    ----------
+    mc : pymc Model
+    scale : float, optional
+      fraction of the way to move towards the prior draw; this is
+      halved until the model has nonzero probability at the new
+      starting point
+    tries : int, optional
+      number of times to halve scale before giving up and keeping the
+      current values
+
+    Notes
+    -----
+    moving part of the way towards a draw (instead of jumping to it)
+    keeps each stoch inside its support, since all of the supports in
+    this model are convex
+    """
+    stochs = list(mc.stochastics)
+    start = [copy.copy(s.value) for s in stochs]
+    for i in range(tries):
+        try:
+            for s, x0 in zip(stochs, start):
+                s.random()
+                s.value = x0 + scale*(s.value - x0)
+            mc.logp
+            return
+        except pymc.ZeroProbability:
+            scale *= .5
+
+    for s, x0 in zip(stochs, start):
+        s.value = x0
+
+
+def run_chains(make_mcmc, sample_chain, dbname, chains, summaries=None):
+    """ Run independent MCMC chains in parallel processes from
+    dispersed starting points, and merge their traces
+
+    Parameters
+    ----------
+    make_mcmc : function
+      make_mcmc(dbname) must return a pymc MCMC for the model, with its
+      step methods set up, that saves its traces in a pickle (or
+      chunked) database called dbname
+    sample_chain : function
+      sample_chain(mc) draws the samples for one chain, e.g. with
+      sampling.sample(mc, names, iter, burn, thin, chains)
+    dbname : str
+      file name for the merged pickle database
+    chains : int
+      number of chains (and processes)
+    summaries : summary.Summaries, optional
+      streaming summaries attached to the MCMC by make_mcmc; each
+      process saves its summaries, which are merged into this
+
+    Results
+    -------
+    returns the merged pymc Database, with each process's trace as a
+    separate chain
+
+    Example
+    -------
+    >>> db = sampling.run_chains(lambda dbname: MCMC(vars, db='pickle', dbname=dbname),
+    ...                          lambda mc: mc.sample(2500*2000 + 250000, 250000, 2000),
+    ...                          'bednet_model.pickle', 4)
+    >>> mc = MCMC(vars, db=db)
+    >>> mc.trace('itn coverage', chain=None)[:]   # samples from all chains
+
+    Notes
+    -----
+    the chains are started with os.fork, so the model (and any MAP
+    fit already done) is shared with every chain without rebuilding
+    it; where fork is not available, the chains are run one after
+    another
+
+    a chain with a checkpoint (from a run that was killed) continues
+    from it instead of starting again, so make_mcmc should open an
+    existing database with checkpoint.database
+    """
+    chain_names = ['%s.chain%d' % (dbname, k) for k in range(chains)]
+
+    if not hasattr(os, 'fork'):
+        for k in range(chains):
+            run_chain(make_mcmc, sample_chain, chain_names[k], summaries)
+        if summaries:
+            merge_summaries(summaries, chain_names)
+        db = merge_chains(chain_names, dbname)
+        for fname in chain_names:
+            checkpoints.remove(fname)
+        return db
+
+    pids = []
+    for k in range(chains):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                try:
+                    numpy.random.seed()  # otherwise every chain would draw the same numbers
+                    run_chain(make_mcmc, sample_chain, chain_names[k], summaries)
+                    status = 0
+                except:
+                    traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        pids.append(pid)
+
+    failed = []
+    for k, pid in enumerate(pids):
+        pid, status = os.waitpid(pid, 0)
+        if status != 0:
+            failed.append(k)
+    if failed:
+        raise RuntimeError, 'MCMC failed for chain(s) %s' % ', '.join([str(k) for k in failed])
+
+    if summaries:
+        merge_summaries(summaries, chain_names)
+    db = merge_chains(chain_names, dbname)
+    for fname in chain_names:
+        checkpoints.remove(fname)
+    return db
+
+
+def run_chain(make_mcmc, sample_chain, dbname, summaries=None):
+    mc = make_mcmc(dbname)
+    if summaries:
+        summaries.reset()
+    if not checkpoints.exists(dbname):  # otherwise sample_chain resumes from the checkpoint
+        disperse(mc)
+    sample_chain(mc)
+    mc.db.commit()
+    if summaries:
+        summaries.save(dbname + '.summary')
+
+
+def merge_summaries(summaries, fnames):
+    """ Replace summaries with the merged summaries saved by each
+    chain, deleting the saved files"""
+    summaries.reset()
+    for fname in fnames:
+        summaries.merge(summary.load(fname + '.summary'))
+        os.remove(fname + '.summary')
+
+
+def merge_chains(fnames, dbname):
+    """ Combine the chains in several pickle (or chunked) databases into
+    a single database, deleting the originals
+
+    Results
+    -------
+    returns the merged database, loaded with pymc.database.pickle.load
+    (or trace_store.load)
+    """
+    if os.path.isdir(fnames[0]):
+        return trace_store.merge(fnames, dbname)
+
+    container = {}
+    chains = 0
+    for fname in fnames:
+        f = open(fname, 'rb')
+        db = cPickle.load(f)
+        f.close()
+
+        state = db.pop('_state_', {})
+        for name, traces in db.items():
+            for k, chain in enumerate(sorted(traces.keys())):
+                container.setdefault(name, {})[chains + k] = traces[chain]
+        chains += max([len(traces) for traces in db.values()] + [0])
+    container['_state_'] = state
+    save_pickle(container, dbname)
+
+    for fname in fnames:
+        os.remove(fname)
+
+    return pymc.database.pickle.load(dbname)
+
+
+def save_pickle(container, fname):
+    """ Write a dict of {name: {chain: trace}} in the format of the
+    pymc pickle backend"""
+    f = open(fname, 'wb')
+    cPickle.dump(container, f)
+    f.close()
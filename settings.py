@@ -12,16 +12,67 @@ TESTING = False
 NUM_SAMPLES = 10000
 THIN = 2000
 BURN = 250000
+
+# with ADAPTIVE_SAMPLING, burn-in and thinning are chosen from running
+# convergence diagnostics, and sampling stops once every reported
+# quantity has TARGET_ESS effective samples; NUM_SAMPLES*THIN + BURN
+# is then only the maximum number of iterations
+ADAPTIVE_SAMPLING = True
+TARGET_ESS = 1000
+# number of independent MCMC chains to run in parallel processes for
+# each country; NUM_SAMPLES is split between them, and with 2 or more
+# chains R-hat is reported for the key quantities
+CHAINS = 1
+# pymc database for the traces of each country fit: 'chunked' appends
+# samples to PATH/bednet_model_*.traces/ as they are drawn (see
+# trace_store.py), 'pickle' keeps them in memory until the end
+TRACE_BACKEND = 'chunked'
+# save a checkpoint of the MCMC after every batch of samples, so that
+# a killed fit can be continued with bednets.py --resume country_id
+CHECKPOINT = True
+# start each country fit from the MCMC state and proposal tuning saved
+# by its last fit (see warm_start.py), skipping the MAP initialization
+# and using WARM_START_BURN burn-in iterations instead of BURN
+WARM_START = True
+WARM_START_BURN = 25000
+
 #METHOD = 'NormApprox'
 METHOD = 'MCMC'
 
+# initial values for the MCMC: 'lbfgs' maximizes the whole posterior
+# with exact gradients (see map_fit.py), 'powell' fits subsets of the
+# model with pymc's MAP and fmin_powell
+MAP_METHOD = 'lbfgs'
+
+# stochs updated jointly by adaptive metropolis steps, with a proposal
+# covariance learned during the burn-in and frozen after it (see
+# step_methods.py); the others are updated one at a time.  the
+# covariance is first estimated after ADAPT_DELAY iterations, and then
+# updated every ADAPT_INTERVAL iterations
+BLOCKS = [['log(llins distributed)', 'log(llins shipped)', 'log(non-llin household net stock)'],
+          ['Pr[net is lost]', 'coverage parameter', 'dispersion parameter']]
+ADAPT_DELAY = 1000
+ADAPT_INTERVAL = 500
+
+# cache parsed input csvs in PATH/cache/, keyed by a hash of their contents
+DATA_CACHE = True
+
+# megabytes of traces explore.py keeps in memory when summarizing fits
+EXPLORE_CACHE_SIZE = 1000
+
 # global model parameters
 year_start = 1999
 year_end = 2013
 
-# matplotlib backend setup
-import matplotlib
-matplotlib.use("AGG") 
+# set PLOTTING to False (here, in local_settings.py, or by passing
+# --no-plots on the command line) to fit models without importing
+# matplotlib; graphics are then skipped.  It has to be decided before
+# pymc is first imported (see the end of this file)
+import sys
+PLOTTING = '--no-plots' not in sys.argv
+
+# matplotlib backend
+MPL_BACKEND = 'AGG'
 
 # windows and linux have different ideas about how to interpret this
 DPI=300
@@ -32,3 +83,14 @@ try:
     from local_settings import *
 except:
     pass
+
+# pymc loads pyplot through its plotting module, pymc.Matplot, as soon
+# as it is imported, so the backend is set in the environment (which
+# does not import matplotlib) before any module imports pymc; without
+# plotting, pymc.Matplot is marked missing, and pymc leaves it out,
+# along with its own convergence diagnostics (the model uses
+# diagnostics.py instead)
+import os
+os.environ.setdefault('MPLBACKEND', MPL_BACKEND)
+if not PLOTTING:
+    sys.modules.setdefault('pymc.Matplot', None)
@@ -0,0 +1,193 @@
+""" Module for the step methods of the country MCMC
+
+The log stocks (llins shipped, llins distributed and non-llin net
+stock in every year) are strongly correlated, and so are the loss
+rate and the coverage parameters, which one-at-a-time Metropolis
+steps explore very slowly.  Each block of stochs in settings.BLOCKS is
+instead updated jointly, with a multivariate normal proposal whose
+covariance is learned from the chain (adaptive Metropolis, Haario et
+al. 2001).
+
+The covariance is learned during the burn-in: it is first estimated
+after settings.ADAPT_DELAY iterations, and updated every
+settings.ADAPT_INTERVAL iterations after that, when the proposal is
+also scaled up or down towards an acceptance rate of
+TARGET_ACCEPTANCE.  At the end of the
+burn-in it is frozen (see sampling.py), so the samples that are kept
+come from a Markov chain with a fixed transition kernel.
+
+Example
+-------
+>>> mc = MCMC(vars)
+>>> step_methods.use_blocks(mc, settings.BLOCKS)
+>>> mc.sample(10000)
+>>> step_methods.freeze(mc)
+>>> mc.sample(100000, thin=100)
+"""
+
+from numpy import asarray, ix_, concatenate, arange, log, exp, random, dot, maximum
+from numpy.linalg import cholesky, eigh
+
+import pymc
+
+import settings
+
+# acceptance rate the proposals are scaled towards while adapting,
+# optimal for a normal target in many dimensions (Roberts et al. 1997)
+TARGET_ACCEPTANCE = .234
+
+
+class BlockMetropolis(pymc.AdaptiveMetropolis):
+    """ Adaptive Metropolis step for a block of stochs, whose proposal
+    covariance can be frozen
+
+    Parameters
+    ----------
+    stochastic : list of stochs
+    cov : array, optional
+      initial proposal covariance, e.g. from initial_cov; defaults to
+      pymc's guess from the current values
+    delay, interval : int, optional
+      iterations before the covariance is first estimated, and between
+      updates; default to settings.ADAPT_DELAY and
+      settings.ADAPT_INTERVAL
+    """
+    def __init__(self, stochastic, cov=None, delay=None, interval=None, verbose=-1):
+        if delay is None:
+            delay = settings.ADAPT_DELAY
+        if interval is None:
+            interval = settings.ADAPT_INTERVAL
+        self.scale = 1.
+        pymc.AdaptiveMetropolis.__init__(self, stochastic, cov=cov, delay=delay, interval=interval,
+                                         verbose=verbose)
+        self._id = 'BlockMetropolis_' + '_'.join([s.__name__ for s in self.stochastics])
+        self.frozen = False
+
+        # chain_mean is needed to continue the covariance estimate
+        # after a checkpoint (pymc does not save it)
+        self._state += ['chain_mean', 'scale', 'frozen']
+
+    def updateproposal_sd(self):
+        self.proposal_sd = self.scale * cholesky(self.C)
+
+    def update_cov(self):
+        """ Update the covariance from the samples since the last update,
+        and the scale of the proposal from their acceptance rate"""
+        rate = float(self.accepted) / max(1, self.accepted + self.rejected)
+        self.scale *= exp(rate - TARGET_ACCEPTANCE)
+        pymc.AdaptiveMetropolis.update_cov(self)
+
+    def step(self):
+        if not self.frozen:
+            return pymc.AdaptiveMetropolis.step(self)
+
+        # a plain metropolis step with the frozen proposal
+        logp = self.logp_plus_loglike
+        self.propose()
+        try:
+            accept = log(random.random()) < self.logp_plus_loglike - logp
+        except pymc.ZeroProbability:
+            accept = False
+        if accept:
+            self.accepted += 1
+        else:
+            self.rejected += 1
+            self.reject()
+
+    def freeze(self):
+        """ Stop learning the proposal covariance"""
+        self.frozen = True
+        self._trace = []
+
+
+def use_blocks(mc, blocks, post=None, cov=None):
+    """ Update each block of stochs of mc jointly with a BlockMetropolis
+    step
+
+    Parameters
+    ----------
+    mc : pymc MCMC
+    blocks : list of lists of str
+      names of the stochs in each block, e.g. settings.BLOCKS
+    post, cov : optional
+      a posterior.Posterior for the model and the covariance of its
+      parameter vector (e.g. from map_fit.laplace), to start each
+      block from the corresponding part of it
+
+    Results
+    -------
+    returns the list of step methods
+    """
+    nodes = dict([[s.__name__, s] for s in mc.stochastics])
+    step_methods = []
+    for names in blocks:
+        stochs = [nodes[name] for name in names]
+        block_cov = None
+        if post is not None and cov is not None:
+            block_cov = initial_cov(post, cov, names)
+        mc.use_step_method(BlockMetropolis, stochs, cov=block_cov)
+        step_methods.append(mc.step_method_dict[stochs[0]][-1])
+    return step_methods
+
+
+def initial_cov(post, cov, names):
+    """ Proposal covariance for a block of stochs, from the covariance
+    of the parameter vector of post
+
+    Notes
+    -----
+    the parameter vector is on the unconstrained scale, so the
+    covariance is transformed to the scale of the stochs to first
+    order, and scaled by 2.4**2/d, the optimal scaling for a normal
+    target in d dimensions (Gelman et al. 1996)
+    """
+    x = post.vector()
+    index = concatenate([arange(post.size)[post.slices[name]] for name in names])
+
+    # derivative of each stoch with respect to its unconstrained value
+    J = []
+    for name in names:
+        v = asarray(post.value(x, name), dtype=float).ravel()
+        transform = post.transforms[name]
+        if transform == 'log':
+            J.append(v)
+        elif transform == 'logit':
+            J.append(v * (1. - v))
+        else:
+            J.append(0.*v + 1.)
+    J = concatenate(J)
+
+    C = asarray(cov)[ix_(index, index)] * J[:, None] * J[None, :]
+
+    # where the posterior is very sharply curved in some direction,
+    # round-off can leave the covariance slightly indefinite
+    w, V = eigh(C)
+    C = dot(V * maximum(w, 1.e-10 * w.max()), V.T)
+    return 2.4**2 / len(index) * C
+
+
+def freeze(mc):
+    """ Freeze the proposal covariance of every BlockMetropolis step of
+    mc, e.g. at the end of the burn-in"""
+    # pymc restores the step methods from the database state whenever
+    # sampling starts, so they are frozen there too
+    state = mc.db.getstate() or {}
+    saved = state.get('step_methods', {})
+    for methods in mc.step_method_dict.values():
+        for sm in methods:
+            if isinstance(sm, BlockMetropolis):
+                sm.freeze()
+                if sm._id in saved:
+                    saved[sm._id].update(frozen=True, _trace=[])
+    if saved:
+        mc.db.savestate(state)
+
+
+def thaw(saved):
+    """ Let the BlockMetropolis steps in saved (the step methods of a
+    database state, e.g. from the end of the last fit, where they were
+    frozen) learn their proposal covariance again, starting from the
+    saved one; the adaptation delay starts over"""
+    for id, state in saved.items():
+        if id.startswith('BlockMetropolis_') and state.get('frozen'):
+            state.update(frozen=False, _current_iter=0, _trace=[], accepted=0, rejected=0)
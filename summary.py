@@ -0,0 +1,268 @@
+""" Module for summarizing the posterior distribution of the
+stock-and-flow model while it is being sampled
+"""
+
+import cPickle
+
+from numpy import asarray, zeros, sort, sqrt, arange, minimum, concatenate, random
+
+# columns of output.csv
+HEADINGS = [
+    'Country', 'Year', 'Population',
+    'LLINs Shipped (Thousands)', 'LLINs Shipped Lower CI', 'LLINs Shipped Upper CI',
+    'LLINs Distributed (Thousands)', 'LLINs Distributed Lower CI', 'LLINs Distributed Upper CI',
+    'LLINs Not Owned Warehouse (Thousands)', 'LLINs Not Owned Lower CI', 'LLINs Not Owned Upper CI',
+    'LLINs Owned (Thousands)', 'LLINs Owned Lower CI', 'LLINs Owned Upper CI',
+    'non-LLIN ITNs Owned (Thousands)', 'non-LLIN ITNs Owned Lower CI', 'non-LLIN ITNs Owned Upper CI',
+    'ITNs Owned (Thousands)', 'ITNs Owned Lower CI', 'ITNs Owned Upper CI',
+    'LLIN Coverage (Percent)', 'LLIN Coverage Lower CI', 'LLIN Coverage Upper CI',
+    'ITN Coverage (Percent)', 'ITN Coverage Lower CI', 'ITN Coverage Upper CI',
+    ]
+
+# node name and scale factor for each mean/lower/upper triple of
+# columns in output.csv
+REPORTED = [['llins shipped', .001],
+            ['llins distributed', .001],
+            ['llin warehouse net stock', .001],
+            ['household llin stock', .001],
+            ['non-llin household net stock', .001],
+            ['household itn stock', .001],
+            ['llin coverage', 100.],
+            ['itn coverage', 100.]]
+
+# the flows (shipped and distributed) are not estimated for the final
+# year; their columns are reported as MISSING
+FLOWS = 2
+MISSING = -99
+
+# draws kept in each reservoir sample, for quantiles and HPD intervals;
+# if no more than this are tallied, the intervals are exact
+RESERVOIR_SIZE = 10000
+
+
+class Accumulator:
+    """ Running mean and variance (Welford's algorithm) and a uniform
+    reservoir sample of the draws of one node"""
+    def __init__(self, size=RESERVOIR_SIZE):
+        self.size = size
+        self.n = 0
+
+    def update(self, x):
+        x = asarray(x, dtype=float)
+        if self.n == 0:
+            self.mean = zeros(x.shape)
+            self.m2 = zeros(x.shape)
+            self.reservoir = zeros((self.size,) + x.shape)
+
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (x - self.mean)
+
+        if self.n <= self.size:
+            self.reservoir[self.n-1] = x
+        else:
+            j = random.randint(self.n)
+            if j < self.size:
+                self.reservoir[j] = x
+
+    def merge(self, other):
+        """ Combine with the accumulator of another chain, as if its
+        draws had been added to this one"""
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.__dict__.update(copy_state(other))
+            return
+
+        n = self.n + other.n
+        d = other.mean - self.mean
+        mean = self.mean + d * other.n / n
+        m2 = self.m2 + other.m2 + d**2 * self.n * other.n / n
+
+        # keep draws from each reservoir in proportion to its chain's length
+        draws = [self.draws(), other.draws()]
+        k = random.binomial(min(self.size, n), float(other.n) / n)
+        k = min(k, len(draws[1]))
+        k = max(k, min(self.size, n) - len(draws[0]))
+        kept = concatenate([random.permutation(draws[0])[:min(self.size, n) - k],
+                            random.permutation(draws[1])[:k]])
+
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.reservoir = zeros((self.size,) + mean.shape)
+        self.reservoir[:len(kept)] = kept
+
+    def draws(self):
+        return self.reservoir[:min(self.n, self.size)]
+
+    def stats(self, alpha=.05):
+        """ Return a dict of posterior statistics, with the same keys as
+        the stats method of a pymc node"""
+        x = sort(self.draws(), axis=0)
+        lower, upper = hpd(x, alpha)
+        n = len(x)
+        return {'n': self.n,
+                'mean': self.mean.copy(),
+                'standard deviation': sqrt(self.m2 / max(self.n-1, 1)),
+                '%s%s HPD interval' % (int(100*(1-alpha)), '%'): asarray([lower, upper]).T,
+                'quantiles': dict([[q, x[minimum(int(q/100.*n), n-1)]] for q in [2.5, 25, 50, 75, 97.5]])}
+
+
+def copy_state(acc):
+    state = dict(acc.__dict__)
+    for k in ['mean', 'm2', 'reservoir']:
+        state[k] = state[k].copy()
+    return state
+
+
+def hpd(x, alpha=.05):
+    """ Highest posterior density interval of each column of x
+
+    Parameters
+    ----------
+    x : array, shape (n, ...)
+      draws, sorted along the first axis
+    alpha : float, optional
+      the interval contains 1-alpha of the draws
+
+    Results
+    -------
+    returns (lower, upper), arrays with the shape of x[0]
+
+    Notes
+    -----
+    all columns are done at once, by finding the narrowest window of
+    sorted draws for every column in a single pass
+    """
+    n = len(x)
+    if n == 0:
+        return zeros(x.shape[1:]), zeros(x.shape[1:])
+    k = min(int(round((1-alpha)*n)), n-1)
+    width = x[k:] - x[:n-k]
+    i = width.argmin(axis=0)
+    cols = tuple([arange(d).reshape([-1] + [1]*(x.ndim-2-j)) for j, d in enumerate(x.shape[1:])])
+    return x[(i,) + cols], x[(i+k,) + cols]
+
+
+def trace_stats(trace, alpha=.05):
+    """ Mean and HPD interval of every column of a trace, from a single
+    sort of the whole (draws x years) array
+
+    Results
+    -------
+    returns a dict with the 'mean' and '95% HPD interval' keys of
+    node.stats()
+    """
+    x = sort(asarray(trace, dtype=float), axis=0)
+    lower, upper = hpd(x, alpha)
+    return {'mean': x.mean(axis=0),
+            '%s%s HPD interval' % (int(100*(1-alpha)), '%'): asarray([lower, upper]).T}
+
+
+def output_table(c, pop, stats, year_start):
+    """ Build the rows of output.csv for one country
+
+    Parameters
+    ----------
+    c : str
+      country name
+    pop : array, shape (T,)
+      population for each year
+    stats : dict
+      maps the name of each node in REPORTED to its stats, e.g. from
+      Summaries.stats or trace_stats
+    year_start : int
+
+    Results
+    -------
+    returns a list of rows [country, year, population, value, ...],
+    one for each year, matching HEADINGS
+
+    Example
+    -------
+    >>> stats = dict([[name, summary.trace_stats(db.trace(name, None)[:])] for name, scale in summary.REPORTED])
+    >>> rows = summary.output_table('Benin', pop, stats, settings.year_start)
+    """
+    T = len(pop)
+    vals = zeros((T, 3*len(REPORTED)))
+    for j, (name, scale) in enumerate(REPORTED):
+        vals[:, 3*j] = stats[name]['mean'] * scale
+        vals[:, 3*j+1:3*j+3] = stats[name]['95% HPD interval'] * scale
+    vals[-1, :3*FLOWS] = MISSING
+
+    return [[c, year_start + t, pop[t]] + list(vals[t]) for t in range(T)]
+
+
+class Summaries:
+    """ Streaming posterior summaries of some nodes of a model,
+    updated every time the sampler tallies a sample
+
+    Example
+    -------
+    >>> summaries = summary.Summaries([mu, delta, itn_coverage])
+    >>> mc = MCMC(vars)
+    >>> summaries.attach(mc)
+    >>> mc.sample(10000)
+    >>> summaries.stats(itn_coverage)['95% HPD interval']
+    """
+    def __init__(self, nodes, size=RESERVOIR_SIZE):
+        self.nodes = nodes
+        self.accumulators = dict([[n.__name__, Accumulator(size)] for n in nodes])
+        self.cache = {}
+
+    def attach(self, sampler):
+        """ Update the summaries whenever sampler tallies a sample"""
+        tally = sampler.tally
+        def tally_and_summarize():
+            tally()
+            self.update()
+        sampler.tally = tally_and_summarize
+
+    def update(self):
+        for n in self.nodes:
+            self.accumulators[n.__name__].update(n.value)
+        self.cache = {}
+
+    def reset(self):
+        """ Forget all samples so far (e.g. at the end of burn-in)"""
+        for k, acc in self.accumulators.items():
+            self.accumulators[k] = Accumulator(acc.size)
+        self.cache = {}
+
+    def merge(self, other):
+        for k, acc in other.accumulators.items():
+            self.accumulators[k].merge(acc)
+        self.cache = {}
+
+    def stats(self, node):
+        """ Return the posterior statistics of node, like node.stats();
+        nodes that are not summarized here fall back on their trace"""
+        name = node.__name__
+        if name not in self.accumulators:
+            return node.stats(chain=None)
+        if name not in self.cache:
+            self.cache[name] = self.accumulators[name].stats()
+        return self.cache[name]
+
+    def table(self, c, pop, year_start):
+        """ Rows of output.csv for country c, from the summaries (see
+        output_table)"""
+        return output_table(c, pop, dict([[n.__name__, self.stats(n)] for n in self.nodes]), year_start)
+
+    def save(self, fname):
+        f = open(fname, 'wb')
+        cPickle.dump(self.accumulators, f)
+        f.close()
+
+
+def load(fname):
+    """ Load Summaries saved (by another process) with Summaries.save;
+    the result has no nodes, so it can only be merged or queried"""
+    f = open(fname, 'rb')
+    accumulators = cPickle.load(f)
+    f.close()
+    summaries = Summaries([])
+    summaries.accumulators = accumulators
+    return summaries
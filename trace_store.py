@@ -0,0 +1,276 @@
+""" Module for storing MCMC traces on disk in fixed-size chunks, as a
+pymc database backend
+
+Each node's trace for each chain is a flat binary file of samples,
+appended one chunk at a time while sampling.  This keeps the memory
+used by the sampler bounded, a run that crashes keeps every chunk
+written so far, and readers can memory-map the trace of a single node
+without reading any of the others.
+
+Importing this module registers it with pymc as the 'chunked'
+backend.
+
+Example
+-------
+>>> import trace_store
+>>> mc = MCMC(vars, db='chunked', dbname='bednet_model_Angola_0.traces')
+>>> mc.sample(10000)
+>>> db = trace_store.load('bednet_model_Angola_0.traces')
+>>> db.trace('itn coverage', chain=None)[:]     # memory-mapped, not read
+>>> trace_store.load_trace('bednet_model_Angola_0.traces', 'itn coverage')
+"""
+
+import os
+import re
+import sys
+import shutil
+import cPickle
+import simplejson as json
+
+from numpy import asarray, zeros, concatenate, memmap, dtype, prod
+
+import pymc
+from pymc.database import base
+
+# samples held in memory for each node before they are appended to disk
+CHUNK_SIZE = 1000
+
+
+class Trace(base.Trace):
+    def __init__(self, name, getfunc=None, db=None):
+        base.Trace.__init__(self, name, getfunc, db)
+        self._buffered = 0
+
+        desc = db.manifest['traces'].get(name)
+        if desc:
+            self.dtype = dtype(desc['dtype'])
+            self.shape = tuple(desc['shape'])
+
+    def _initialize(self, chain, length):
+        """ Start a new, empty chain on disk"""
+        base.Trace._initialize(self, chain, length)
+        value = asarray(self._getfunc())
+        assert value.dtype.kind in 'biuf', 'chunked traces must be numeric (%s is %s)' % (self.name, value.dtype)
+
+        self.dtype = value.dtype
+        self.shape = value.shape
+        self.db.describe(self)
+
+        self._buffer = zeros((self.db.chunk_size,) + self.shape, self.dtype)
+        self._buffered = 0
+        open(self.filename(chain), 'wb').close()
+
+    def tally(self, chain):
+        self._buffer[self._buffered] = self._getfunc()
+        self._buffered += 1
+        if self._buffered == len(self._buffer):
+            self.flush(chain)
+
+    def flush(self, chain):
+        """ Append the buffered samples to the file for this chain"""
+        if self._buffered > 0:
+            f = open(self.filename(chain), 'ab')
+            self._buffer[:self._buffered].tofile(f)
+            f.close()
+            self._buffered = 0
+
+    def truncate(self, index, chain):
+        self.flush(chain)
+
+    def _finalize(self, chain):
+        self.flush(chain)
+
+    def filename(self, chain):
+        return os.path.join(self.db.dbname, '%s.%d.bin' % (self.db.manifest['traces'][self.name]['file'], chain))
+
+    def memmap(self, chain):
+        """ Memory-map the samples of one chain, as an array of shape
+        (samples,) + shape"""
+        fname = self.filename(chain)
+        row_size = self.dtype.itemsize * int(prod(self.shape))
+        n = 0
+        if os.path.exists(fname) and row_size > 0:
+            n = os.path.getsize(fname) / row_size
+        if n == 0:
+            return zeros((0,) + self.shape, self.dtype)
+        return memmap(fname, self.dtype, 'r', shape=(n,) + self.shape)
+
+    def gettrace(self, burn=0, thin=1, chain=-1, slicing=None):
+        """ Return the trace
+
+        Parameters
+        ----------
+        burn, thin : int, optional
+        chain : int or None, optional
+          the chain to return, or None to join all chains (which
+          copies them into memory)
+        slicing : slice, optional
+          overrides burn and thin
+        """
+        if slicing is None:
+            slicing = slice(burn, None, thin)
+        if chain is not None:
+            if chain < 0:
+                chain = range(self.db.chains)[chain]
+            return self.memmap(chain)[slicing]
+        else:
+            return concatenate([self.memmap(k) for k in range(self.db.chains)])[slicing]
+
+    __call__ = gettrace
+
+    def length(self, chain=-1):
+        if chain is not None:
+            return len(self.gettrace(chain=chain))
+        return sum([len(self.memmap(k)) for k in range(self.db.chains)])
+
+
+class Database(base.Database):
+    def __init__(self, dbname, dbmode='a', chunk_size=CHUNK_SIZE):
+        """ Create or open a directory of chunked traces
+
+        Parameters
+        ----------
+        dbname : str
+          directory to store the traces in
+        dbmode : {'a', 'w'}, optional
+          'a' adds new chains to an existing directory, 'w' replaces it
+        chunk_size : int, optional
+          samples to hold in memory for each node between writes
+        """
+        base.Database.__init__(self, dbname)
+        self.__name__ = 'chunked'
+        self.__Trace__ = Trace
+        self.chunk_size = chunk_size
+        self.manifest = dict(traces={}, chains=0)
+
+        if os.path.exists(dbname) and dbmode == 'w':
+            shutil.rmtree(dbname)
+
+        if not os.path.exists(dbname):
+            os.makedirs(dbname)
+            return
+
+        self.manifest = read_manifest(dbname)
+        names = [str(name) for name in self.manifest['traces']]
+        for name in names:
+            self._traces[name] = Trace(name=name, db=self)
+            setattr(self, name, self._traces[name])
+        self.chains = self.manifest['chains']
+        self.trace_names = self.chains * [names]
+
+        fname = os.path.join(dbname, 'state.pickle')
+        if os.path.exists(fname):
+            f = open(fname, 'rb')
+            self._state_ = cPickle.load(f)
+            f.close()
+
+    def describe(self, trace):
+        """ Add the file name, dtype and shape of a trace to the manifest"""
+        traces = self.manifest['traces']
+        if trace.name not in traces:
+            traces[trace.name] = dict(file='%03d_%s' % (len(traces), re.sub('[^A-Za-z0-9]+', '_', trace.name).strip('_')))
+        traces[trace.name].update(dtype=trace.dtype.str, shape=list(trace.shape))
+
+    def _initialize(self, funs_to_tally, length=None):
+        base.Database._initialize(self, funs_to_tally, length)
+        self.commit()
+
+    def commit(self):
+        self.manifest['chains'] = self.chains
+        write_manifest(self.dbname, self.manifest)
+
+    def savestate(self, state):
+        base.Database.savestate(self, state)
+        f = open(os.path.join(self.dbname, 'state.pickle'), 'wb')
+        cPickle.dump(state, f)
+        f.close()
+
+    def join_chains(self, first=0):
+        """ Replace the chains with a single chain, joining chains
+        first, first+1, ... and dropping the chains before first"""
+        for name, trace in self._traces.items():
+            joined = trace.filename(0) + '.tmp'
+            f = open(joined, 'wb')
+            for k in range(first, self.chains):
+                g = open(trace.filename(k), 'rb')
+                shutil.copyfileobj(g, f)
+                g.close()
+            f.close()
+            for k in range(self.chains):
+                os.remove(trace.filename(k))
+            os.rename(joined, trace.filename(0))
+        self.trace_names = self.trace_names[-1:]
+        self.chains = 1
+        self.commit()
+
+
+def read_manifest(dbname):
+    f = open(os.path.join(dbname, 'manifest.json'))
+    manifest = json.load(f)
+    f.close()
+    return manifest
+
+def write_manifest(dbname, manifest):
+    """ Write the manifest via a temporary file, so that readers never
+    see it half written"""
+    fname = os.path.join(dbname, 'manifest.json')
+    f = open(fname + '.tmp', 'w')
+    json.dump(manifest, f)
+    f.close()
+    os.rename(fname + '.tmp', fname)
+
+
+def load(dbname):
+    """ Open a directory of chunked traces for reading
+
+    Results
+    -------
+    returns a Database with a Trace attribute for each node, as for
+    pymc.database.pickle.load; nothing is read from disk until a trace
+    is requested
+    """
+    return Database(dbname)
+
+
+def load_trace(dbname, name, chain=None):
+    """ Memory-map the trace of a single node
+
+    Parameters
+    ----------
+    dbname : str
+      directory of chunked traces
+    name : str
+      name of the node
+    chain : int or None, optional
+      the chain to return, or None to join all chains
+    """
+    return load(dbname).trace(name, chain)[:]
+
+
+def merge(dbnames, dbname):
+    """ Combine the chains in several directories of chunked traces
+    into a single directory, removing the originals
+
+    Results
+    -------
+    returns the merged Database
+    """
+    db = Database(dbname, 'w')
+    for src_name in dbnames:
+        src = load(src_name)
+        for k in range(src.chains):
+            for name, trace in src._traces.items():
+                trace_dst = Trace(name=name, db=db)
+                db.describe(trace)
+                os.rename(trace.filename(k), trace_dst.filename(db.chains))
+            db.trace_names.append(src._traces.keys())
+            db.chains += 1
+        if hasattr(src, '_state_'):
+            db.savestate(src._state_)
+        shutil.rmtree(src_name)
+    db.commit()
+    return load(dbname)
+
+
+# register with pymc, so that MCMC(..., db='chunked') uses this module
+pymc.database.chunked = sys.modules[__name__]
@@ -0,0 +1,128 @@
+""" Module for saving the state reached by each country fit, so that the
+next fit of the same country (usually after a small update to the
+data) can start from it instead of from scratch
+
+For each country, PATH/warm_start/<country>.pickle holds the values of
+the stochs at the MAP optimum, the state of the MCMC at the end of the
+last fit (the stoch values and the tuning of every step method) and
+when they were saved.  Starting from a state that was already a draw
+from (nearly) the same posterior, with proposals that were already
+tuned, needs only a short burn-in (settings.WARM_START_BURN).
+
+Example
+-------
+>>> model = Model(vars)
+>>> state = warm_start.load('Benin')
+>>> if state and warm_start.apply(model, state['mcmc']['stochastics']):
+...     mc = MCMC(vars)
+...     warm_start.tune(mc, state['mcmc'])
+>>> warm_start.save('Benin', warm_start.values(model), mc.db.getstate())
+"""
+
+import os
+import re
+import time
+import copy
+import cPickle
+
+from numpy import shape
+import pymc
+
+import settings
+import step_methods
+
+
+def filename(c, path=None):
+    return '%swarm_start/%s.pickle' % (path or settings.PATH, re.sub('[^A-Za-z0-9]+', '_', c))
+
+
+def load(c, path=None):
+    """ Load the saved state for country c
+
+    Results
+    -------
+    returns a dict with keys 'map' (stoch values at the MAP optimum),
+    'mcmc' (the MCMC state, from pymc's MCMC.get_state) and 'time', any
+    of which may be None, or returns None if there is no saved state
+    """
+    fname = filename(c, path)
+    if not os.path.exists(fname):
+        return None
+    f = open(fname, 'rb')
+    state = cPickle.load(f)
+    f.close()
+    return state
+
+
+def save(c, map_values=None, mcmc_state=None, path=None):
+    """ Save the state reached by a fit of country c, keeping the
+    previously saved MAP values or MCMC state if either is None"""
+    state = load(c, path) or dict(map=None, mcmc=None)
+    if map_values is not None:
+        state['map'] = map_values
+    if mcmc_state:
+        state['mcmc'] = dict(stochastics=mcmc_state.get('stochastics', {}),
+                             step_methods=mcmc_state.get('step_methods', {}))
+    state['time'] = time.strftime('%Y_%m_%d_%H_%M')
+
+    fname = filename(c, path)
+    try:
+        os.makedirs(os.path.dirname(fname))
+    except OSError:  # already exists
+        pass
+    f = open(fname + '.tmp', 'wb')
+    cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(fname + '.tmp', fname)
+
+
+def values(model):
+    """ Return a dict of the current value of every stoch of model"""
+    return dict([[s.__name__, copy.copy(s.value)] for s in model.stochastics])
+
+
+def apply(model, saved):
+    """ Set the stochs of model to saved values
+
+    Parameters
+    ----------
+    model : pymc Model
+    saved : dict
+      stoch values, e.g. from values()
+
+    Results
+    -------
+    returns True if the saved values were used, or False (leaving
+    model unchanged) if they do not fit the current model, because a
+    stoch is missing or has changed shape (e.g. a different year
+    range) or the model has zero probability there (e.g. because the
+    data have changed)
+    """
+    if not saved:
+        return False
+    stochs = list(model.stochastics)
+    for s in stochs:
+        if s.__name__ not in saved or shape(saved[s.__name__]) != shape(s.value):
+            return False
+
+    start = [copy.copy(s.value) for s in stochs]
+    try:
+        for s in stochs:
+            s.value = saved[s.__name__]
+        model.logp
+        return True
+    except pymc.ZeroProbability:
+        for s, x0 in zip(stochs, start):
+            s.value = x0
+        return False
+
+
+def tune(mc, mcmc_state):
+    """ Start the step methods of mc with their saved tuning; pymc
+    restores them from the database state when sampling starts.  The
+    block proposals were frozen at the end of the last fit, so they
+    are thawed to keep adapting during the burn-in"""
+    if mcmc_state and not mc.db.getstate():
+        saved = copy.deepcopy(mcmc_state['step_methods'])
+        step_methods.thaw(saved)
+        mc.db.savestate(dict(stochastics={}, step_methods=saved))